@@ -0,0 +1,112 @@
+"""
+Native cell type annotation engine.
+
+Reads an ingested sparse store, applies the same QC filters and log-normalization as
+the R stages, projects the cells onto a prepared reference atlas and labels each one
+by a kNN vote among the reference cells (see app.tasks.references). Run as a stage:
+python -m app.tasks.annotate_engine --input <store> --output <dir> --reference_dataset <name>
+"""
+from collections import Counter
+from typing import List, Optional
+import argparse
+import json
+import os
+import sys
+
+from app.tasks.de_engine import report_progress, select_cells
+from app.tasks.ingest import is_store_complete, open_store
+from app.tasks.references import get_reference
+
+# Store rows read per block
+CELL_BLOCK = 10000
+
+def marker_columns(gene_names: List[str], marker_names: List[str]):
+    """Input gene index of each reference marker gene (-1 where the input lacks it)"""
+    import numpy as np
+
+    index = {name: i for i, name in enumerate(gene_names)}
+    return np.array([index.get(name, -1) for name in marker_names], dtype=np.int64)
+
+def run_annotation(store_path: str, output_dir: str, reference_dataset: str,
+                   min_genes: int = 200, max_percent_mt: float = 20) -> dict:
+    """Write annotations.csv (cell,cell_type,confidence) and the job's summary.json"""
+    import numpy as np
+
+    store = open_store(store_path)
+    # Served from this process's cache; on a warm server the reference is already loaded
+    reference = get_reference(reference_dataset)
+
+    columns = marker_columns(store.gene_names(), reference.marker_gene_names())
+    present = columns >= 0
+    if not present.any():
+        raise ValueError(f"None of the marker genes of reference {reference_dataset} are in the input")
+
+    cells, scales = select_cells(store, min_genes, max_percent_mt)
+    kept = np.zeros(store.n_cells, dtype=bool)
+    kept[cells] = True
+    scale = np.zeros(store.n_cells)
+    scale[cells] = scales
+
+    os.makedirs(output_dir, exist_ok=True)
+    cell_names = store.cell_names()
+    counts = Counter()
+    confidence_sum = 0.0
+    with open(os.path.join(output_dir, 'annotations.csv'), 'w') as f:
+        f.write('cell,cell_type,confidence\n')
+        for start in range(0, store.n_cells, CELL_BLOCK):
+            block = store.cells(start, start + CELL_BLOCK)
+            rows = np.flatnonzero(kept[start:start + block.shape[0]])
+            if len(rows):
+                # Markers missing from the input count as unexpressed
+                expression = np.zeros((len(rows), len(columns)), dtype=np.float32)
+                values = block[rows][:, columns[present]].toarray()
+                expression[:, present] = np.log1p(values * scale[start + rows][:, None])
+
+                types, confidence = reference.vote(reference.project(expression))
+                for row, cell_type, score in zip(rows, types, confidence):
+                    f.write(f"{cell_names[start + row]},{cell_type},{score:.3f}\n")
+                counts.update(types)
+                confidence_sum += float(confidence.sum())
+            report_progress(100 * min(start + CELL_BLOCK, store.n_cells) / store.n_cells, 'annotating cells')
+
+    summary = {
+        'engine': 'native',
+        'reference_dataset': reference_dataset,
+        'reference_version': reference.meta['version'],
+        'n_cells': int(len(cells)),
+        'n_markers': int(len(columns)),
+        'n_markers_found': int(present.sum()),
+        'mean_confidence': confidence_sum / len(cells) if len(cells) else None,
+        'cell_types': dict(counts.most_common()),
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--input_format', default=None)
+    # Prepared by the worker before the stage runs; the reference is opened by name
+    parser.add_argument('--reference_dir', default=None)
+    parser.add_argument('--reference_dataset', default='default')
+    parser.add_argument('--min_genes', type=int, default=200)
+    parser.add_argument('--max_percent_mt', type=float, default=20)
+    args = parser.parse_args(argv)
+
+    if not is_store_complete(args.input):
+        print("The native engine reads the ingested sparse store; the input has not been ingested", file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        run_annotation(
+            args.input, args.output, args.reference_dataset,
+            min_genes=args.min_genes, max_percent_mt=args.max_percent_mt
+        )
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
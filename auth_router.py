@@ -1,9 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
 from pydantic import BaseModel, EmailStr
 
+from app.core.database import get_db
+from app.core.security import (
+    hash_password,
+    verify_password,
+    create_access_token,
+    get_current_user,
+    ACCESS_TOKEN_EXPIRE_HOURS
+)
+
 router = APIRouter()
 
 # Schemas
@@ -29,53 +39,15 @@ class Token(BaseModel):
     token_type: str
     user: UserResponse
 
-# Dependencies (you'll need to implement these)
-def get_db():
-    """Database session dependency"""
-    # Implement database session management
-    pass
-
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    """Get current authenticated user"""
-    # Implement JWT token validation
-    pass
-
-def hash_password(password: str) -> str:
-    """Hash password using bcrypt"""
-    from passlib.context import CryptContext
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-    return pwd_context.hash(password)
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify password"""
-    from passlib.context import CryptContext
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-    return pwd_context.verify(plain_password, hashed_password)
-
-def create_access_token(data: dict, expires_delta: timedelta = None):
-    """Create JWT access token"""
-    from jose import jwt
-    from datetime import datetime, timedelta
-    
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(hours=24)
-    
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, "your-secret-key", algorithm="HS256")
-    return encoded_jwt
-
 @router.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
     """Register a new user"""
     from app.models.user import User
     
     # Check if user exists
-    existing_user = db.query(User).filter(
+    existing_user = await db.scalar(select(User).where(
         (User.email == user_data.email) | (User.username == user_data.username)
-    ).first()
+    ))
     
     if existing_user:
         raise HTTPException(
@@ -88,24 +60,24 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         email=user_data.email,
         username=user_data.username,
         full_name=user_data.full_name,
-        hashed_password=hash_password(user_data.password)
+        hashed_password=await hash_password(user_data.password)
     )
     
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     return db_user
 
 @router.post("/login", response_model=Token)
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     """Login and get access token"""
     from app.models.user import User
     
     # Find user
-    user = db.query(User).filter(User.username == form_data.username).first()
+    user = await db.scalar(select(User).where(User.username == form_data.username))
     
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not user or not await verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -120,7 +92,8 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
     
     # Create access token
     access_token = create_access_token(
-        data={"sub": user.username, "user_id": user.id}
+        data={"sub": user.username, "user_id": user.id},
+        expires_delta=timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
     )
     
     return {
@@ -0,0 +1,367 @@
+"""
+Native clustering engine.
+
+Streams cell blocks from an ingested sparse store: QC, log-normalization and highly
+variable genes, out-of-core randomized PCA, an approximate kNN graph with shared-
+neighbor weights, and multi-threaded Louvain clustering. Run as a stage:
+python -m app.tasks.cluster_engine --input <store> --output <dir> [options]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+import argparse
+import json
+import os
+import sys
+
+from app.tasks.de_engine import report_progress, select_cells
+from app.tasks.ingest import is_store_complete, open_store
+from app.tasks.references import build_ivf_index, ivf_search
+
+# Cells per streamed block; bounds the sparse data held in memory at once
+CELL_BLOCK = int(os.getenv('CLUSTER_CELL_BLOCK', 20000))
+
+CLUSTER_THREADS = int(os.getenv('CLUSTER_THREADS', os.cpu_count() or 1))
+
+# Randomized PCA: extra sketch columns and power iterations
+PCA_OVERSAMPLE = 10
+PCA_POWER_ITERATIONS = 2
+
+# Index lists scanned per query when building the kNN graph
+KNN_NPROBE = 10
+
+# Shared-neighbor edges weaker than this are dropped, as in Seurat's FindNeighbors
+SNN_PRUNE = 1 / 15
+
+LOUVAIN_MAX_LEVELS = 10
+LOUVAIN_MAX_SWEEPS = 25
+# Share of improving nodes moved per synchronous sweep, to avoid oscillation
+LOUVAIN_MOVE_FRACTION = 0.5
+
+SEED = 0
+
+class CellMatrix:
+    """
+    Log-normalized, standardized highly variable genes of the kept cells, applied block
+    by block. Centering is kept implicit so the blocks stay sparse.
+    """
+
+    def __init__(self, store, cells, scales, genes, mean, std):
+        self.store = store
+        self.cells = cells
+        self.scales = scales
+        self.genes = genes
+        self.mean = mean
+        self.std = std
+        self.blocks = [(start, min(start + CELL_BLOCK, len(cells))) for start in range(0, len(cells), CELL_BLOCK)]
+
+    @property
+    def shape(self):
+        return len(self.cells), len(self.genes)
+
+    def block(self, start: int, stop: int):
+        """Log-normalized (uncentered) block of kept cells start..stop on the selected genes"""
+        return log_normalized_block(self.store, self.cells[start:stop], self.scales[start:stop])[:, self.genes]
+
+    def dot(self, m):
+        """Standardized matrix times m (genes x l), computed per cell block in threads"""
+        import numpy as np
+
+        scaled = m / self.std[:, None]
+        offset = (self.mean / self.std) @ m
+        out = np.empty((self.shape[0], m.shape[1]))
+
+        def run(bounds):
+            start, stop = bounds
+            out[start:stop] = self.block(start, stop) @ scaled - offset
+
+        with ThreadPoolExecutor(max_workers=CLUSTER_THREADS) as pool:
+            list(pool.map(run, self.blocks))
+        return out
+
+    def tdot(self, q):
+        """Transposed standardized matrix times q (cells x l), summed over cell blocks"""
+        import numpy as np
+
+        def run(bounds):
+            start, stop = bounds
+            return self.block(start, stop).T @ q[start:stop]
+
+        with ThreadPoolExecutor(max_workers=CLUSTER_THREADS) as pool:
+            total = sum(pool.map(run, self.blocks))
+        total = np.asarray(total)
+        return total / self.std[:, None] - np.outer(self.mean / self.std, q.sum(axis=0))
+
+def log_normalized_block(store, cell_ids, scales):
+    """CSR block of the given cells, library-size normalized and log1p transformed"""
+    import numpy as np
+    import scipy.sparse as sp
+
+    start, stop = int(cell_ids[0]), int(cell_ids[-1]) + 1
+    block = store.cells(start, stop)[cell_ids - start]
+    block = (sp.diags(scales) @ block.astype(np.float64)).tocsr()
+    block.data = np.log1p(block.data)
+    return block
+
+def select_genes(store, cells, scales, min_cells: int, n_hvg: int):
+    """
+    Highly variable genes by dispersion (variance / mean of log-normalized values)
+    among genes detected in at least min_cells cells. Returns (genes, mean, std).
+    """
+    import numpy as np
+
+    total = np.zeros(store.n_genes)
+    total_sq = np.zeros(store.n_genes)
+    detected = np.zeros(store.n_genes)
+    for start in range(0, len(cells), CELL_BLOCK):
+        block = log_normalized_block(store, cells[start:start + CELL_BLOCK], scales[start:start + CELL_BLOCK])
+        total += np.asarray(block.sum(axis=0)).ravel()
+        total_sq += np.asarray(block.multiply(block).sum(axis=0)).ravel()
+        detected += np.bincount(block.indices, minlength=store.n_genes)
+
+    n = len(cells)
+    mean = total / n
+    var = np.maximum(total_sq / n - mean**2, 0) * n / max(n - 1, 1)
+    dispersion = np.divide(var, mean, out=np.zeros_like(var), where=mean > 0)
+    dispersion[detected < min_cells] = -np.inf
+
+    candidates = np.flatnonzero(np.isfinite(dispersion) & (var > 0))
+    genes = np.sort(candidates[np.argsort(dispersion[candidates])[::-1][:n_hvg]])
+    return genes, mean[genes], np.sqrt(var[genes])
+
+def randomized_pca(matrix: CellMatrix, n_pcs: int, rng):
+    """Top principal components of the standardized matrix (Halko et al.), out of core"""
+    import numpy as np
+
+    n_pcs = min(n_pcs, min(matrix.shape) - 1)
+    sketch = min(n_pcs + PCA_OVERSAMPLE, matrix.shape[1])
+    y = matrix.dot(rng.standard_normal((matrix.shape[1], sketch)))
+    for _ in range(PCA_POWER_ITERATIONS):
+        q, _ = np.linalg.qr(y)
+        z, _ = np.linalg.qr(matrix.tdot(q))
+        y = matrix.dot(z)
+
+    q, _ = np.linalg.qr(y)
+    u, s, vt = np.linalg.svd(matrix.tdot(q).T, full_matrices=False)
+    pcs = (q @ u[:, :n_pcs]) * s[:n_pcs]
+    variance = s[:n_pcs]**2 / max(matrix.shape[0] - 1, 1)
+    return pcs.astype(np.float32), variance
+
+def knn_graph(pcs, k: int, rng):
+    """Approximate k nearest neighbors of every cell (itself excluded), queried in threads"""
+    import numpy as np
+
+    centroids, order, offsets = build_ivf_index(pcs, rng)
+    neighbors = np.empty((len(pcs), k), dtype=np.int64)
+
+    def run(start):
+        stop = min(start + CELL_BLOCK, len(pcs))
+        found, _ = ivf_search(pcs[start:stop], pcs, centroids, order, offsets, k + 1, KNN_NPROBE)
+        for row, candidates in enumerate(found):
+            others = candidates[(candidates != start + row) & (candidates >= 0)][:k]
+            # Too few candidates in the probed lists: repeat the nearest (rare for sane nprobe)
+            if len(others) < k:
+                others = np.resize(others if len(others) else [start + row], k)
+            neighbors[start + row] = others
+
+    with ThreadPoolExecutor(max_workers=CLUSTER_THREADS) as pool:
+        list(pool.map(run, range(0, len(pcs), CELL_BLOCK)))
+    return neighbors
+
+def snn_graph(neighbors):
+    """Symmetric graph over kNN edges weighted by Jaccard overlap of neighbor sets"""
+    import numpy as np
+    import scipy.sparse as sp
+
+    n, k = neighbors.shape
+    # Each cell counts as its own neighbor, as in Seurat
+    sets = np.sort(np.hstack([np.arange(n)[:, None], neighbors]), axis=1)
+    flat = (sets + (np.arange(n) * n)[:, None]).ravel()
+
+    src = np.repeat(np.arange(n), k)
+    dst = neighbors.ravel()
+    shared = np.zeros(len(src))
+    for column in range(k + 1):
+        keys = sets[dst, column] + src * n
+        pos = np.minimum(np.searchsorted(flat, keys), len(flat) - 1)
+        shared += flat[pos] == keys
+
+    jaccard = shared / (2 * (k + 1) - shared)
+    keep = jaccard >= SNN_PRUNE
+    graph = sp.csr_matrix((jaccard[keep], (src[keep], dst[keep])), shape=(n, n))
+    graph = graph.maximum(graph.T).tocsr()
+    graph.setdiag(0)
+    graph.eliminate_zeros()
+    return graph
+
+def _best_moves(graph, labels, strength, totals, m2: float, resolution: float, start: int, stop: int):
+    """Best community and modularity gain over staying, for nodes start..stop"""
+    import numpy as np
+    import scipy.sparse as sp
+
+    rows = graph[start:stop].tocoo()
+    node = rows.row
+    off_diagonal = rows.col != node + start
+    node, col, weight = node[off_diagonal], rows.col[off_diagonal], rows.data[off_diagonal]
+
+    n_local = stop - start
+    own = labels[start:stop]
+    # Edge weight from each node to each neighboring community
+    links = sp.csr_matrix((weight, (node, labels[col])), shape=(n_local, len(totals)))
+    links.sum_duplicates()
+    links = links.tocoo()
+
+    k_i = strength[start:stop]
+    is_own = links.col == own[links.row]
+    tot = totals[links.col] - np.where(is_own, k_i[links.row], 0)
+    gain = links.data - resolution * k_i[links.row] * tot / m2
+
+    stay = -resolution * k_i * (totals[own] - k_i) / m2
+    np.add.at(stay, links.row[is_own], links.data[is_own])
+
+    best_gain = stay.copy()
+    best = own.copy()
+    if not links.nnz:
+        return best
+    order = np.lexsort((-gain, links.row))
+    first = np.r_[True, links.row[order][1:] != links.row[order][:-1]]
+    top = order[first]
+    better = gain[top] > best_gain[links.row[top]] + 1e-12
+    best[links.row[top][better]] = links.col[top][better]
+    best_gain[links.row[top][better]] = gain[top][better]
+    return best
+
+def local_moving(graph, resolution: float, rng):
+    """Synchronous, multi-threaded Louvain local moving; returns compact community labels"""
+    import numpy as np
+
+    n = graph.shape[0]
+    strength = np.asarray(graph.sum(axis=1)).ravel()
+    m2 = strength.sum()
+    labels = np.arange(n)
+    if m2 == 0:
+        return labels
+
+    chunk = max(1, -(-n // CLUSTER_THREADS))
+    bounds = [(start, min(start + chunk, n)) for start in range(0, n, chunk)]
+    with ThreadPoolExecutor(max_workers=CLUSTER_THREADS) as pool:
+        for _ in range(LOUVAIN_MAX_SWEEPS):
+            totals = np.bincount(labels, weights=strength, minlength=n)
+            best = np.concatenate(list(pool.map(
+                lambda b: _best_moves(graph, labels, strength, totals, m2, resolution, *b), bounds
+            )))
+            movers = np.flatnonzero(best != labels)
+            if len(movers) <= n * 1e-4:
+                break
+            movers = movers[rng.random(len(movers)) < LOUVAIN_MOVE_FRACTION]
+            labels[movers] = best[movers]
+
+    _, compact = np.unique(labels, return_inverse=True)
+    return compact
+
+def louvain(graph, resolution: float, rng):
+    """Community per node: local moving, then aggregation, until nothing merges"""
+    import numpy as np
+    import scipy.sparse as sp
+
+    membership = np.arange(graph.shape[0])
+    for _ in range(LOUVAIN_MAX_LEVELS):
+        labels = local_moving(graph, resolution, rng)
+        n_communities = labels.max() + 1
+        if n_communities == graph.shape[0]:
+            break
+        membership = labels[membership]
+        assign = sp.csr_matrix((np.ones(len(labels)), (np.arange(len(labels)), labels)),
+                               shape=(len(labels), n_communities))
+        graph = (assign.T @ graph @ assign).tocsr()
+
+    # Cluster 0 is the largest
+    sizes = np.bincount(membership)
+    rank = np.empty_like(sizes)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+    return rank[membership]
+
+def run_clustering(store_path: str, output_dir: str, min_genes: int = 200, min_cells: int = 3,
+                   max_percent_mt: float = 20, n_hvg: int = 2000, n_pcs: int = 50,
+                   n_neighbors: int = 20, resolution: float = 0.8) -> dict:
+    """Cluster the store's cells and write clusters.csv, pcs.npy, neighbors.npy and summary.json"""
+    import numpy as np
+
+    rng = np.random.default_rng(SEED)
+    store = open_store(store_path)
+    cells, scales = select_cells(store, min_genes, max_percent_mt)
+    if len(cells) <= n_neighbors:
+        raise ValueError(f"Only {len(cells)} cells pass QC; at least {n_neighbors + 1} are needed")
+
+    report_progress(10, f"{len(cells)} cells pass QC")
+    genes, mean, std = select_genes(store, cells, scales, min_cells, n_hvg)
+    if len(genes) < 2:
+        raise ValueError("Too few variable genes pass QC to cluster")
+
+    report_progress(25, f"{len(genes)} variable genes selected")
+    matrix = CellMatrix(store, cells, scales, genes, mean, std)
+    pcs, variance = randomized_pca(matrix, n_pcs, rng)
+    report_progress(55, "PCA done")
+    neighbors = knn_graph(pcs, n_neighbors, rng)
+    report_progress(75, "Neighbor graph built")
+    clusters = louvain(snn_graph(neighbors), resolution, rng)
+    report_progress(95, "Clustering done")
+
+    os.makedirs(output_dir, exist_ok=True)
+    cell_names = store.cell_names()
+    with open(os.path.join(output_dir, 'clusters.csv'), 'w') as f:
+        f.write('cell,cluster\n')
+        f.writelines(f"{cell_names[cell]},{cluster}\n" for cell, cluster in zip(cells, clusters))
+    np.save(os.path.join(output_dir, 'pcs.npy'), pcs)
+    np.save(os.path.join(output_dir, 'neighbors.npy'), neighbors.astype(np.int32))
+
+    gene_names = store.gene_names()
+    with open(os.path.join(output_dir, 'variable_genes.txt'), 'w') as f:
+        f.writelines(f"{gene_names[g]}\n" for g in genes)
+
+    sizes = np.bincount(clusters)
+    summary = {
+        'engine': 'native',
+        'n_cells': int(len(cells)),
+        'n_genes': int(store.n_genes),
+        'n_variable_genes': int(len(genes)),
+        'n_pcs': int(pcs.shape[1]),
+        'n_neighbors': n_neighbors,
+        'resolution': resolution,
+        'n_clusters': int(len(sizes)),
+        'cluster_sizes': {str(c): int(size) for c, size in enumerate(sizes)},
+        'variance_explained': [float(v) for v in variance],
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--input_format', default=None)
+    parser.add_argument('--min_genes', type=int, default=200)
+    parser.add_argument('--min_cells', type=int, default=3)
+    parser.add_argument('--max_percent_mt', type=float, default=20)
+    parser.add_argument('--n_hvg', type=int, default=2000)
+    parser.add_argument('--n_pcs', type=int, default=50)
+    parser.add_argument('--n_neighbors', type=int, default=20)
+    parser.add_argument('--resolution', type=float, default=0.8)
+    args = parser.parse_args(argv)
+
+    if not is_store_complete(args.input):
+        print("The native engine reads the ingested sparse store; the input has not been ingested", file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        run_clustering(
+            args.input, args.output, min_genes=args.min_genes, min_cells=args.min_cells,
+            max_percent_mt=args.max_percent_mt, n_hvg=args.n_hvg, n_pcs=args.n_pcs,
+            n_neighbors=args.n_neighbors, resolution=args.resolution
+        )
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
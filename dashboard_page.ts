@@ -1,4 +1,4 @@
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { Link } from 'react-router-dom';
 import axios from 'axios';
 import { useAuth } from '../contexts/AuthContext';
@@ -17,11 +17,89 @@ const Dashboard: React.FC = () => {
   const [stats, setStats] = useState<DashboardStats | null>(null);
   const [recentJobs, setRecentJobs] = useState<any[]>([]);
   const [loading, setLoading] = useState(true);
+  const jobStatuses = useRef<Record<number, string>>({});
 
   useEffect(() => {
     fetchDashboardData();
   }, []);
 
+  // Live progress is pushed from the server instead of polled. EventSource cannot
+  // send the Authorization header the API requires, so the stream is read with fetch.
+  useEffect(() => {
+    const controller = new AbortController();
+
+    const handleEvent = (event: any) => {
+      // Counts only change on status transitions, not on progress updates
+      if (jobStatuses.current[event.job_id] !== event.status) {
+        jobStatuses.current[event.job_id] = event.status;
+        fetchStats();
+      }
+
+      setRecentJobs((jobs) =>
+        jobs.map((job) =>
+          job.id === event.job_id
+            ? { ...job, status: event.status, progress_percent: event.progress, current_step: event.step }
+            : job
+        )
+      );
+    };
+
+    const stream = async () => {
+      while (!controller.signal.aborted) {
+        try {
+          const response = await fetch(`${axios.defaults.baseURL || ''}/api/jobs/events`, {
+            headers: {
+              Accept: 'text/event-stream',
+              Authorization: String(axios.defaults.headers.common['Authorization'] || ''),
+            },
+            signal: controller.signal,
+          });
+          if (!response.ok || !response.body) {
+            throw new Error(`Event stream failed: ${response.status}`);
+          }
+
+          const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+          let buffer = '';
+          while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += value;
+
+            // Messages end with a blank line; keepalive comments start with ':'
+            const messages = buffer.split('\n\n');
+            buffer = messages.pop() || '';
+            for (const message of messages) {
+              const lines = message.split('\n');
+              const eventType = lines.find((line) => line.startsWith('event: '))?.slice(7) || 'message';
+              const data = lines.filter((line) => line.startsWith('data: ')).map((line) => line.slice(6)).join('\n');
+              if (eventType === 'job' && data) {
+                handleEvent(JSON.parse(data));
+              }
+            }
+          }
+        } catch (error) {
+          if (controller.signal.aborted) return;
+          console.error('Job event stream interrupted:', error);
+        }
+
+        // Reconnect after a pause, as EventSource would
+        await new Promise((resolve) => setTimeout(resolve, 3000));
+      }
+    };
+
+    stream();
+    return () => controller.abort();
+  }, []);
+
+  const fetchStats = async () => {
+    try {
+      const statsResponse = await axios.get('/api/users/stats');
+      setStats(statsResponse.data);
+    } catch (error) {
+      console.error('Failed to fetch dashboard stats:', error);
+    }
+  };
+
   const fetchDashboardData = async () => {
     try {
       const [statsResponse, jobsResponse] = await Promise.all([
@@ -31,6 +109,9 @@ const Dashboard: React.FC = () => {
       
       setStats(statsResponse.data);
       setRecentJobs(jobsResponse.data);
+      jobsResponse.data.forEach((job: any) => {
+        jobStatuses.current[job.id] = job.status;
+      });
     } catch (error) {
       console.error('Failed to fetch dashboard data:', error);
     } finally {
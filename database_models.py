@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, Boolean, Text, ForeignKey, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Float, Boolean, Text, ForeignKey, Enum, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
@@ -19,6 +19,16 @@ class JobStatus(str, enum.Enum):
     FAILED = "failed"
     CANCELLED = "cancelled"
 
+class UploadStatus(str, enum.Enum):
+    UPLOADING = "uploading"
+    COMPLETED = "completed"
+    ABORTED = "aborted"
+
+class IngestStatus(str, enum.Enum):
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
+
 class User(Base):
     __tablename__ = "users"
     
@@ -44,9 +54,58 @@ class User(Base):
     
     # Relationships
     jobs = relationship("AnalysisJob", back_populates="user", cascade="all, delete-orphan")
+    uploads = relationship("UploadedFile", back_populates="user", cascade="all, delete-orphan")
+
+class UploadedFile(Base):
+    __tablename__ = "uploaded_files"
+    
+    id = Column(String, primary_key=True)  # upload id handed to the client, used as input_file_id
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    
+    # File details
+    filename = Column(String, nullable=False)
+    file_path = Column(String, nullable=False)
+    status = Column(Enum(UploadStatus), default=UploadStatus.UPLOADING)
+    
+    # Chunked upload state
+    total_size = Column(BigInteger, nullable=False)
+    chunk_size = Column(Integer, nullable=False)
+    chunks_received = Column(Integer, default=0)
+    bytes_received = Column(BigInteger, default=0)
+    
+    # Request currently writing chunk chunks_received, so a concurrent PUT of the same
+    # chunk is refused; a claim older than CHUNK_CLAIM_SECONDS is abandoned
+    chunk_claim = Column(String, nullable=True)
+    chunk_claimed_at = Column(DateTime, nullable=True)
+    
+    # SHA-256 of the full file, set on completion
+    sha256 = Column(String, nullable=True, index=True)
+    
+    # Matrix dimensions when they can be read cheaply; used to size jobs.
+    # Ingest replaces them with exact values and adds nnz.
+    n_cells = Column(Integer, nullable=True)
+    n_genes = Column(Integer, nullable=True)
+    nnz = Column(BigInteger, nullable=True)
+    
+    # Canonical sparse store written by the ingest task (see app.tasks.ingest)
+    ingest_status = Column(Enum(IngestStatus), nullable=True)
+    ingest_error = Column(Text, nullable=True)
+    store_path = Column(String, nullable=True)
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+    
+    # Relationships
+    user = relationship("User", back_populates="uploads")
 
 class AnalysisJob(Base):
     __tablename__ = "analysis_jobs"
+    __table_args__ = (
+        # Job listing: filter by user (and status), keyset-paginate on (submitted_at, id)
+        Index("ix_analysis_jobs_user_status_submitted", "user_id", "status", "submitted_at", "id"),
+        Index("ix_analysis_jobs_user_submitted", "user_id", "submitted_at", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -74,15 +133,96 @@ class AnalysisJob(Base):
     
     # Results
     result_summary = Column(Text, nullable=True)
+    result_manifest = Column(Text, nullable=True)  # JSON file list written at completion
     error_message = Column(Text, nullable=True)
     
-    # Progress tracking
+    # Progress tracking (written behind by the worker, see app.tasks.progress_buffer)
     progress_percent = Column(Integer, default=0)
     current_step = Column(String, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+    
+    # Result cache key: hash of input content, job type, parameters and script version
+    cache_key = Column(String, nullable=True, index=True)
+    
+    # Scheduling: estimated peak memory, size-class queue and tier priority
+    estimated_memory_mb = Column(Float, nullable=True)
+    queue = Column(String, nullable=True)
+    priority = Column(Integer, nullable=True)
+    
+    # Celery task running the job, so cancellation can revoke it. A delivery of any
+    # other task id for the job is stale and ignored.
+    celery_task_id = Column(String, nullable=True)
+    
+    # Stages checkpointed so far (JSON list of {stage, key, at}) and how often the job
+    # was requeued after losing its worker; see app.tasks.pipeline.CHECKPOINT_DIR
+    checkpoints = Column(Text, nullable=True)
+    resume_count = Column(Integer, default=0)
+    
+    # Trace the job's spans belong to, from submission through its stages; see
+    # app.core.tracing
+    trace_id = Column(String, nullable=True)
+    
+    # Cancellation: when it was requested, and how long until the job's processes,
+    # memory reservation and partial outputs were gone
+    cancel_requested_at = Column(DateTime, nullable=True)
+    time_to_free_seconds = Column(Float, nullable=True)
+    
+    # Output storage (app.core.output_store): MB charged to the user's storage_used_mb,
+    # 'hot' or 'cold' compression tier, and when retention removed the files
+    stored_mb = Column(Float, default=0)
+    storage_tier = Column(String, default='hot')
+    outputs_deleted_at = Column(DateTime, nullable=True)
     
     # Relationships
     user = relationship("User", back_populates="jobs")
 
+class ResultCacheEntry(Base):
+    __tablename__ = "result_cache"
+    __table_args__ = (UniqueConstraint("user_id", "cache_key"),)
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    cache_key = Column(String, nullable=False)
+    
+    # What was computed
+    job_type = Column(String, nullable=False)
+    input_sha256 = Column(String, nullable=False)
+    script_version = Column(String, nullable=False)
+    source_job_id = Column(Integer, ForeignKey("analysis_jobs.id"), nullable=True)
+    
+    # Cached results
+    output_directory = Column(String, nullable=False)
+    result_summary = Column(Text, nullable=True)
+    result_manifest = Column(Text, nullable=True)
+    size_mb = Column(Float, default=0)
+    
+    # Hit accounting, also drives LRU eviction
+    hit_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class JobStageUsage(Base):
+    __tablename__ = "job_stage_usage"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, ForeignKey("analysis_jobs.id"), nullable=False, index=True)
+    job_type = Column(String, nullable=False)
+    stage = Column(String, nullable=False, index=True)
+    stage_key = Column(String, nullable=False)
+    
+    # Input size, when known; drives the memory-per-cell model
+    n_cells = Column(Integer, nullable=True)
+    
+    # Measured from the stage subprocess tree
+    wall_seconds = Column(Float, default=0)
+    cpu_seconds = Column(Float, default=0)
+    peak_rss_mb = Column(Float, default=0)
+    read_mb = Column(Float, default=0)
+    write_mb = Column(Float, default=0)
+    max_processes = Column(Integer, default=0)
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class Payment(Base):
     __tablename__ = "payments"
     
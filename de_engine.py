@@ -0,0 +1,300 @@
+"""
+Native differential expression engine.
+
+Reads an ingested sparse store, applies the same QC filters and log-normalization as
+the R stages, and tests genes block by block across a process pool. Run as a stage:
+python -m app.tasks.de_engine --input <store> --output <dir> [options]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+
+from app.core.job_outputs import ENCODING_SUFFIXES, open_stored
+from app.tasks.ingest import is_store_complete, open_store
+
+# Genes per block; each block is one task for the pool
+GENE_BLOCK = int(os.getenv('DE_GENE_BLOCK', 2000))
+
+DE_WORKERS = int(os.getenv('DE_WORKERS', os.cpu_count() or 1))
+
+TARGET_SUM = 1e4
+SIGNIFICANCE = 0.05
+TEST_METHODS = ('wilcoxon', 't_test')
+
+# Per-process state for pool workers, set once by _init_worker
+_state = {}
+
+def report_progress(percent: float, message: str):
+    """Progress line parsed by the worker into the job's progress (see app.core.job_logs)"""
+    print(f"PROGRESS {percent:.0f} {message}", flush=True)
+
+def select_cells(store, min_genes: int, max_percent_mt: float):
+    """Indices of cells passing QC and their library-size scale factors"""
+    import numpy as np
+
+    mt_genes = np.array([name.upper().startswith('MT-') for name in store.gene_names()])
+    kept, scales = [], []
+    for start in range(0, store.n_cells, 10000):
+        block = store.cells(start, start + 10000)
+        n_genes = np.diff(block.indptr)
+        totals = np.asarray(block.sum(axis=1)).ravel().astype(np.float64)
+        mt = np.asarray(block[:, mt_genes].sum(axis=1)).ravel() if mt_genes.any() else np.zeros(len(totals))
+        percent_mt = np.divide(100 * mt, totals, out=np.zeros_like(totals), where=totals > 0)
+        ok = (n_genes >= min_genes) & (percent_mt <= max_percent_mt) & (totals > 0)
+        kept.append(np.flatnonzero(ok) + start)
+        scales.append(TARGET_SUM / totals[ok])
+    return np.concatenate(kept), np.concatenate(scales)
+
+def assign_groups(cell_names: List[str], cells, group1: List[str], group2: List[str],
+                  labels_path: Optional[str]):
+    """
+    Group code per kept cell (-1 = not compared) and the group names.
+    With group1 the comparison is group1 vs group2 (or vs all other cells when group2
+    is empty); otherwise every label in labels_path is tested against the rest.
+    """
+    import numpy as np
+
+    names = [cell_names[i] for i in cells]
+    codes = np.full(len(names), -1, dtype=np.int64)
+
+    if group1:
+        first, second = set(group1), set(group2)
+        for i, name in enumerate(names):
+            if name in first:
+                codes[i] = 0
+            elif not second or name in second:
+                codes[i] = 1
+        return codes, ['group1', 'group2' if second else 'rest']
+
+    if not labels_path:
+        raise ValueError("Either group1 or a cluster labels file is required")
+
+    # The labels are another job's output, which may be stored compressed
+    encoding = next((name for name, suffix in ENCODING_SUFFIXES.items() if suffix and labels_path.endswith(suffix)), 'identity')
+    with io.TextIOWrapper(open_stored(labels_path, encoding), newline='') as f:
+        rows = csv.reader(f)
+        next(rows, None)
+        cell_label = {row[0]: row[1] for row in rows if len(row) >= 2}
+    groups = sorted(set(cell_label.values()))
+    index = {group: code for code, group in enumerate(groups)}
+    for i, name in enumerate(names):
+        if name in cell_label:
+            codes[i] = index[cell_label[name]]
+    return codes, groups
+
+def _init_worker(store_path, cells, scales, codes, n_groups, test_method):
+    import numpy as np
+
+    _state.update(
+        store=open_store(store_path),
+        cells=cells,
+        scales=scales,
+        codes=codes,
+        n_groups=n_groups,
+        group_sizes=np.bincount(codes[codes >= 0], minlength=n_groups).astype(np.float64),
+        test_method=test_method,
+    )
+
+def test_block(start: int, stop: int) -> dict:
+    """Statistics for genes start..stop, every group against the other compared cells"""
+    import numpy as np
+    from scipy import stats
+
+    store, codes, k = _state['store'], _state['codes'], _state['n_groups']
+    n_g = _state['group_sizes']
+    n = n_g.sum()
+    n_r = n - n_g
+    genes = stop - start
+
+    block = store.genes(range(start, stop))[_state['cells']].tocoo()
+    detected = np.bincount(block.col, minlength=genes)
+    # Cells outside every compared group do not take part in the ranking
+    compared = codes[block.row] >= 0
+    rows, cols = block.row[compared], block.col[compared]
+    values = np.log1p(block.data[compared] * _state['scales'][rows])
+    groups = codes[rows]
+
+    def per_group(weights=None):
+        flat = np.bincount(cols * k + groups, weights=weights, minlength=genes * k)
+        return flat.reshape(genes, k).astype(np.float64)
+
+    nnz_g = per_group()
+    nnz = nnz_g.sum(axis=1, keepdims=True)
+    expm1_g = per_group(np.expm1(values))
+    mean_g = expm1_g / n_g
+    mean_r = (expm1_g.sum(axis=1, keepdims=True) - expm1_g) / np.maximum(n_r, 1)
+    result = {
+        'avg_log2FC': np.log2(mean_g + 1) - np.log2(mean_r + 1),
+        'pct_1': nnz_g / n_g,
+        'pct_2': (nnz - nnz_g) / np.maximum(n_r, 1),
+        'detected': detected[:, None],
+    }
+
+    if _state['test_method'] == 'wilcoxon':
+        # Ranks over all compared cells at once; zeros share the lowest average rank
+        order = np.lexsort((values, cols))
+        s_cols, s_values = cols[order], values[order]
+        new_tie = np.r_[True, (s_cols[1:] != s_cols[:-1]) | (s_values[1:] != s_values[:-1])]
+        tie_start = np.flatnonzero(new_tie)
+        tie_size = np.diff(np.r_[tie_start, len(s_values)]).astype(np.float64)
+        tie_id = np.cumsum(new_tie) - 1
+
+        gene_nnz = nnz.ravel()
+        gene_first = np.r_[0, np.cumsum(gene_nnz)[:-1]]
+        zeros = n - gene_nnz
+        position = np.arange(len(s_values)) - gene_first[s_cols]
+        avg_rank = position[tie_start] + (tie_size + 1) / 2
+        ranks = np.empty(len(s_values))
+        ranks[order] = zeros[s_cols] + avg_rank[tie_id]
+
+        rank_sum = per_group(ranks) + (n_g - nnz_g) * ((zeros + 1) / 2)[:, None]
+        ties = np.bincount(s_cols[tie_start], weights=tie_size**3 - tie_size, minlength=genes) + zeros**3 - zeros
+
+        u = rank_sum - n_g * (n_g + 1) / 2
+        mu = n_g * n_r / 2
+        sigma = np.sqrt(n_g * n_r / 12 * ((n + 1) - (ties / (n * (n - 1)))[:, None]))
+        # Continuity correction, as R's wilcox.test(correct = TRUE)
+        z = np.divide(u - mu - 0.5 * np.sign(u - mu), sigma, out=np.zeros_like(u), where=sigma > 0)
+        result['statistic'] = u
+        result['p_val'] = np.where(sigma > 0, 2 * stats.norm.sf(np.abs(z)), 1.0)
+    else:
+        # Welch's t-test on log-normalized values
+        sum_g = per_group(values)
+        sumsq_g = per_group(values**2)
+        sum_r = sum_g.sum(axis=1, keepdims=True) - sum_g
+        sumsq_r = sumsq_g.sum(axis=1, keepdims=True) - sumsq_g
+        m1, m2 = sum_g / n_g, sum_r / np.maximum(n_r, 1)
+        v1 = np.maximum(sumsq_g - n_g * m1**2, 0) / np.maximum(n_g - 1, 1)
+        v2 = np.maximum(sumsq_r - n_r * m2**2, 0) / np.maximum(n_r - 1, 1)
+        se2 = v1 / n_g + v2 / np.maximum(n_r, 1)
+        t = np.divide(m1 - m2, np.sqrt(se2), out=np.zeros_like(se2), where=se2 > 0)
+        df = np.divide(se2**2, (v1 / n_g)**2 / np.maximum(n_g - 1, 1) + (v2 / n_r)**2 / np.maximum(n_r - 1, 1),
+                       out=np.ones_like(se2), where=se2 > 0)
+        result['statistic'] = t
+        result['p_val'] = np.where(se2 > 0, 2 * stats.t.sf(np.abs(t), df), 1.0)
+
+    return result
+
+def benjamini_hochberg(p_values):
+    import numpy as np
+
+    m = len(p_values)
+    order = np.argsort(p_values)
+    scaled = p_values[order] * m / np.arange(1, m + 1)
+    adjusted = np.empty(m)
+    adjusted[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+    return adjusted
+
+def run_de(store_path: str, output_dir: str, group1: List[str], group2: List[str], test_method: str,
+           labels_path: Optional[str] = None, min_genes: int = 200, min_cells: int = 3,
+           max_percent_mt: float = 20, workers: int = DE_WORKERS) -> dict:
+    """Test every gene kept by QC and write de_results.csv and summary.json"""
+    import numpy as np
+
+    if test_method not in TEST_METHODS:
+        raise ValueError(f"Unsupported test_method for the native engine: {test_method}")
+
+    store = open_store(store_path)
+    cells, scales = select_cells(store, min_genes, max_percent_mt)
+    codes, groups = assign_groups(store.cell_names(), cells, group1, group2, labels_path)
+    sizes = np.bincount(codes[codes >= 0], minlength=len(groups))
+    if len(groups) < 2 or (sizes == 0).any():
+        raise ValueError(f"Every compared group needs cells after QC: {dict(zip(groups, sizes.tolist()))}")
+
+    init_args = (store_path, cells, scales, codes, len(groups), test_method)
+    blocks = [(start, min(start + GENE_BLOCK, store.n_genes)) for start in range(0, store.n_genes, GENE_BLOCK)]
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(blocks)), initializer=_init_worker,
+                                 initargs=init_args) as pool:
+            results = []
+            for result in pool.map(test_block, *zip(*blocks)):
+                results.append(result)
+                report_progress(90 * len(results) / len(blocks), f"{len(results)}/{len(blocks)} gene blocks tested")
+    else:
+        _init_worker(*init_args)
+        results = []
+        for start, stop in blocks:
+            results.append(test_block(start, stop))
+            report_progress(90 * len(results) / len(blocks), f"{len(results)}/{len(blocks)} gene blocks tested")
+
+    columns = {name: np.vstack([r[name] for r in results]) for name in results[0]}
+    gene_names = store.gene_names()
+
+    # Genes detected in fewer than min_cells kept cells are not reported
+    tested = np.flatnonzero(columns['detected'][:, 0] >= min_cells)
+
+    # Two-group mode reports group1 only; one-vs-rest reports every label
+    reported = [0] if group1 else range(len(groups))
+    comparisons = []
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'de_results.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['group', 'gene', 'avg_log2FC', 'pct_1', 'pct_2', 'statistic', 'p_val', 'p_val_adj'])
+        for g in reported:
+            p_adj = benjamini_hochberg(columns['p_val'][tested, g])
+            order = np.argsort(columns['p_val'][tested, g], kind='stable')
+            for i in order:
+                gene = tested[i]
+                writer.writerow([
+                    groups[g], gene_names[gene],
+                    *(f"{columns[name][gene, g]:.6g}" for name in ('avg_log2FC', 'pct_1', 'pct_2', 'statistic', 'p_val')),
+                    f"{p_adj[i]:.6g}",
+                ])
+            comparisons.append({
+                'group': groups[g],
+                'n_cells': int(sizes[g]),
+                'n_significant': int((p_adj < SIGNIFICANCE).sum()),
+            })
+
+    summary = {
+        'engine': 'native',
+        'test_method': test_method,
+        'n_cells': int((codes >= 0).sum()),
+        'n_genes_tested': int(len(tested)),
+        'n_significant': sum(c['n_significant'] for c in comparisons),
+        'comparisons': comparisons,
+    }
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def _list(value: str) -> List[str]:
+    return [item for item in value.split(',') if item] if value else []
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--input_format', default=None)
+    parser.add_argument('--group1', default='')
+    parser.add_argument('--group2', default='')
+    parser.add_argument('--test_method', default='wilcoxon')
+    parser.add_argument('--labels_path', default='')
+    # Keys the stage by the labels' content; the file itself is --labels_path
+    parser.add_argument('--labels_sha256', default='')
+    parser.add_argument('--min_genes', type=int, default=200)
+    parser.add_argument('--min_cells', type=int, default=3)
+    parser.add_argument('--max_percent_mt', type=float, default=20)
+    args = parser.parse_args(argv)
+
+    if not is_store_complete(args.input):
+        print("The native engine reads the ingested sparse store; the input has not been ingested", file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        run_de(
+            args.input, args.output, _list(args.group1), _list(args.group2), args.test_method,
+            labels_path=args.labels_path or None, min_genes=args.min_genes, min_cells=args.min_cells,
+            max_percent_mt=args.max_percent_mt
+        )
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Native embedding stage for the native clustering pipeline.
+
+Lays out the cells clustered by app.tasks.cluster_engine in two dimensions from their
+principal components and kNN graph. Run as a stage:
+python -m app.tasks.embed_engine --input <cluster stage dir> --output <dir> [options]
+"""
+from typing import List, Optional
+import argparse
+import json
+import os
+import sys
+
+from app.tasks.cluster_engine import CLUSTER_THREADS
+
+def embed(pcs, neighbors, min_dist: float):
+    """
+    UMAP of the principal components, reusing the precomputed kNN graph, when umap-learn
+    is installed; otherwise the first two components. Returns (coordinates, method).
+    """
+    import numpy as np
+
+    try:
+        import umap
+    except ImportError:
+        return pcs[:, :2].astype(np.float32), 'pca'
+
+    # The graph excludes each cell itself; UMAP expects it in the first column
+    knn_indices = np.hstack([np.arange(len(pcs))[:, None], neighbors])
+    knn_dists = np.sqrt(((pcs[knn_indices] - pcs[:, None, :])**2).sum(axis=2))
+    reducer = umap.UMAP(
+        n_neighbors=knn_indices.shape[1], min_dist=min_dist, precomputed_knn=(knn_indices, knn_dists),
+        n_jobs=CLUSTER_THREADS
+    )
+    return reducer.fit_transform(pcs).astype(np.float32), 'umap'
+
+def run_embedding(cluster_dir: str, output_dir: str, umap_min_dist: float = 0.3) -> dict:
+    """Write embedding.csv (cell,x,y,cluster) and the job's summary.json"""
+    import numpy as np
+
+    pcs = np.load(os.path.join(cluster_dir, 'pcs.npy'))
+    neighbors = np.load(os.path.join(cluster_dir, 'neighbors.npy'))
+    coordinates, method = embed(pcs, neighbors, umap_min_dist)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(cluster_dir, 'clusters.csv'), 'r') as src, \
+            open(os.path.join(output_dir, 'embedding.csv'), 'w') as dst:
+        next(src)
+        dst.write('cell,x,y,cluster\n')
+        for line, (x, y) in zip(src, coordinates):
+            cell, cluster = line.rstrip('\n').rsplit(',', 1)
+            dst.write(f"{cell},{x:.5g},{y:.5g},{cluster}\n")
+
+    with open(os.path.join(cluster_dir, 'summary.json'), 'r') as f:
+        summary = json.load(f)
+    summary.update(embedding=method, umap_min_dist=umap_min_dist)
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--umap_min_dist', type=float, default=0.3)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(args.input, 'pcs.npy')):
+        print("Input is not a native clustering stage output", file=sys.stderr)
+        sys.exit(2)
+
+    run_embedding(args.input, args.output, umap_min_dist=args.umap_min_dist)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,530 @@
+from typing import Iterator, List, Optional, Sequence, Tuple
+import gzip
+import json
+import os
+import shutil
+import uuid
+
+# Canonical stores are keyed by upload content, so identical files are ingested once
+INGEST_DIR = os.getenv('INGEST_DIR', '/data/uploads/stores')
+
+STORE_META = 'meta.json'
+STORE_VERSION = 1
+SUCCESS_MARKER = '_SUCCESS'
+
+# Rows of a dense text matrix parsed per block, so wide CSVs never need a dense copy
+CSV_BLOCK_ROWS = int(os.getenv('INGEST_CSV_BLOCK_ROWS', 2000))
+
+# Entries converted per block: ingest memory is bounded by this and by the numbers of
+# cells and genes, never by the size of the upload
+INGEST_BLOCK_NNZ = int(os.getenv('INGEST_BLOCK_NNZ', 4 * 1024 * 1024))
+
+# Record layout of entries spilled to disk while a store is written
+_ENTRY_DTYPE = [('major', '<i4'), ('minor', '<i4'), ('value', '<f8')]
+
+class IngestError(Exception):
+    """The upload is not a usable count matrix; shown to the user as-is"""
+
+def store_path(sha256: str) -> str:
+    return os.path.join(INGEST_DIR, sha256)
+
+def is_store_complete(path: str) -> bool:
+    return os.path.exists(os.path.join(path, SUCCESS_MARKER))
+
+def ingest_file(file_path: str, filename: str, sha256: str) -> dict:
+    """
+    Validate an uploaded matrix and write it as a canonical sparse store.
+    Returns the store's metadata (including its path); an existing store for the
+    same content is reused. Raises IngestError for malformed input.
+    """
+    final_dir = store_path(sha256)
+    if is_store_complete(final_dir):
+        return read_store_meta(final_dir)
+
+    source = open_matrix(file_path, filename)
+
+    os.makedirs(INGEST_DIR, exist_ok=True)
+    scratch_dir = f"{final_dir}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(scratch_dir)
+    try:
+        write_store(scratch_dir, source)
+        open(os.path.join(scratch_dir, SUCCESS_MARKER), 'w').close()
+        try:
+            os.rename(scratch_dir, final_dir)
+        except OSError:
+            # Same content ingested concurrently; the other store is identical
+            if not is_store_complete(final_dir):
+                raise
+    finally:
+        if os.path.exists(scratch_dir):
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return read_store_meta(final_dir)
+
+def open_matrix(file_path: str, filename: str) -> 'MatrixSource':
+    """Streaming reader for an upload, chosen by its file name (see MatrixSource)"""
+    name = filename.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+
+    if name.endswith('.mtx'):
+        return MtxSource(file_path, filename)
+    if name.endswith('.h5ad'):
+        return H5adSource(file_path, filename)
+    if name.endswith(('.csv', '.tsv', '.txt')):
+        return DelimitedSource(file_path, filename, ',' if name.endswith('.csv') else '\t')
+
+    raise IngestError(f"Unsupported file format: {filename} (expected .mtx, .h5ad, .csv or .tsv)")
+
+class MatrixSource:
+    """
+    A cells x genes count matrix read a block at a time. entries() yields
+    (cells, genes, values) arrays of non-zero entries in any order; cell_names and
+    gene_names are complete once it is exhausted. Parse errors surface as IngestError.
+    """
+    source_format = ''
+
+    def __init__(self, file_path: str, filename: str):
+        self.file_path = file_path
+        self.filename = filename
+        self.cell_names: List[str] = []
+        self.gene_names: List[str] = []
+
+    def entries(self) -> Iterator[Tuple[object, object, object]]:
+        try:
+            yield from self._entries()
+        except IngestError:
+            raise
+        except (OSError, EOFError, ValueError, KeyError, IndexError, TypeError) as e:
+            raise IngestError(f"Could not parse {self.filename}: {e}")
+
+    def _entries(self) -> Iterator[Tuple[object, object, object]]:
+        raise NotImplementedError
+
+class MtxSource(MatrixSource):
+    """MatrixMarket in the 10x layout (genes are rows); names are not part of the format"""
+    source_format = 'mtx'
+
+    def _entries(self):
+        import numpy as np
+        import pandas as pd
+
+        with _open_text(self.file_path) as f:
+            banner = f.readline().split()
+            if len(banner) < 5 or banner[0].lower() != '%%matrixmarket' or banner[2].lower() != 'coordinate':
+                raise IngestError("Only coordinate MatrixMarket files are supported")
+            field, symmetry = banner[3].lower(), banner[4].lower()
+            if field not in ('integer', 'real', 'pattern') or symmetry != 'general':
+                raise IngestError(f"Unsupported MatrixMarket matrix: {field} {symmetry}")
+
+            line = f.readline()
+            while line.startswith('%') or (line and not line.strip()):
+                line = f.readline()
+            n_genes, n_cells = (int(value) for value in line.split()[:2])
+            self.cell_names = [f"cell_{i + 1}" for i in range(n_cells)]
+            self.gene_names = [f"gene_{i + 1}" for i in range(n_genes)]
+
+            columns = [0, 1] if field == 'pattern' else [0, 1, 2]
+            try:
+                reader = pd.read_csv(f, sep=r'\s+', header=None, comment='%', usecols=columns,
+                                     dtype={0: np.int64, 1: np.int64, 2: np.float64}, chunksize=INGEST_BLOCK_NNZ)
+                for chunk in reader:
+                    values = chunk.to_numpy()
+                    genes = values[:, 0].astype(np.int64) - 1
+                    cells = values[:, 1].astype(np.int64) - 1
+                    if genes.min() < 0 or genes.max() >= n_genes or cells.min() < 0 or cells.max() >= n_cells:
+                        raise IngestError("MatrixMarket entry outside the matrix dimensions")
+                    counts = np.ones(len(chunk)) if field == 'pattern' else values[:, 2]
+                    yield cells, genes, counts
+            except pd.errors.EmptyDataError:
+                return
+
+class H5adSource(MatrixSource):
+    """AnnData file (cells are rows), read with h5py so anndata itself is not required"""
+    source_format = 'h5ad'
+
+    def _entries(self):
+        import numpy as np
+
+        try:
+            import h5py
+        except ImportError:
+            raise IngestError("h5ad uploads require h5py on the worker")
+
+        with h5py.File(self.file_path, 'r') as f:
+            if 'X' not in f:
+                raise IngestError("h5ad file has no X matrix")
+
+            x = f['X']
+            dense = isinstance(x, h5py.Dataset)
+            n_cells, n_genes = x.shape if dense else tuple(x.attrs.get('shape', x.attrs.get('h5sparse_shape')))
+            self.cell_names = _h5ad_index(f, 'obs') or [f"cell_{i + 1}" for i in range(n_cells)]
+            self.gene_names = _h5ad_index(f, 'var') or [f"gene_{i + 1}" for i in range(n_genes)]
+
+            if dense:
+                rows = max(1, INGEST_BLOCK_NNZ // max(n_genes, 1))
+                for start in range(0, n_cells, rows):
+                    block = x[start:start + rows]
+                    cells, genes = np.nonzero(block)
+                    yield cells + start, genes, block[cells, genes].astype(np.float64)
+                return
+
+            # Sparse X is sliced along its compressed axis, a block of rows (or columns) at a time
+            by_cell = _decode(x.attrs.get('encoding-type', 'csr_matrix')) != 'csc_matrix'
+            indptr = x['indptr'][()].astype(np.int64)
+            for start, stop in major_blocks(indptr):
+                lo, hi = indptr[start], indptr[stop]
+                major = np.repeat(np.arange(start, stop), np.diff(indptr[start:stop + 1]))
+                minor = x['indices'][lo:hi].astype(np.int64)
+                values = x['data'][lo:hi].astype(np.float64)
+                yield (major, minor, values) if by_cell else (minor, major, values)
+
+class DelimitedSource(MatrixSource):
+    """Dense text matrix with genes as rows and cells as columns, parsed in row blocks"""
+    source_format = 'csv'
+
+    def __init__(self, file_path: str, filename: str, sep: str):
+        super().__init__(file_path, filename)
+        self.sep = sep
+
+    def _entries(self):
+        import numpy as np
+        import pandas as pd
+
+        header = pd.read_csv(self.file_path, sep=self.sep, index_col=0, nrows=0, compression='infer')
+        self.cell_names = [str(name) for name in header.columns]
+        # Blocks of rows are parsed densely; keep each to about INGEST_BLOCK_NNZ values
+        rows = max(1, min(CSV_BLOCK_ROWS, INGEST_BLOCK_NNZ // max(len(self.cell_names), 1)))
+
+        offset = 0
+        reader = pd.read_csv(self.file_path, sep=self.sep, index_col=0, chunksize=rows, compression='infer')
+        for chunk in reader:
+            non_numeric = [str(column) for column, dtype in chunk.dtypes.items() if dtype.kind not in 'iuf']
+            if non_numeric:
+                raise IngestError(f"Non-numeric values in column(s): {', '.join(non_numeric[:5])}")
+            self.gene_names.extend(str(name) for name in chunk.index)
+            values = chunk.to_numpy(dtype=np.float64)
+            genes, cells = np.nonzero(values)
+            yield cells, genes + offset, values[genes, cells]
+            offset += len(chunk)
+
+def _open_text(path: str):
+    """Text reader of a plain or gzip-compressed file, told apart by its magic number"""
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    return gzip.open(path, 'rt') if magic == b'\x1f\x8b' else open(path, 'r')
+
+def _h5ad_index(f, group: str) -> Optional[List[str]]:
+    if group not in f:
+        return None
+    frame = f[group]
+    column = _decode(frame.attrs.get('_index', '_index'))
+    if column not in frame:
+        return None
+    return [_decode(value) for value in frame[column][()]]
+
+def _decode(value) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else str(value)
+
+def major_blocks(indptr) -> Iterator[Tuple[int, int]]:
+    """(start, stop) ranges of rows (or columns) holding about INGEST_BLOCK_NNZ entries each"""
+    import numpy as np
+
+    n = len(indptr) - 1
+    start = 0
+    while start < n:
+        stop = int(np.searchsorted(indptr, indptr[start] + INGEST_BLOCK_NNZ, side='right')) - 1
+        stop = min(max(stop, start + 1), n)
+        yield start, stop
+        start = stop
+
+def validate_matrix(n_cells: int, n_genes: int, nnz: int, cell_names: Sequence[str], gene_names: Sequence[str]):
+    """Reject matrices no analysis can run on, before any job is queued"""
+    if n_cells == 0 or n_genes == 0:
+        raise IngestError(f"Matrix is empty ({n_cells} cells x {n_genes} genes)")
+    if nnz == 0:
+        raise IngestError("Matrix has no non-zero counts")
+    if len(cell_names) != n_cells or len(gene_names) != n_genes:
+        raise IngestError("Cell or gene names do not match the matrix dimensions")
+    if len(set(cell_names)) != n_cells:
+        raise IngestError("Cell barcodes are not unique")
+
+def validate_counts(values):
+    """Reject a block of entries that are not counts"""
+    import numpy as np
+
+    if not np.all(np.isfinite(values)):
+        raise IngestError("Matrix contains NaN or infinite values")
+    if len(values) and values.min() < 0:
+        raise IngestError("Matrix contains negative counts")
+
+def count_dtype(integral: bool, peak: float):
+    """Narrowest dtype that holds the values exactly; raw counts are small integers"""
+    import numpy as np
+
+    if integral:
+        if peak <= np.iinfo(np.uint16).max:
+            return np.uint16
+        if peak <= np.iinfo(np.uint32).max:
+            return np.uint32
+    return np.float32
+
+def write_store(path: str, source: MatrixSource):
+    """
+    Write a matrix as CSR (row slices = cells) and CSC (column slices = genes).
+    Entries are spilled to disk as they are read, bucketed by row (then column) range
+    and each bucket sorted on its own, with plain sequential file I/O, so memory is
+    bounded by INGEST_BLOCK_NNZ and the numbers of cells and genes whatever the size of
+    the upload; duplicate entries are summed. Arrays are plain .npy files so readers
+    memory-map them and touch only the rows or columns they slice; values use the
+    narrowest exact dtype instead of block compression, which would defeat memory mapping.
+    Raises IngestError for matrices no analysis can run on.
+    """
+    import numpy as np
+    import scipy.sparse as sp
+
+    spill_dir = os.path.join(path, 'spill')
+    os.makedirs(spill_dir)
+    row_entries = os.path.join(spill_dir, 'rows.bin')
+    row_genes = os.path.join(spill_dir, 'csr_genes.bin')
+    row_values = os.path.join(spill_dir, 'csr_values.bin')
+    column_entries = os.path.join(spill_dir, 'columns.bin')
+
+    # Entries in reading order, counted per cell
+    cell_counts = np.zeros(0, dtype=np.int64)
+    max_gene = -1
+    with open(row_entries, 'wb') as f:
+        for cells, genes, values in source.entries():
+            validate_counts(values)
+            kept = values != 0
+            if not kept.any():
+                continue
+            cell_counts = _add_counts(cell_counts, cells[kept])
+            max_gene = max(max_gene, int(genes[kept].max()))
+            _entry_records(cells[kept], genes[kept], values[kept]).tofile(f)
+
+    n_cells, n_genes = len(source.cell_names), len(source.gene_names)
+    if len(cell_counts) > n_cells or max_gene >= n_genes:
+        raise IngestError("Cell or gene names do not match the matrix dimensions")
+    validate_matrix(n_cells, n_genes, int(cell_counts.sum()), source.cell_names, source.gene_names)
+
+    # Rows: each bucket of cells sorted, with duplicates summed; the value range decides
+    # the stored dtype
+    indptr = np.zeros(n_cells + 1, dtype=np.int64)
+    integral, peak = True, 0.0
+    with open(row_genes, 'wb') as genes_file, open(row_values, 'wb') as values_file:
+        for start, stop, block in _bucketed(row_entries, _indptr(cell_counts, n_cells)):
+            rows = sp.csr_matrix(
+                (block['value'], (block['major'] - start, block['minor'])), shape=(stop - start, n_genes)
+            )
+            rows.sum_duplicates()
+            indptr[start + 1:stop + 1] = indptr[start] + rows.indptr[1:]
+            if rows.nnz:
+                integral = integral and bool(np.all(rows.data == np.round(rows.data)))
+                peak = max(peak, float(rows.data.max()))
+            rows.indices.astype(np.int32).tofile(genes_file)
+            rows.data.astype(np.float64).tofile(values_file)
+    nnz = int(indptr[-1])
+    dtype = count_dtype(integral, peak)
+
+    os.makedirs(os.path.join(path, 'csr'))
+    np.save(os.path.join(path, 'csr', 'indptr.npy'), indptr)
+    _copy_to_npy(row_genes, np.int32, os.path.join(path, 'csr', 'indices.npy'), np.int32, nnz)
+    _copy_to_npy(row_values, np.float64, os.path.join(path, 'csr', 'data.npy'), dtype, nnz)
+
+    # Columns: the rows are read in order, so a stable sort of each bucket of genes
+    # leaves the cells of every column sorted
+    gene_counts = np.zeros(n_genes, dtype=np.int64)
+    for genes in _read_blocks(row_genes, np.int32):
+        gene_counts += np.bincount(genes, minlength=n_genes)
+    with open(column_entries, 'wb') as f, open(row_genes, 'rb') as genes_file, open(row_values, 'rb') as values_file:
+        for start, stop in major_blocks(indptr):
+            count = int(indptr[stop] - indptr[start])
+            cells = np.repeat(np.arange(start, stop), np.diff(indptr[start:stop + 1]))
+            genes = np.fromfile(genes_file, dtype=np.int32, count=count)
+            _entry_records(genes, cells, np.fromfile(values_file, dtype=np.float64, count=count)).tofile(f)
+
+    os.makedirs(os.path.join(path, 'csc'))
+    csc_indptr = _indptr(gene_counts, n_genes)
+    np.save(os.path.join(path, 'csc', 'indptr.npy'), csc_indptr)
+    with _npy_file(os.path.join(path, 'csc', 'indices.npy'), np.int32, nnz) as cells_file, \
+            _npy_file(os.path.join(path, 'csc', 'data.npy'), dtype, nnz) as values_file:
+        for _, _, block in _bucketed(column_entries, csc_indptr):
+            block = block[np.argsort(block['major'], kind='stable')]
+            block['minor'].astype(np.int32).tofile(cells_file)
+            block['value'].astype(dtype).tofile(values_file)
+    shutil.rmtree(spill_dir)
+
+    for filename, names in (('cells.txt.gz', source.cell_names), ('genes.txt.gz', source.gene_names)):
+        with gzip.open(os.path.join(path, filename), 'wt') as f:
+            f.writelines(f"{name}\n" for name in names)
+
+    with open(os.path.join(path, STORE_META), 'w') as f:
+        json.dump({
+            'version': STORE_VERSION,
+            'source_format': source.source_format,
+            'n_cells': n_cells,
+            'n_genes': n_genes,
+            'nnz': nnz,
+            'dtype': np.dtype(dtype).name,
+        }, f, indent=2)
+
+def _entry_records(major, minor, values):
+    """Spilled entries: (major, minor, value) records, e.g. (cell, gene, count)"""
+    import numpy as np
+
+    records = np.empty(len(values), dtype=_ENTRY_DTYPE)
+    records['major'] = major
+    records['minor'] = minor
+    records['value'] = values
+    return records
+
+def _bucketed(entries_path: str, indptr) -> Iterator[Tuple[int, int, object]]:
+    """
+    Spilled entries grouped by major index: yields (start, stop, entries) for consecutive
+    ranges of about INGEST_BLOCK_NNZ entries (as counted by indptr), in order. Each range
+    is first appended to a file of its own, so only one block is in memory at a time.
+    Consumes the entries file.
+    """
+    import numpy as np
+
+    ranges = list(major_blocks(indptr))
+    starts = np.array([start for start, _ in ranges], dtype=np.int64)
+    bucket_paths = [f"{entries_path}.{i}" for i in range(len(ranges))]
+    for block in _read_blocks(entries_path, _ENTRY_DTYPE):
+        buckets = np.searchsorted(starts, block['major'], side='right') - 1
+        order = np.argsort(buckets, kind='stable')
+        buckets, block = buckets[order], block[order]
+        bounds = np.searchsorted(buckets, np.arange(len(ranges) + 1))
+        for i in np.flatnonzero(np.diff(bounds)):
+            with open(bucket_paths[i], 'ab') as f:
+                block[bounds[i]:bounds[i + 1]].tofile(f)
+    os.remove(entries_path)
+
+    for (start, stop), bucket_path in zip(ranges, bucket_paths):
+        block = np.zeros(0, dtype=_ENTRY_DTYPE)
+        if os.path.exists(bucket_path):
+            block = np.fromfile(bucket_path, dtype=_ENTRY_DTYPE)
+            os.remove(bucket_path)
+        yield start, stop, block
+
+def _read_blocks(path: str, dtype) -> Iterator[object]:
+    """A binary file of dtype values, INGEST_BLOCK_NNZ at a time"""
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        while True:
+            block = np.fromfile(f, dtype=dtype, count=INGEST_BLOCK_NNZ)
+            if not len(block):
+                return
+            yield block
+
+def _npy_file(path: str, dtype, length: int):
+    """File with the .npy header of a 1-d array, for the caller to write its values to"""
+    import numpy as np
+
+    f = open(path, 'wb')
+    np.lib.format.write_array_header_1_0(f, {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': (length,)
+    })
+    return f
+
+def _copy_to_npy(raw_path: str, raw_dtype, path: str, dtype, length: int):
+    with _npy_file(path, dtype, length) as f:
+        for block in _read_blocks(raw_path, raw_dtype):
+            block.astype(dtype, copy=False).tofile(f)
+
+def _indptr(counts, n: int):
+    """Offsets from per-index counts; counts may stop short of n"""
+    import numpy as np
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:len(counts) + 1])
+    indptr[len(counts) + 1:] = indptr[len(counts)]
+    return indptr
+
+def _add_counts(counts, keys):
+    """counts with one added per occurrence of each key, grown to cover the largest"""
+    import numpy as np
+
+    block = np.bincount(keys)
+    if len(block) > len(counts):
+        counts = np.concatenate([counts, np.zeros(len(block) - len(counts), dtype=counts.dtype)])
+    counts[:len(block)] += block
+    return counts
+
+def read_store_meta(path: str) -> dict:
+    with open(os.path.join(path, STORE_META), 'r') as f:
+        meta = json.load(f)
+    meta['path'] = path
+    return meta
+
+class SparseStore:
+    """Read-only view of a canonical store; arrays are memory-mapped on first use"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.meta = read_store_meta(path)
+        self.n_cells = self.meta['n_cells']
+        self.n_genes = self.meta['n_genes']
+        self.nnz = self.meta['nnz']
+        self._arrays = {}
+
+    def _layout(self, layout: str) -> Tuple[object, object, object]:
+        if layout not in self._arrays:
+            import numpy as np
+
+            self._arrays[layout] = tuple(
+                np.load(os.path.join(self.path, layout, f'{name}.npy'), mmap_mode='r')
+                for name in ('data', 'indices', 'indptr')
+            )
+        return self._arrays[layout]
+
+    def cells(self, start: int = 0, stop: Optional[int] = None):
+        """CSR matrix of cells start..stop (all genes); reads only those rows"""
+        import numpy as np
+        import scipy.sparse as sp
+
+        stop = self.n_cells if stop is None else min(stop, self.n_cells)
+        data, indices, indptr = self._layout('csr')
+        offsets = np.asarray(indptr[start:stop + 1])
+        lo, hi = offsets[0], offsets[-1]
+        return sp.csr_matrix(
+            (np.asarray(data[lo:hi]), np.asarray(indices[lo:hi]), offsets - lo),
+            shape=(stop - start, self.n_genes)
+        )
+
+    def genes(self, gene_ids: Sequence[int]):
+        """CSC matrix of the given gene columns (all cells); reads only those columns"""
+        import numpy as np
+        import scipy.sparse as sp
+
+        data, indices, indptr = self._layout('csc')
+        columns = [(int(indptr[g]), int(indptr[g + 1])) for g in gene_ids]
+        offsets = np.zeros(len(columns) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([hi - lo for lo, hi in columns])
+        return sp.csc_matrix(
+            (
+                np.concatenate([data[lo:hi] for lo, hi in columns]) if columns else data[:0],
+                np.concatenate([indices[lo:hi] for lo, hi in columns]) if columns else indices[:0],
+                offsets,
+            ),
+            shape=(self.n_cells, len(columns))
+        )
+
+    def cell_names(self) -> List[str]:
+        return self._read_names('cells.txt.gz')
+
+    def gene_names(self) -> List[str]:
+        return self._read_names('genes.txt.gz')
+
+    def gene_index(self) -> dict:
+        """Gene name -> column, for selecting genes by name"""
+        return {name: i for i, name in enumerate(self.gene_names())}
+
+    def _read_names(self, filename: str) -> List[str]:
+        with gzip.open(os.path.join(self.path, filename), 'rt') as f:
+            return [line.rstrip('\n') for line in f]
+
+def open_store(path: str) -> SparseStore:
+    return SparseStore(path)
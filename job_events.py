@@ -0,0 +1,125 @@
+from datetime import datetime
+from typing import AsyncIterator, Iterable, List, Optional
+import json
+
+from app.core.redis_client import get_async_redis, get_redis
+
+# Latest event per job is kept so new subscribers start from the current state
+SNAPSHOT_TTL_SECONDS = 24 * 3600
+
+# Comment lines keep proxies from closing idle streams
+HEARTBEAT_SECONDS = 15
+
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+def job_channel(job_id: int) -> str:
+    return f"job_events:job:{job_id}"
+
+def user_channel(user_id: int) -> str:
+    return f"job_events:user:{user_id}"
+
+def snapshot_key(job_id: int) -> str:
+    return f"job_events:snapshot:{job_id}"
+
+def build_event(job, progress: Optional[int] = None, step: Optional[str] = None, **extra) -> dict:
+    """Event payload for a job; progress and step default to the job's columns"""
+    status = job.status.value if hasattr(job.status, 'value') else job.status
+    event = {
+        'job_id': job.id,
+        'status': status,
+        'progress': job.progress_percent if progress is None else progress,
+        'step': job.current_step if step is None else step,
+        'ts': datetime.utcnow().isoformat(),
+    }
+    event.update(extra)
+    return event
+
+def publish_job_event(job, progress: Optional[int] = None, step: Optional[str] = None, **extra) -> dict:
+    """
+    Publish a job event to its job and user channels and store it as the snapshot.
+    Progress is best-effort: Redis errors are swallowed so they never fail a job.
+    """
+    event = build_event(job, progress, step, **extra)
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        _queue_event(pipe, job, event)
+        pipe.execute()
+    except Exception:
+        pass
+    return event
+
+def _queue_event(pipe, job, event: dict):
+    payload = json.dumps(event)
+    pipe.set(snapshot_key(job.id), payload, ex=SNAPSHOT_TTL_SECONDS)
+    pipe.publish(job_channel(job.id), payload)
+    pipe.publish(user_channel(job.user_id), payload)
+
+def publish_job_transition(job, progress: Optional[int] = None, step: Optional[str] = None, **extra) -> dict:
+    """Publish a status change (already committed) and invalidate the user's cached counts"""
+    from app.core.job_stats import invalidate_job_counts
+
+    invalidate_job_counts(job.user_id)
+    return publish_job_event(job, progress, step, **extra)
+
+def publish_job_transitions(jobs: List) -> List[dict]:
+    """publish_job_transition for many jobs in one Redis round trip"""
+    from app.core.job_stats import invalidate_job_counts
+
+    events = [build_event(job) for job in jobs]
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for job, event in zip(jobs, events):
+            _queue_event(pipe, job, event)
+        pipe.execute()
+    except Exception:
+        pass
+    for user_id in {job.user_id for job in jobs}:
+        invalidate_job_counts(user_id)
+    return events
+
+async def get_snapshots(job_ids: Iterable[int]) -> dict:
+    """Latest published event per job id, for jobs that have one"""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return {}
+    try:
+        values = await get_async_redis().mget([snapshot_key(job_id) for job_id in job_ids])
+    except Exception:
+        return {}
+    return {job_id: json.loads(value) for job_id, value in zip(job_ids, values) if value}
+
+async def stream_events(channels: List[str], initial: Iterable[dict] = (),
+                        until_terminal: bool = False) -> AsyncIterator[str]:
+    """
+    Server-sent event stream of messages on the given channels.
+    Subscribes before emitting the initial events so nothing published in between is lost.
+    With until_terminal the stream ends after the first terminal status.
+    """
+    pubsub = get_async_redis().pubsub()
+    await pubsub.subscribe(*channels)
+
+    try:
+        for event in initial:
+            yield format_sse(json.dumps(event))
+            if until_terminal and event.get('status') in TERMINAL_STATUSES:
+                return
+
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=HEARTBEAT_SECONDS)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+
+            data = message['data']
+            if isinstance(data, bytes):
+                data = data.decode()
+            yield format_sse(data)
+
+            if until_terminal and json.loads(data).get('status') in TERMINAL_STATUSES:
+                return
+    finally:
+        await pubsub.unsubscribe(*channels)
+        await pubsub.close()
+
+def format_sse(data: str, event: str = 'job') -> str:
+    return f"event: {event}\ndata: {data}\n\n"
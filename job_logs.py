@@ -0,0 +1,104 @@
+from typing import Callable, Optional, Tuple
+import os
+import re
+import threading
+
+from app.core.job_outputs import OUTPUT_ROOT
+
+# Kept beside (not inside) the job output directories, so they are not part of results
+LOG_DIR = os.getenv('JOB_LOG_DIR', os.path.join(OUTPUT_ROOT, 'logs'))
+
+# A job's log rolls over at this size, keeping LOG_BACKUPS older files
+LOG_MAX_BYTES = int(os.getenv('JOB_LOG_MAX_BYTES', 20 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv('JOB_LOG_BACKUPS', 2))
+
+# Bytes returned by the log endpoint when no offset is given, and at most per request
+LOG_TAIL_BYTES = 64 * 1024
+LOG_MAX_READ_BYTES = 1024 * 1024
+
+# Stage scripts report progress by printing e.g. "PROGRESS 40 Running PCA"
+PROGRESS_PATTERN = re.compile(r'^PROGRESS\s+(\d+(?:\.\d+)?)%?(?:\s+(.*))?$')
+
+def job_log_path(job_id: int) -> str:
+    return os.path.join(LOG_DIR, f"job_{job_id}.log")
+
+def parse_progress(line: str) -> Optional[Tuple[float, str]]:
+    """(percent within the stage, message) for a progress line, else None"""
+    match = PROGRESS_PATTERN.match(line.strip())
+    if not match:
+        return None
+    return min(float(match.group(1)), 100.0), match.group(2) or ''
+
+class JobLog:
+    """
+    Rotating log file of a job's stage output, written line by line as stages run, so
+    no output is held in memory. on_progress(stage, percent, message) is called for
+    progress lines. Safe to call from the pipe reader threads of concurrent stages.
+    """
+
+    def __init__(self, job_id: int, on_progress: Optional[Callable[[str, float, str], None]] = None):
+        self.path = job_log_path(job_id)
+        self.on_progress = on_progress
+        self._lock = threading.Lock()
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8', errors='replace')
+        self._size = self._file.tell()
+
+    def write(self, stage: str, stream: str, line: str):
+        """Record one output line of a stage (stream is 'stdout' or 'stderr')"""
+        text = f"[{stage}] {line}\n" if stream == 'stdout' else f"[{stage}:{stream}] {line}\n"
+        with self._lock:
+            if self._file.closed:
+                return
+            size = len(text.encode('utf-8', errors='replace'))
+            if self._size + size > LOG_MAX_BYTES:
+                self._rotate()
+            self._file.write(text)
+            self._file.flush()
+            self._size += size
+
+        if self.on_progress:
+            progress = parse_progress(line)
+            if progress:
+                self.on_progress(stage, *progress)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _rotate(self):
+        """job_N.log -> job_N.log.1 -> ... -> job_N.log.<LOG_BACKUPS>; the oldest is dropped"""
+        self._file.close()
+        for index in range(LOG_BACKUPS, 0, -1):
+            source = self.path if index == 1 else f"{self.path}.{index - 1}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index}")
+        if not LOG_BACKUPS:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8', errors='replace')
+        self._size = 0
+
+def read_log(job_id: int, offset: Optional[int] = None, limit: int = LOG_MAX_READ_BYTES) -> Tuple[bytes, int, int]:
+    """
+    Bytes of a job's current log file from offset (the last LOG_TAIL_BYTES if None;
+    a negative offset counts from the end). Returns (data, next offset, file size).
+    An offset beyond the file means it rotated since, so reading restarts at 0.
+    Only the requested range is read.
+    """
+    path = job_log_path(job_id)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return b'', 0, 0
+
+    if offset is None:
+        offset = -LOG_TAIL_BYTES
+    if offset < 0:
+        offset = max(size + offset, 0)
+    elif offset > size:
+        offset = 0
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(min(limit, LOG_MAX_READ_BYTES))
+    return data, offset + len(data), size
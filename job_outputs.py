@@ -0,0 +1,153 @@
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+import gzip
+import hashlib
+import io
+import lzma
+import mimetypes
+import os
+import zipfile
+
+MANIFEST_FILE = 'manifest.json'
+
+# When set (e.g. /protected-outputs/), downloads are handed to nginx via X-Accel-Redirect,
+# which serves them with sendfile and native Range support
+DOWNLOAD_ACCEL_PREFIX = os.getenv('DOWNLOAD_ACCEL_PREFIX')
+OUTPUT_ROOT = os.getenv('OUTPUT_DIR', '/data/outputs')
+
+READ_SIZE = 1024 * 1024
+
+# On-disk suffix of output files stored compressed (see app.core.output_store)
+ENCODING_SUFFIXES = {'identity': '', 'gzip': '.gz', 'xz': '.xz'}
+
+def build_manifest(output_dir: str) -> dict:
+    """Names, sizes, checksums and content types of every file under a job's output directory"""
+    files = []
+    for root, dirs, filenames in os.walk(output_dir):
+        dirs.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, output_dir)
+            if name == MANIFEST_FILE:
+                continue
+
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(READ_SIZE), b''):
+                    hasher.update(block)
+
+            files.append({
+                'name': name,
+                'size': os.path.getsize(path),
+                'sha256': hasher.hexdigest(),
+                'content_type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            })
+
+    return {
+        'files': files,
+        'total_size': sum(entry['size'] for entry in files),
+        'created_at': datetime.utcnow().isoformat(),
+    }
+
+def find_manifest_entry(manifest: dict, name: str) -> Optional[dict]:
+    """Manifest entry for a file; anything not listed (including ../ paths) is not served"""
+    for entry in manifest.get('files', []):
+        if entry['name'] == name:
+            return entry
+    return None
+
+def stored_name(entry: dict) -> str:
+    """Path of a manifest entry's file relative to the output directory"""
+    return entry['name'] + ENCODING_SUFFIXES[entry.get('encoding', 'identity')]
+
+def open_stored(path: str, encoding: str = 'identity'):
+    """Binary reader of a stored output file's original bytes"""
+    if encoding == 'gzip':
+        return gzip.open(path, 'rb')
+    if encoding == 'xz':
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Inclusive (start, end) for a single-range 'bytes=' header.
+    Returns None when there is no usable Range header (absent, malformed or multi-range,
+    which RFC 9110 says to ignore); raises ValueError if it cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+
+    start_text, dash, end_text = header[len('bytes='):].strip().partition('-')
+    start_text, end_text = start_text.strip(), end_text.strip()
+    if not dash or not (start_text or end_text) or not all(text.isdigit() for text in (start_text, end_text) if text):
+        return None
+
+    if not start_text:
+        # Suffix range: the last N bytes
+        length = int(end_text)
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+
+    start = int(start_text)
+    end = int(end_text) if end_text else size - 1
+    if end_text and end < start:
+        return None
+    if start >= size:
+        raise ValueError(header)
+    return start, min(end, size - 1)
+
+def iter_file_range(path: str, start: int, end: int, encoding: str = 'identity') -> Iterator[bytes]:
+    """Bytes start..end (inclusive) of a file in READ_SIZE blocks (decompressing if stored so)"""
+    with open_stored(path, encoding) as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(READ_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+def accel_redirect_path(path: str) -> Optional[str]:
+    """Internal nginx location for an output file, if offloading is configured"""
+    if not DOWNLOAD_ACCEL_PREFIX:
+        return None
+    relative = os.path.relpath(path, OUTPUT_ROOT)
+    return DOWNLOAD_ACCEL_PREFIX.rstrip('/') + '/' + relative
+
+class _ZipSink(io.RawIOBase):
+    """Unseekable write target; zipfile then streams entries with data descriptors"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def stream_zip(output_dir: str, files: List[dict]) -> Iterator[bytes]:
+    """
+    ZIP archive of the listed files, produced on the fly. Only one read block is held
+    in memory at a time. Entries are stored uncompressed; most outputs are already
+    compressed and this keeps the export I/O-bound. Files kept compressed on disk are
+    unpacked as they are read.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for entry in files:
+            with open_stored(os.path.join(output_dir, stored_name(entry)), entry.get('encoding', 'identity')) as src:
+                with archive.open(entry['name'], 'w', force_zip64=True) as dst:
+                    for block in iter(lambda: src.read(READ_SIZE), b''):
+                        dst.write(block)
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,50 @@
+import json
+import os
+
+from app.core.redis_client import get_redis
+
+# Counts are invalidated on every status transition; the TTL only bounds drift
+# if an invalidation is ever lost
+STATS_TTL_SECONDS = int(os.getenv('JOB_STATS_TTL_SECONDS', 300))
+
+def stats_key(user_id: int) -> str:
+    return f"job_stats:{user_id}"
+
+def get_job_counts(db, user_id: int) -> dict:
+    """Job counts per status for a user, served from Redis when cached"""
+    try:
+        cached = get_redis().get(stats_key(user_id))
+        if cached:
+            return json.loads(cached)
+    except Exception:
+        cached = None
+
+    counts = count_jobs_by_status(db, user_id)
+
+    try:
+        get_redis().set(stats_key(user_id), json.dumps(counts), ex=STATS_TTL_SECONDS)
+    except Exception:
+        pass
+
+    return counts
+
+def count_jobs_by_status(db, user_id: int) -> dict:
+    """One GROUP BY status query over the user's jobs"""
+    from sqlalchemy import func
+    from app.models.job import AnalysisJob, JobStatus
+
+    rows = db.query(AnalysisJob.status, func.count(AnalysisJob.id)).filter(
+        AnalysisJob.user_id == user_id
+    ).group_by(AnalysisJob.status).all()
+
+    counts = {status.value: 0 for status in JobStatus}
+    for status, count in rows:
+        counts[status.value if hasattr(status, 'value') else status] = count
+    return counts
+
+def invalidate_job_counts(user_id: int):
+    """Drop a user's cached counts; call after every job status transition"""
+    try:
+        get_redis().delete(stats_key(user_id))
+    except Exception:
+        pass
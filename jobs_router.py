@@ -1,11 +1,28 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy import case, or_, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
+from datetime import datetime, timedelta
+from urllib.parse import quote
+import asyncio
+import base64
 import json
+import os
+import time
+
+from app.core.database import get_db
+from app.core.security import get_current_user
 
 router = APIRouter()
 
+# Limits on sweep grids, batch submissions and job listing pages; defined before
+# the routes, whose Query bounds are evaluated at import
+MAX_SWEEP_POINTS = 64
+MAX_BATCH_JOBS = 500
+MAX_JOB_PAGE_SIZE = 500
+
 # Schemas
 class JobCreate(BaseModel):
     job_name: str
@@ -13,6 +30,16 @@ class JobCreate(BaseModel):
     input_file_id: str
     parameters: dict
 
+class SweepCreate(BaseModel):
+    job_name: str
+    job_type: str  # job type run at every point, e.g. clustering
+    input_file_id: str
+    parameters: dict = {}  # fixed for every point
+    sweep: Dict[str, List]  # parameter name -> values; the grid is their product
+
+class JobBatchCreate(BaseModel):
+    jobs: List[JobCreate]
+
 class JobResponse(BaseModel):
     id: int
     job_name: str
@@ -20,19 +47,53 @@ class JobResponse(BaseModel):
     status: str
     progress_percent: int
     current_step: Optional[str]
-    submitted_at: str
-    started_at: Optional[str]
-    completed_at: Optional[str]
+    submitted_at: datetime
+    started_at: Optional[datetime]
+    completed_at: Optional[datetime]
     result_summary: Optional[str]
     error_message: Optional[str]
     
     class Config:
         from_attributes = True
 
+class JobBatchItem(BaseModel):
+    """Outcome of one job of a batch: the created job, or why it was rejected"""
+    index: int
+    status_code: int
+    job: Optional[JobResponse] = None
+    error: Optional[str] = None
+
+class JobBatchResponse(BaseModel):
+    created: int
+    results: List[JobBatchItem]  # in request order
+
+class JobListItem(BaseModel):
+    """Job listing row; leaves out the potentially large result and error text"""
+    id: int
+    job_name: str
+    job_type: str
+    status: str
+    progress_percent: int
+    current_step: Optional[str]
+    submitted_at: datetime
+    started_at: Optional[datetime]
+    completed_at: Optional[datetime]
+    
+    class Config:
+        from_attributes = True
+
 class JobParameters(BaseModel):
+    # Shared preprocessing parameters (QC and normalization stages)
+    min_genes: Optional[int] = 200
+    min_cells: Optional[int] = 3
+    max_percent_mt: Optional[float] = 20
+    n_hvg: Optional[int] = 2000
+    
     # Clustering parameters
     resolution: Optional[float] = 0.8
     n_pcs: Optional[int] = 50
+    n_neighbors: Optional[int] = 20
+    umap_min_dist: Optional[float] = 0.3
     
     # Annotation parameters
     reference_dataset: Optional[str] = None
@@ -41,16 +102,28 @@ class JobParameters(BaseModel):
     group1: Optional[List[str]] = None
     group2: Optional[List[str]] = None
     test_method: Optional[str] = "wilcoxon"
+    # One-vs-rest over the clusters of a completed clustering job (native engine)
+    labels_job_id: Optional[int] = None
+    
+    # Analysis engine: "r" (default) or "native" where available
+    engine: Optional[str] = "r"
 
 @router.post("/", response_model=JobResponse, status_code=status.HTTP_201_CREATED)
 async def create_job(
     job_data: JobCreate,
     current_user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Create a new analysis job"""
     from app.models.job import AnalysisJob, JobStatus
-    from app.tasks.analysis import run_analysis
+    from app.core.scheduler import plan_job, dispatch_job
+    from app.core.job_events import publish_job_transition
+    from app.core.result_cache import compute_cache_key, lookup_result, complete_from_cache
+    from app.core.tracing import new_trace_id, new_span_id, format_traceparent, record_span
+    
+    # The job's trace starts here; the worker's spans hang off this one
+    started = time.time()
+    span_id = new_span_id()
     
     # Check user quota
     if not check_user_quota(current_user, db):
@@ -59,66 +132,318 @@ async def create_job(
             detail="Usage quota exceeded. Please upgrade your subscription."
         )
     
+    # The cache key needs the job type's pipeline
+    check_job_type(job_data.job_type)
+    
     # Validate input file exists and belongs to user
-    input_file = get_user_file(job_data.input_file_id, current_user.id, db)
+    input_file = await get_user_file(job_data.input_file_id, current_user.id, db)
     if not input_file:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Input file not found"
         )
     
+    # Format errors found at ingest surface now rather than in the worker
+    check_input_ingested(input_file)
+    check_references(job_data.job_type, [job_data.parameters])
+    parameters = await prepare_engine_parameters(job_data.job_type, job_data.parameters, input_file, current_user.id, db)
+    
     # Create job record
     db_job = AnalysisJob(
         user_id=current_user.id,
         job_name=job_data.job_name,
         job_type=job_data.job_type,
         input_file_path=input_file.file_path,
-        parameters=json.dumps(job_data.parameters),
-        status=JobStatus.PENDING
+        parameters=json.dumps(parameters),
+        status=JobStatus.PENDING,
+        cache_key=compute_cache_key(input_file.sha256, job_data.job_type, parameters),
+        trace_id=new_trace_id()
     )
     
+    # Identical analysis already computed: complete immediately from the cache.
+    # The cache and scheduler helpers are shared with the sync Celery workers.
+    cached = await db.run_sync(lookup_result, current_user.id, db_job.cache_key, job_data.job_type)
+    if cached:
+        complete_from_cache(db_job, cached)
+    else:
+        # Size the job from its input so it lands on a queue whose workers can hold it
+        await db.run_sync(plan_job, db_job, input_file, current_user)
+    
     db.add(db_job)
-    db.commit()
-    db.refresh(db_job)
+    await db.commit()
+    await db.refresh(db_job)
     
-    # Submit to Celery queue
-    run_analysis.delay(db_job.id)
+    publish_job_transition(db_job)
     
+    # Submit to Celery queue; the task id is saved for cancellation
+    if not cached:
+        dispatch_job(db_job, format_traceparent(db_job.trace_id, span_id))
+        await db.commit()
+    
+    record_span(db_job.id, db_job.trace_id, 'api.create_job', started, time.time() - started,
+                span_id=span_id, cached=bool(cached), queue=db_job.queue)
     return db_job
 
-@router.get("/", response_model=List[JobResponse])
+@router.post("/sweeps", response_model=JobResponse, status_code=status.HTTP_201_CREATED)
+async def create_sweep(
+    sweep_data: SweepCreate,
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Create a parameter sweep that shares preprocessing across all points"""
+    from app.models.job import AnalysisJob, JobStatus
+    from app.core.scheduler import plan_job, dispatch_job
+    from app.core.job_events import publish_job_transition
+    from app.tasks.pipeline import pipeline_defaults, expand_sweep
+    from app.core.tracing import new_trace_id, new_span_id, format_traceparent, record_span
+    
+    started = time.time()
+    span_id = new_span_id()
+    
+    check_job_type(sweep_data.job_type)
+    
+    unknown = set(sweep_data.sweep) - set(pipeline_defaults(sweep_data.job_type))
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot sweep parameters not used by {sweep_data.job_type}: {', '.join(sorted(unknown))}"
+        )
+    
+    n_points = 1
+    for values in sweep_data.sweep.values():
+        n_points *= len(values)
+    if not sweep_data.sweep or n_points == 0 or n_points > MAX_SWEEP_POINTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"A sweep must have between 1 and {MAX_SWEEP_POINTS} points"
+        )
+    
+    if not check_user_quota(current_user, db):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Usage quota exceeded. Please upgrade your subscription."
+        )
+    
+    input_file = await get_user_file(sweep_data.input_file_id, current_user.id, db)
+    if not input_file:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Input file not found"
+        )
+    
+    # Format errors found at ingest surface now rather than in the worker
+    check_input_ingested(input_file)
+    check_references(sweep_data.job_type, expand_sweep(sweep_data.parameters, sweep_data.sweep))
+    parameters = await prepare_engine_parameters(sweep_data.job_type, sweep_data.parameters, input_file, current_user.id, db)
+    
+    db_job = AnalysisJob(
+        user_id=current_user.id,
+        job_name=sweep_data.job_name,
+        job_type='sweep',
+        input_file_path=input_file.file_path,
+        parameters=json.dumps({
+            "job_type": sweep_data.job_type,
+            "parameters": parameters,
+            "sweep": sweep_data.sweep
+        }),
+        status=JobStatus.PENDING,
+        trace_id=new_trace_id()
+    )
+    await db.run_sync(plan_job, db_job, input_file, current_user)
+    
+    db.add(db_job)
+    await db.commit()
+    await db.refresh(db_job)
+    
+    publish_job_transition(db_job)
+    dispatch_job(db_job, format_traceparent(db_job.trace_id, span_id))
+    await db.commit()
+    
+    record_span(db_job.id, db_job.trace_id, 'api.create_sweep', started, time.time() - started,
+                span_id=span_id, points=n_points, queue=db_job.queue)
+    return db_job
+
+@router.post("/batch", response_model=JobBatchResponse)
+async def create_jobs(
+    batch: JobBatchCreate,
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Create many analysis jobs at once. Each job is validated as by create_job and
+    rejected on its own; the valid ones are inserted in one transaction and queued
+    together. Results are per job, in request order.
+    """
+    from app.models.job import AnalysisJob, JobStatus
+    from app.core.scheduler import plan_job, assign_task_id, dispatch_jobs
+    from app.core.job_events import publish_job_transitions
+    from app.core.result_cache import compute_cache_key, lookup_results, complete_from_cache
+    from app.core.tracing import new_trace_id, new_span_id, format_traceparent, record_span
+    
+    started = time.time()
+    
+    if not 1 <= len(batch.jobs) <= MAX_BATCH_JOBS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"A batch must have between 1 and {MAX_BATCH_JOBS} jobs"
+        )
+    
+    # Quota is checked once for the whole batch
+    if not check_user_quota(current_user, db):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Usage quota exceeded. Please upgrade your subscription."
+        )
+    
+    input_files = await get_user_files([job_data.input_file_id for job_data in batch.jobs], current_user.id, db)
+    
+    results = [JobBatchItem(index=index, status_code=status.HTTP_201_CREATED) for index in range(len(batch.jobs))]
+    accepted = []
+    for index, job_data in enumerate(batch.jobs):
+        try:
+            check_job_type(job_data.job_type)
+            input_file = input_files.get(job_data.input_file_id)
+            if not input_file:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Input file not found"
+                )
+            check_input_ingested(input_file)
+            check_references(job_data.job_type, [job_data.parameters])
+            parameters = await prepare_engine_parameters(job_data.job_type, job_data.parameters, input_file, current_user.id, db)
+        except HTTPException as e:
+            results[index].status_code = e.status_code
+            results[index].error = e.detail
+            continue
+        
+        db_job = AnalysisJob(
+            user_id=current_user.id,
+            job_name=job_data.job_name,
+            job_type=job_data.job_type,
+            input_file_path=input_file.file_path,
+            parameters=json.dumps(parameters),
+            status=JobStatus.PENDING,
+            cache_key=compute_cache_key(input_file.sha256, job_data.job_type, parameters),
+            trace_id=new_trace_id()
+        )
+        accepted.append((index, db_job, input_file))
+    
+    # Cache hits complete immediately; the rest are planned with memory models fitted once
+    cached = await db.run_sync(
+        lookup_results, current_user.id, [(db_job.cache_key, db_job.job_type) for _, db_job, _ in accepted]
+    )
+    queued = []
+    models = {}
+    for _, db_job, input_file in accepted:
+        entry = cached.get(db_job.cache_key)
+        if entry:
+            complete_from_cache(db_job, entry)
+        else:
+            await db.run_sync(plan_job, db_job, input_file, current_user, models)
+            # Committed with the rows, so the tasks never see a job without its task id
+            assign_task_id(db_job)
+            queued.append(db_job)
+    
+    # Flushed together, rows become multi-row INSERT ... RETURNING statements
+    jobs = [db_job for _, db_job, _ in accepted]
+    db.add_all(jobs)
+    await db.commit()
+    
+    publish_job_transitions(jobs)
+    
+    span_ids = {db_job.id: new_span_id() for db_job in jobs}
+    dispatch_jobs(queued, [format_traceparent(db_job.trace_id, span_ids[db_job.id]) for db_job in queued])
+    
+    duration = time.time() - started
+    for index, db_job, _ in accepted:
+        results[index].job = JobResponse.model_validate(db_job)
+        record_span(db_job.id, db_job.trace_id, 'api.create_jobs', started, duration,
+                    span_id=span_ids[db_job.id], cached=db_job.cache_key in cached, batch_size=len(batch.jobs))
+    
+    return JobBatchResponse(created=len(jobs), results=results)
+
+@router.get("/", response_model=List[JobListItem])
 async def list_jobs(
-    skip: int = 0,
-    limit: int = 100,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_JOB_PAGE_SIZE),
     status: Optional[str] = None,
     current_user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """List all jobs for current user"""
+    """
+    List jobs for current user, newest first.
+    When more jobs exist the X-Next-Cursor header holds the cursor for the next page.
+    """
     from app.models.job import AnalysisJob
     
-    query = db.query(AnalysisJob).filter(AnalysisJob.user_id == current_user.id)
+    # Only the listed columns are loaded; result_summary and error_message can be huge
+    query = select(
+        AnalysisJob.id,
+        AnalysisJob.job_name,
+        AnalysisJob.job_type,
+        AnalysisJob.status,
+        AnalysisJob.progress_percent,
+        AnalysisJob.current_step,
+        AnalysisJob.submitted_at,
+        AnalysisJob.started_at,
+        AnalysisJob.completed_at
+    ).where(AnalysisJob.user_id == current_user.id)
     
     if status:
-        query = query.filter(AnalysisJob.status == status)
+        query = query.where(AnalysisJob.status == status)
+    
+    # Keyset pagination: deep pages seek the index instead of skipping rows
+    if cursor:
+        submitted_at, job_id = decode_job_cursor(cursor)
+        query = query.where(tuple_(AnalysisJob.submitted_at, AnalysisJob.id) < (submitted_at, job_id))
     
-    jobs = query.order_by(AnalysisJob.submitted_at.desc()).offset(skip).limit(limit).all()
+    jobs = (await db.execute(query.order_by(
+        AnalysisJob.submitted_at.desc(),
+        AnalysisJob.id.desc()
+    ).limit(limit + 1))).all()
+    
+    if len(jobs) > limit:
+        jobs = jobs[:limit]
+        response.headers["X-Next-Cursor"] = encode_job_cursor(jobs[-1].submitted_at, jobs[-1].id)
     
     return jobs
 
+@router.get("/events")
+async def stream_user_events(
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Server-sent events for all of the current user's jobs"""
+    from app.models.job import AnalysisJob, JobStatus
+    from app.core.job_events import user_channel, get_snapshots, stream_events
+    
+    # Start with the latest state of the user's active jobs
+    active_ids = (await db.scalars(select(AnalysisJob.id).where(
+        AnalysisJob.user_id == current_user.id,
+        AnalysisJob.status.in_([JobStatus.PENDING, JobStatus.RUNNING])
+    ))).all()
+    snapshots = await get_snapshots(active_ids)
+    
+    return StreamingResponse(
+        stream_events([user_channel(current_user.id)], initial=snapshots.values()),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
 @router.get("/{job_id}", response_model=JobResponse)
 async def get_job(
     job_id: int,
     current_user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get job details"""
     from app.models.job import AnalysisJob
     
-    job = db.query(AnalysisJob).filter(
+    job = await db.scalar(select(AnalysisJob).where(
         AnalysisJob.id == job_id,
         AnalysisJob.user_id == current_user.id
-    ).first()
+    ))
     
     if not job:
         raise HTTPException(
@@ -126,21 +451,124 @@ async def get_job(
             detail="Job not found"
         )
     
+    # Progress between state transitions lives only in Redis
+    await apply_progress_snapshot(job)
+    
     return job
 
+@router.get("/{job_id}/events")
+async def stream_job_events(
+    job_id: int,
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Server-sent events for one job; the stream ends when the job does"""
+    from app.models.job import AnalysisJob
+    from app.core.job_events import job_channel, build_event, get_snapshots, stream_events
+    
+    job = await db.scalar(select(AnalysisJob).where(
+        AnalysisJob.id == job_id,
+        AnalysisJob.user_id == current_user.id
+    ))
+    
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    
+    # The database is authoritative for finished jobs, Redis for progress of live ones
+    initial = build_event(job)
+    if initial['status'] not in ('completed', 'failed', 'cancelled'):
+        initial = (await get_snapshots([job.id])).get(job.id, initial)
+    
+    return StreamingResponse(
+        stream_events([job_channel(job.id)], initial=[initial], until_terminal=True),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+@router.get("/{job_id}/logs")
+async def get_job_logs(
+    job_id: int,
+    offset: Optional[int] = Query(None, description="Byte offset to read from; negative counts from the end"),
+    limit: int = Query(256 * 1024, ge=1, le=1024 * 1024),
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Stage output of a job, running or finished. Without an offset the recent tail is
+    returned; poll with the X-Log-Offset of the previous response to follow the log.
+    """
+    from app.models.job import AnalysisJob
+    from app.core.job_logs import read_log
+
+    job_exists = await db.scalar(select(AnalysisJob.id).where(
+        AnalysisJob.id == job_id,
+        AnalysisJob.user_id == current_user.id
+    ))
+
+    if not job_exists:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+
+    # Only the requested range is read, however large the log has grown
+    data, next_offset, size = await asyncio.to_thread(read_log, job_id, offset, limit)
+
+    return Response(
+        content=data,
+        media_type="text/plain; charset=utf-8",
+        headers={
+            "X-Log-Offset": str(next_offset),
+            "X-Log-Size": str(size),
+            "Cache-Control": "no-store"
+        }
+    )
+
+@router.get("/{job_id}/trace")
+async def get_job_trace(
+    job_id: int,
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Spans of a job from submission through queueing, each stage and storing its
+    outputs, in start order. Times are in seconds; 'start' is a Unix time.
+    """
+    from app.models.job import AnalysisJob
+    from app.core.tracing import read_trace
+
+    trace_id = await db.scalar(select(AnalysisJob.trace_id).where(
+        AnalysisJob.id == job_id,
+        AnalysisJob.user_id == current_user.id
+    ))
+
+    if trace_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+
+    return {"trace_id": trace_id, "spans": await asyncio.to_thread(read_trace, job_id)}
+
 @router.delete("/{job_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def cancel_job(
     job_id: int,
     current_user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Cancel a running job"""
+    """
+    Cancel a queued or running job. A running job's worker stops its whole process
+    tree (SIGTERM, then SIGKILL), removes partial outputs and frees its slot.
+    """
     from app.models.job import AnalysisJob, JobStatus
     
-    job = db.query(AnalysisJob).filter(
+    job = await db.scalar(select(AnalysisJob).where(
         AnalysisJob.id == job_id,
         AnalysisJob.user_id == current_user.id
-    ).first()
+    ))
     
     if not job:
         raise HTTPException(
@@ -148,82 +576,469 @@ async def cancel_job(
             detail="Job not found"
         )
     
-    if job.status in [JobStatus.COMPLETED, JobStatus.FAILED]:
+    # Only a job still queued or running is cancelled, in one conditional UPDATE, so a
+    # job that completes or fails meanwhile keeps its outcome. A job that never
+    # started has nothing to free; a running one is finished by its worker.
+    now = datetime.utcnow()
+    queued = AnalysisJob.status == JobStatus.PENDING
+    cancelled = await db.execute(update(AnalysisJob).where(
+        AnalysisJob.id == job.id,
+        AnalysisJob.status.in_([JobStatus.PENDING, JobStatus.RUNNING])
+    ).values(
+        status=JobStatus.CANCELLED,
+        cancel_requested_at=now,
+        completed_at=case((queued, now), else_=AnalysisJob.completed_at),
+        time_to_free_seconds=case((queued, 0.0), else_=AnalysisJob.time_to_free_seconds)
+    ).execution_options(synchronize_session=False))
+    await db.commit()
+    await db.refresh(job)
+    
+    if cancelled.rowcount != 1:
+        if job.status == JobStatus.CANCELLED:
+            return None
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Cannot cancel completed or failed job"
         )
     
-    # Update status and revoke Celery task
-    job.status = JobStatus.CANCELLED
-    db.commit()
+    from app.core.job_events import publish_job_transition
+    publish_job_transition(job)
     
-    # Revoke the Celery task
-    from app.tasks.analysis import celery_app
-    celery_app.control.revoke(str(job.id), terminate=True)
+    # Queued tasks are dropped; a running one gets SIGUSR1, which the prefork pool
+    # raises in the task as SoftTimeLimitExceeded so it can stop its stages and clean
+    # up. Other pools cannot terminate tasks, so workers refuse to start with them.
+    if job.celery_task_id:
+        from app.tasks.analysis import celery_app
+        celery_app.control.revoke(job.celery_task_id, terminate=True, signal='SIGUSR1')
     
     return None
 
-@router.get("/{job_id}/results")
-async def get_job_results(
+@router.post("/{job_id}/retry", response_model=JobResponse)
+async def retry_job(
     job_id: int,
     current_user = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Get job results and output files"""
+    """
+    Run a failed or cancelled job again. Stages it checkpointed before failing are
+    restored rather than rerun (a cancelled job's partial outputs were removed).
+    """
     from app.models.job import AnalysisJob, JobStatus
-    import os
-    
-    job = db.query(AnalysisJob).filter(
+    from app.core.scheduler import assign_task_id, dispatch_job
+    from app.core.tracing import new_trace_id, new_span_id, format_traceparent, record_span
+
+    started = time.time()
+    span_id = new_span_id()
+
+    job = await db.scalar(select(AnalysisJob).where(
         AnalysisJob.id == job_id,
         AnalysisJob.user_id == current_user.id
-    ).first()
-    
+    ))
+
     if not job:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Job not found"
         )
-    
-    if job.status != JobStatus.COMPLETED:
+
+    if job.status not in [JobStatus.FAILED, JobStatus.CANCELLED]:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Job is not completed yet"
+            detail="Only failed or cancelled jobs can be retried"
         )
+
+    if not check_user_quota(current_user, db):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Usage quota exceeded. Please upgrade your subscription."
+        )
+
+    # Claimed with a conditional UPDATE, so concurrent retries dispatch once. A
+    # cancelled job is retried only once its worker has torn it down (completed_at is
+    # set), or has been silent for as long as the reaper would wait, since teardown
+    # removes the output directory the new run would write to.
+    from app.tasks.analysis import HEARTBEAT_TIMEOUT_SECONDS
+
+    torn_down_before = datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT_SECONDS)
+    was_cancelled = job.status == JobStatus.CANCELLED
+    claimed = await db.execute(update(AnalysisJob).where(
+        AnalysisJob.id == job.id,
+        or_(
+            AnalysisJob.status == JobStatus.FAILED,
+            (AnalysisJob.status == JobStatus.CANCELLED) & or_(
+                AnalysisJob.completed_at.isnot(None),
+                AnalysisJob.cancel_requested_at < torn_down_before
+            )
+        )
+    ).values(status=JobStatus.PENDING).execution_options(synchronize_session=False))
+    if claimed.rowcount != 1:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Job is still being cancelled, or is already being retried"
+        )
+
+    if was_cancelled:
+        job.checkpoints = None
+    job.status = JobStatus.PENDING
+    job.progress_percent = 0
+    job.current_step = 'Retrying'
+    job.error_message = None
+    job.started_at = None
+    job.completed_at = None
+    job.cancel_requested_at = None
+    job.time_to_free_seconds = None
+    job.resume_count = 0
+    # The new attempt's spans join the job's existing trace
+    job.trace_id = job.trace_id or new_trace_id()
+    # Committed before sending, so the new task never sees the old task's id
+    assign_task_id(job)
+    await db.commit()
+
+    from app.core.job_events import publish_job_transition
+    publish_job_transition(job)
+    dispatch_job(job, format_traceparent(job.trace_id, span_id))
+
+    record_span(job.id, job.trace_id, 'api.retry_job', started, time.time() - started, span_id=span_id)
+    return job
+
+@router.get("/{job_id}/results")
+async def get_job_results(
+    job_id: int,
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get job results and output files"""
+    job = await get_completed_job(job_id, current_user.id, db)
+    manifest = await get_job_manifest(job, db)
+    if job.outputs_deleted_at:
+        manifest = {"files": [], "total_size": 0}
     
-    # List output files
-    output_files = []
-    if job.output_directory and os.path.exists(job.output_directory):
-        for filename in os.listdir(job.output_directory):
-            file_path = os.path.join(job.output_directory, filename)
-            output_files.append({
-                "filename": filename,
-                "size": os.path.getsize(file_path),
-                "download_url": f"/api/jobs/{job_id}/download/{filename}"
-            })
+    output_files = [
+        {
+            "filename": entry["name"],
+            "size": entry["size"],
+            "sha256": entry["sha256"],
+            "content_type": entry["content_type"],
+            "download_url": f"/api/jobs/{job_id}/download/{quote(entry['name'])}"
+        }
+        for entry in manifest["files"]
+    ]
     
     return {
         "job_id": job.id,
         "status": job.status,
         "result_summary": json.loads(job.result_summary) if job.result_summary else None,
-        "output_files": output_files
+        "output_files": output_files,
+        "total_size": manifest["total_size"],
+        "stored_size": manifest.get("stored_size", manifest["total_size"]),
+        "outputs_deleted_at": job.outputs_deleted_at.isoformat() if job.outputs_deleted_at else None,
+        "archive_url": f"/api/jobs/{job_id}/download.zip"
     }
 
+@router.get("/{job_id}/download.zip")
+async def download_job_archive(
+    job_id: int,
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """All output files as a ZIP built while it streams"""
+    from app.core.job_outputs import stream_zip
+    
+    job = await get_completed_job(job_id, current_user.id, db)
+    check_outputs_available(job)
+    manifest = await get_job_manifest(job, db)
+    
+    return StreamingResponse(
+        stream_zip(job.output_directory, manifest["files"]),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="job_{job.id}_results.zip"'}
+    )
+
+@router.get("/{job_id}/download/{filename:path}")
+async def download_job_file(
+    job_id: int,
+    filename: str,
+    request: Request,
+    current_user = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Download one output file; supports Range, If-Range and If-None-Match. Files stored
+    gzip-compressed are sent as-is to clients that accept gzip, otherwise unpacked.
+    """
+    from app.core.job_outputs import (find_manifest_entry, parse_range, iter_file_range, accel_redirect_path,
+                                      stored_name)
+    
+    job = await get_completed_job(job_id, current_user.id, db)
+    check_outputs_available(job)
+    manifest = await get_job_manifest(job, db)
+    
+    # Only files listed in the manifest are served, which also rules out path traversal
+    entry = find_manifest_entry(manifest, filename)
+    if not entry:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="File not found"
+        )
+    
+    path = os.path.join(job.output_directory, stored_name(entry))
+    encoding = entry.get("encoding", "identity")
+    size = entry["size"]
+    etag = f'"{entry["sha256"]}"'
+    
+    # Ranges are of the decoded content, whose ETag is the one If-Range is checked against
+    range_header = request.headers.get("range")
+    if request.headers.get("if-range", etag) != etag:
+        range_header = None
+    
+    # A gzip file sent as-is is a different representation, so it gets its own ETag
+    send_gzip = encoding == "gzip" and not range_header and "gzip" in request.headers.get("accept-encoding", "")
+    if send_gzip:
+        etag = f'"{entry["sha256"]}-gz"'
+    
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(os.path.basename(entry['name']))}"
+    }
+    if encoding == "gzip":
+        headers["Vary"] = "Accept-Encoding"
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    # Let nginx serve the bytes with sendfile (and ranges) when it fronts the API
+    accel_path = accel_redirect_path(path) if encoding == "identity" else None
+    if accel_path:
+        headers["X-Accel-Redirect"] = accel_path
+        return Response(headers=headers, media_type=entry["content_type"])
+    
+    if send_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return FileResponse(path, media_type=entry["content_type"], headers=headers)
+    
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        return Response(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    
+    if byte_range is None:
+        if encoding == "identity":
+            return FileResponse(path, media_type=entry["content_type"], headers=headers)
+        byte_range = (0, size - 1)
+        status_code = status.HTTP_200_OK
+    else:
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+    
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file_range(path, start, end, encoding),
+        status_code=status_code,
+        media_type=entry["content_type"],
+        headers=headers
+    )
+
 # Helper functions
+
+def encode_job_cursor(submitted_at: datetime, job_id: int) -> str:
+    """Opaque cursor for the position after a listed job"""
+    raw = f"{submitted_at.isoformat()}|{job_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_job_cursor(cursor: str):
+    """Inverse of encode_job_cursor; rejects malformed cursors with a 400"""
+    try:
+        submitted_at, job_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(submitted_at), int(job_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def apply_progress_snapshot(job):
+    """Overlay the latest published progress on a running job (not persisted)"""
+    from sqlalchemy.orm.attributes import set_committed_value
+    from app.models.job import JobStatus
+    from app.core.job_events import get_snapshots
+    
+    if job.status != JobStatus.RUNNING:
+        return
+    
+    snapshot = (await get_snapshots([job.id])).get(job.id)
+    if snapshot:
+        # Set as committed values so the session never writes them back
+        set_committed_value(job, 'progress_percent', snapshot['progress'])
+        set_committed_value(job, 'current_step', snapshot['step'])
+
 def check_user_quota(user, db) -> bool:
     """Check if user has available quota"""
     # Implement quota checking logic based on subscription tier
     return True
 
-def get_user_file(file_id: str, user_id: int, db):
-    """Get file by ID if it belongs to user"""
-    # Implement file retrieval logic
-    pass
+async def get_completed_job(job_id: int, user_id: int, db: AsyncSession):
+    """A completed job owned by the user, or the matching 404/400"""
+    from app.models.job import AnalysisJob, JobStatus
+    
+    job = await db.scalar(select(AnalysisJob).where(
+        AnalysisJob.id == job_id,
+        AnalysisJob.user_id == user_id
+    ))
+    
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found"
+        )
+    
+    if job.status != JobStatus.COMPLETED:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Job is not completed yet"
+        )
+    
+    return job
 
-def get_current_user():
-    """Get current authenticated user (placeholder)"""
-    pass
+def check_outputs_available(job):
+    """410 once a job's output files were removed by retention (see app.core.output_store)"""
+    if job.outputs_deleted_at:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="Output files were removed after the retention period"
+        )
+
+async def get_job_manifest(job, db: AsyncSession) -> dict:
+    """The job's stored output manifest; built once and saved for jobs that predate it"""
+    from app.core.job_outputs import build_manifest
+    
+    if job.result_manifest:
+        return json.loads(job.result_manifest)
+    
+    if not job.output_directory or not os.path.isdir(job.output_directory):
+        return {"files": [], "total_size": 0}
+    
+    # Hashing can take a while on large outputs; keep it off the event loop
+    manifest = await asyncio.to_thread(build_manifest, job.output_directory)
+    job.result_manifest = json.dumps(manifest)
+    await db.commit()
+    return manifest
+
+def check_job_type(job_type: str):
+    """Reject job types without a pipeline before anything keys or plans them"""
+    from app.tasks.pipeline import JOB_PIPELINES
+
+    if job_type not in JOB_PIPELINES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown job type: {job_type}"
+        )
+
+def check_input_ingested(input_file):
+    """Uploads that failed validation at ingest are rejected before any job is queued"""
+    from app.models.upload import IngestStatus
+
+    if input_file.ingest_status == IngestStatus.FAILED:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Input file is not a valid count matrix: {input_file.ingest_error}"
+        )
+
+def check_references(job_type: str, parameter_sets: List[dict]):
+    """Reject unknown reference atlases up front instead of failing in the worker"""
+    from app.tasks.pipeline import JOB_PIPELINES, get_pipeline, stage_parameters
+    from app.tasks.references import reference_exists
+
+    if job_type not in JOB_PIPELINES:
+        return
+    for stage in get_pipeline(job_type):
+        if not stage.reference_param:
+            continue
+        for params in parameter_sets:
+            name = stage_parameters(stage, params or {})[stage.reference_param]
+            if not reference_exists(name):
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Unknown reference dataset: {name}"
+                )
+
+async def prepare_engine_parameters(job_type: str, parameters: dict, input_file, user_id: int,
+                                    db: AsyncSession) -> dict:
+    """
+    Validate the engine choice and pin labels_job_id to the content of that job's
+    cluster labels (labels_sha256), which keys the job; the worker finds the file
+    """
+    from app.models.job import AnalysisJob, JobStatus
+    from app.models.upload import IngestStatus
+    from app.core.job_outputs import find_manifest_entry
+    from app.tasks.pipeline import CLUSTER_LABELS_FILE, DEFAULT_ENGINE, JOB_PIPELINES, get_pipeline
+
+    parameters = dict(parameters or {})
+    if job_type not in JOB_PIPELINES:
+        return parameters
+    try:
+        get_pipeline(job_type, parameters)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    if (parameters.get('engine') or DEFAULT_ENGINE) == DEFAULT_ENGINE:
+        return parameters
+
+    # Native engines read the ingested store rather than the raw upload
+    if input_file.ingest_status != IngestStatus.READY:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Input file is still being ingested; retry once its ingest_status is ready"
+        )
+
+    # Only the worker resolves files; a client-supplied path is never trusted
+    parameters.pop('labels_path', None)
+    parameters.pop('labels_sha256', None)
+    labels_job_id = parameters.get('labels_job_id')
+    if labels_job_id is not None:
+        labels_job = await db.scalar(select(AnalysisJob).where(
+            AnalysisJob.id == labels_job_id,
+            AnalysisJob.user_id == user_id,
+            AnalysisJob.status == JobStatus.COMPLETED,
+            AnalysisJob.outputs_deleted_at.is_(None)
+        ))
+        entry = find_manifest_entry(await get_job_manifest(labels_job, db), CLUSTER_LABELS_FILE) if labels_job else None
+        if not entry:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Job {labels_job_id} has no cluster labels"
+            )
+        parameters['labels_sha256'] = entry['sha256']
+
+    return parameters
+
+async def get_user_files(file_ids: List[str], user_id: int, db: AsyncSession) -> dict:
+    """get_user_file for many ids in one query; returns id -> file for those found"""
+    from app.models.upload import UploadedFile, UploadStatus
+
+    files = await db.scalars(select(UploadedFile).where(
+        UploadedFile.id.in_(set(file_ids)),
+        UploadedFile.user_id == user_id,
+        UploadedFile.status == UploadStatus.COMPLETED
+    ))
+    return {input_file.id: input_file for input_file in files}
+
+async def get_user_file(file_id: str, user_id: int, db: AsyncSession):
+    """Get file by ID if it belongs to user"""
+    from app.models.upload import UploadedFile, UploadStatus
 
-def get_db():
-    """Get database session (placeholder)"""
-    pass
\ No newline at end of file
+    # Only fully uploaded (and checksummed) files can be analysed
+    return await db.scalar(select(UploadedFile).where(
+        UploadedFile.id == file_id,
+        UploadedFile.user_id == user_id,
+        UploadedFile.status == UploadStatus.COMPLETED
+    ))
\ No newline at end of file
@@ -5,6 +5,8 @@ from sqlalchemy.orm import Session
 from datetime import timedelta
 import os
 
+from app.core.metrics import install as install_metrics
+
 app = FastAPI(title="Single Cell RNA Analysis Platform")
 
 # CORS middleware for React frontend
@@ -14,8 +16,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Log-Offset", "X-Log-Size"],  # job listing pagination, log polling
 )
 
+# Request latency histograms and the /metrics endpoint (see app.core.metrics)
+install_metrics(app)
+
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
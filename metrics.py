@@ -0,0 +1,172 @@
+from typing import Dict
+import asyncio
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily
+
+# Histograms observed by Celery workers are accumulated in Redis (cumulative bucket
+# counts, sum and count per label set) and exposed by the API's /metrics, so one scrape
+# target covers the workers too. Name -> (help, label names, bucket upper bounds).
+WORKER_HISTOGRAMS = {
+    'job_queue_wait_seconds': (
+        'Time from dispatch until a worker started the job',
+        ('queue',), (1, 5, 15, 60, 300, 900, 3600, 4 * 3600),
+    ),
+    'job_duration_seconds': (
+        'Wall time of finished jobs',
+        ('job_type', 'size_class', 'status'), (10, 30, 60, 300, 900, 1800, 3600, 4 * 3600),
+    ),
+    'job_stage_duration_seconds': (
+        'Wall time of pipeline stages that ran (not reused)',
+        ('stage',), (1, 5, 15, 60, 300, 900, 3600),
+    ),
+}
+METRICS_KEY_PREFIX = 'metrics:'
+
+# Redis keys of a priority queue (see broker_transport_options in app.tasks.analysis):
+# the queue name for priority 0, and name + separator + step for the others
+PRIORITY_SEPARATOR = '\x06\x16'
+PRIORITY_STEPS = range(10)
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'API request latency',
+    ('method', 'route', 'status'),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+def observe(name: str, value: float, **labels):
+    """Add an observation to a worker histogram; metrics never fail a job"""
+    from app.core.redis_client import get_redis
+
+    _, label_names, buckets = WORKER_HISTOGRAMS[name]
+    label_key = '|'.join(str(labels.get(label, '')) for label in label_names)
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        key = METRICS_KEY_PREFIX + name
+        for bound in buckets:
+            if value <= bound:
+                pipe.hincrby(key, f"{label_key}#{bound}", 1)
+        pipe.hincrby(key, f"{label_key}#count", 1)
+        pipe.hincrbyfloat(key, f"{label_key}#sum", value)
+        pipe.execute()
+    except Exception:
+        pass
+
+class WorkerHistogramCollector:
+    """Worker histograms, read from Redis at scrape time"""
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        from app.core.redis_client import get_redis
+
+        for name, (help_text, label_names, buckets) in WORKER_HISTOGRAMS.items():
+            family = HistogramMetricFamily(name, help_text, labels=label_names)
+            try:
+                fields = get_redis().hgetall(METRICS_KEY_PREFIX + name)
+            except Exception:
+                fields = {}
+
+            series: Dict[str, Dict[str, float]] = {}
+            for field, value in fields.items():
+                label_key, _, part = field.decode().rpartition('#')
+                series.setdefault(label_key, {})[part] = float(value)
+            for label_key, values in series.items():
+                family.add_metric(
+                    label_key.split('|'),
+                    [(str(bound), values.get(str(bound), 0)) for bound in buckets] + [('+Inf', values.get('count', 0))],
+                    values.get('sum', 0)
+                )
+            yield family
+
+class QueueDepthCollector:
+    """Tasks waiting in each size-class queue"""
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        from app.core.redis_client import get_redis
+        from app.core.scheduler import SIZE_CLASSES
+
+        family = GaugeMetricFamily('celery_queue_depth', 'Tasks waiting per queue', labels=('queue',))
+        queues = [queue for queue, _ in SIZE_CLASSES]
+        try:
+            pipe = get_redis().pipeline(transaction=False)
+            for queue in queues:
+                for step in PRIORITY_STEPS:
+                    pipe.llen(queue if step == 0 else f"{queue}{PRIORITY_SEPARATOR}{step}")
+            lengths = pipe.execute()
+        except Exception:
+            return
+        for index, queue in enumerate(queues):
+            family.add_metric([queue], sum(lengths[index * len(PRIORITY_STEPS):(index + 1) * len(PRIORITY_STEPS)]))
+        yield family
+
+class DatabasePoolCollector:
+    """Connections of this API process's pool: in use, idle, overflow and saturation"""
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        from app.core.database import engine, DB_POOL_SIZE, DB_MAX_OVERFLOW
+
+        pool = engine.sync_engine.pool
+        connections = GaugeMetricFamily('db_pool_connections', 'Pool connections by state', labels=('state',))
+        connections.add_metric(['checked_out'], pool.checkedout())
+        connections.add_metric(['idle'], pool.checkedin())
+        connections.add_metric(['overflow'], max(pool.overflow(), 0))
+        yield connections
+        yield GaugeMetricFamily(
+            'db_pool_saturation', 'Share of the pool limit (size + max overflow) in use',
+            value=pool.checkedout() / (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+        )
+
+def scrape_registry() -> CollectorRegistry:
+    """
+    The registry /metrics serves. With several API worker processes, set
+    PROMETHEUS_MULTIPROC_DIR so request latency is aggregated across them.
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    # The collectors describe nothing, so register() does not call collect() to learn
+    # their names: startup neither queries Redis nor touches the database pool
+    for collector in (WorkerHistogramCollector(), QueueDepthCollector(), DatabasePoolCollector()):
+        registry.register(collector)
+    return registry
+
+def install(app):
+    """Time every request and serve /metrics"""
+    from fastapi import Response
+
+    registry = scrape_registry()
+
+    @app.middleware("http")
+    async def time_request(request, call_next):
+        started = time.perf_counter()
+        status_code = 500
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            return response
+        finally:
+            # Route templates keep the label set small (/api/jobs/{job_id}, not each id)
+            route = request.scope.get('route')
+            REQUEST_LATENCY.labels(
+                request.method, route.path if route else 'unmatched', str(status_code)
+            ).observe(time.perf_counter() - started)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        # Collectors query Redis synchronously; keep that off the event loop
+        body = await asyncio.to_thread(generate_latest, registry)
+        return Response(body, media_type=CONTENT_TYPE_LATEST)
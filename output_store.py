@@ -0,0 +1,157 @@
+from typing import Optional
+import gzip
+import lzma
+import os
+import shutil
+import time
+import uuid
+
+from app.core.job_outputs import OUTPUT_ROOT, READ_SIZE, open_stored, stored_name
+
+# Content-addressed blobs shared by all job outputs: <BLOB_DIR>/<sha[:2]>/<sha>.<encoding>.
+# Output files are hard links to their blob, so identical files take space once, and a
+# blob whose only link is the store's own is garbage.
+BLOB_DIR = os.getenv('OUTPUT_BLOB_DIR', os.path.join(OUTPUT_ROOT, 'blobs'))
+
+# Files from COMPRESS_MIN_BYTES up to COMPRESS_MAX_BYTES are compressed unless already
+# compressed or the gain is under MIN_COMPRESSION_GAIN; smaller ones are only deduplicated,
+# and tiny ones left alone. Larger ones are stored as-is: they are the downloads that get
+# resumed with Range, and only uncompressed files can be seeked cheaply and sent by
+# nginx with sendfile
+COMPRESS_MIN_BYTES = int(os.getenv('OUTPUT_COMPRESS_MIN_BYTES', 1024 * 1024))
+COMPRESS_MAX_BYTES = int(os.getenv('OUTPUT_COMPRESS_MAX_BYTES', 64 * 1024 * 1024))
+DEDUP_MIN_BYTES = 64 * 1024
+MIN_COMPRESSION_GAIN = 0.1
+PRECOMPRESSED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.pdf', '.gz', '.bz2', '.xz', '.zst', '.zip', '.h5ad'}
+
+# New outputs get a fast codec that HTTP clients accept as-is (Content-Encoding: gzip);
+# outputs older than COLD_AFTER_DAYS are recompressed with the slower, denser xz
+HOT_CODEC = 'gzip'
+COLD_CODEC = 'xz'
+COLD_AFTER_DAYS = int(os.getenv('OUTPUT_COLD_AFTER_DAYS', 30))
+
+# Days a finished job's outputs are kept, per subscription tier (None: forever)
+RETENTION_DAYS = {'free': 30, 'basic': 90, 'pro': 365, 'enterprise': None}
+
+# Unreferenced blobs are removed once their last link change is this old, so a blob
+# being linked into a job's outputs is never collected underneath it
+BLOB_GRACE_SECONDS = 3600
+
+CODECS = {
+    'identity': lambda path: open(path, 'wb'),
+    'gzip': lambda path: gzip.open(path, 'wb', compresslevel=1),
+    'xz': lambda path: lzma.open(path, 'wb', preset=6),
+}
+
+def blob_path(sha256: str, encoding: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], f"{sha256}.{encoding}")
+
+def is_compressible(entry: dict) -> bool:
+    extension = os.path.splitext(entry['name'])[1].lower()
+    return COMPRESS_MIN_BYTES <= entry['size'] <= COMPRESS_MAX_BYTES and extension not in PRECOMPRESSED_EXTENSIONS
+
+def store_outputs(output_dir: str, manifest: dict, codec: str = HOT_CODEC) -> dict:
+    """
+    Compress (with codec) and deduplicate a job's output files in place: each one becomes
+    a hard link to its blob, named as stored_name() gives. Files that should not be
+    compressed (any more) are stored uncompressed. Entries gain 'encoding' and
+    'stored_size' and the manifest its total 'stored_size'. Returns the manifest.
+    """
+    names = {entry['name'] for entry in manifest['files']}
+    for entry in manifest['files']:
+        entry.setdefault('encoding', 'identity')
+        if entry['size'] >= DEDUP_MIN_BYTES:
+            encoding = codec if is_compressible(entry) else 'identity'
+            # A compressed copy must not take the name of another output (a.csv.gz next to a.csv)
+            if encoding != 'identity' and stored_name({**entry, 'encoding': encoding}) in names:
+                encoding = 'identity'
+            _link_to_blob(output_dir, entry, encoding)
+        entry['stored_size'] = os.path.getsize(os.path.join(output_dir, stored_name(entry)))
+
+    manifest['stored_size'] = sum(entry['stored_size'] for entry in manifest['files'])
+    return manifest
+
+def _link_to_blob(output_dir: str, entry: dict, encoding: str):
+    """Replace an output file by a link to the blob of its content in encoding"""
+    path = os.path.join(output_dir, stored_name(entry))
+    if not _ensure_blob(path, entry, encoding):
+        # Does not compress well enough: share the file as it is
+        encoding = entry['encoding']
+        _ensure_blob(path, entry, encoding)
+
+    blob = blob_path(entry['sha256'], encoding)
+    target = os.path.join(output_dir, stored_name({**entry, 'encoding': encoding}))
+    try:
+        _link_into_place(blob, target)
+    except FileNotFoundError:
+        # Collected between the check and the link
+        _create_blob(path, entry, encoding)
+        _link_into_place(blob, target)
+
+    if target != path:
+        os.remove(path)
+    entry['encoding'] = encoding
+
+def _ensure_blob(path: str, entry: dict, encoding: str) -> bool:
+    return os.path.exists(blob_path(entry['sha256'], encoding)) or _create_blob(path, entry, encoding)
+
+def _create_blob(path: str, entry: dict, encoding: str) -> bool:
+    """Publish the file's content as a blob in encoding; False if compressing gains too little"""
+    blob = blob_path(entry['sha256'], encoding)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    if encoding == entry['encoding']:
+        # Same bytes: the output file itself becomes the blob
+        scratch = None
+        source = path
+    else:
+        scratch = f"{blob}.tmp-{uuid.uuid4().hex[:8]}"
+        with open_stored(path, entry['encoding']) as src, CODECS[encoding](scratch) as dst:
+            shutil.copyfileobj(src, dst, READ_SIZE)
+        if encoding != 'identity' and os.path.getsize(scratch) > entry['size'] * (1 - MIN_COMPRESSION_GAIN):
+            os.remove(scratch)
+            return False
+        source = scratch
+    try:
+        os.link(source, blob)
+    except FileExistsError:
+        # Stored concurrently by another job; the content is identical
+        pass
+    finally:
+        if scratch:
+            os.remove(scratch)
+    return True
+
+def _link_into_place(blob: str, target: str):
+    if os.path.exists(target) and os.path.samefile(blob, target):
+        return
+    scratch = f"{target}.tmp-{uuid.uuid4().hex[:8]}"
+    os.link(blob, scratch)
+    os.replace(scratch, target)
+
+def stored_size_mb(manifest: Optional[dict]) -> float:
+    """Space a job's outputs take after compression, from its manifest"""
+    if not manifest:
+        return 0.0
+    return manifest.get('stored_size', manifest.get('total_size', 0)) / (1024**2)
+
+def remove_outputs(output_dir: str):
+    """Delete a job's output directory; blobs only it used are collected later"""
+    if output_dir and os.path.isdir(output_dir):
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def collect_garbage() -> int:
+    """Remove blobs no output links to any more; returns the bytes freed"""
+    freed = 0
+    cutoff = time.time() - BLOB_GRACE_SECONDS
+    for root, _, filenames in os.walk(BLOB_DIR):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                info = os.stat(path)
+                # A hard link (or its removal) updates ctime
+                if info.st_nlink == 1 and info.st_ctime < cutoff:
+                    os.remove(path)
+                    freed += info.st_size
+            except OSError:
+                pass
+    return freed
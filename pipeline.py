@@ -0,0 +1,614 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+import hashlib
+import importlib.util
+import itertools
+import json
+import os
+import shutil
+import time
+import uuid
+
+from app.core.process_control import stop_job_processes
+from app.core.resource_usage import run_monitored
+from app.core.tracing import span, stage_environment
+from app.tasks.references import prepare_reference, reference_version
+from app.tasks.warm_pool import run_warm
+
+# Stage artifacts are shared across jobs and keyed by content, not job id
+STAGE_DIR = os.getenv('STAGE_DIR', '/data/stages')
+SCRIPTS_DIR = os.getenv('SCRIPTS_DIR', '/app/scripts')
+
+SUCCESS_MARKER = '_SUCCESS'
+
+# Stage artifacts no job has used for this long are evicted (see evict_stage_artifacts),
+# except those a running job has checkpointed. Must exceed the task time limit, since
+# a job reads its upstream artifacts until it publishes its outputs.
+STAGE_IDLE_DAYS = float(os.getenv('STAGE_IDLE_DAYS', 7))
+
+# Completed stage artifacts are hard-linked into <job output>/.checkpoints/<stage>/<key>
+# as the job runs, so a resumed job finds them even if the shared artifact was evicted.
+# Removed once the job's outputs are published.
+CHECKPOINT_DIR = '.checkpoints'
+
+# Stages are subprocesses, so sweep fan-out uses threads sized to the worker's cores
+SWEEP_MAX_WORKERS = int(os.getenv('SWEEP_MAX_WORKERS', os.cpu_count() or 1))
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    interpreter: str
+    script: str
+    upstream: Tuple[str, ...] = ()
+    defaults: Dict[str, object] = field(default_factory=dict)
+    # Parameter naming a reference atlas the stage reads (see app.tasks.references)
+    reference_param: Optional[str] = None
+    # Native engines run as `interpreter -m module` instead of a script
+    module: Optional[str] = None
+    # Stage whose outputs this one stands in for when publishing
+    provides: Optional[str] = None
+    # Parameters passed to the stage but left out of its key: they locate an input whose
+    # content is keyed by another parameter, and are resolved by the worker at run time
+    runtime_params: Tuple[str, ...] = ()
+
+    @property
+    def script_path(self) -> str:
+        if self.module:
+            return importlib.util.find_spec(self.module).origin
+        return os.path.join(SCRIPTS_DIR, self.script)
+
+# The first upstream stage is passed as --input, any others as --<name>_dir
+STAGES = {
+    stage.name: stage for stage in [
+        Stage('load', 'Rscript', 'stages/load.R'),
+        Stage('qc', 'Rscript', 'stages/qc.R', ('load',),
+              {'min_genes': 200, 'min_cells': 3, 'max_percent_mt': 20}),
+        Stage('normalize', 'Rscript', 'stages/normalize.R', ('qc',),
+              {'n_hvg': 2000}),
+        Stage('pca', 'Rscript', 'stages/pca.R', ('normalize',),
+              {'n_pcs': 50}),
+        Stage('neighbors', 'Rscript', 'stages/neighbors.R', ('pca',),
+              {'n_neighbors': 20}),
+        Stage('cluster', 'Rscript', 'stages/cluster.R', ('neighbors',),
+              {'resolution': 0.8}),
+        Stage('embed', 'Rscript', 'stages/embed.R', ('neighbors', 'cluster'),
+              {'umap_min_dist': 0.3}),
+        Stage('annotate', 'python', 'annotation.py', ('normalize',),
+              {'reference_dataset': 'default'}, reference_param='reference_dataset'),
+        Stage('de', 'Rscript', 'differential_expression.R', ('normalize',),
+              {'group1': [], 'group2': [], 'test_method': 'wilcoxon'}),
+        # Reads the ingested store and does its own QC and normalization
+        Stage('de_native', 'python', 'de_engine.py', (),
+              {'group1': [], 'group2': [], 'test_method': 'wilcoxon', 'labels_sha256': '',
+               'min_genes': 200, 'min_cells': 3, 'max_percent_mt': 20},
+              module='app.tasks.de_engine', provides='de', runtime_params=('labels_path',)),
+        Stage('cluster_native', 'python', 'cluster_engine.py', (),
+              {'min_genes': 200, 'min_cells': 3, 'max_percent_mt': 20, 'n_hvg': 2000, 'n_pcs': 50,
+               'n_neighbors': 20, 'resolution': 0.8},
+              module='app.tasks.cluster_engine', provides='cluster'),
+        Stage('embed_native', 'python', 'embed_engine.py', ('cluster_native',),
+              {'umap_min_dist': 0.3},
+              module='app.tasks.embed_engine', provides='embed'),
+        # Labels cells from the reference cached in this process (or a warm server)
+        Stage('annotate_native', 'python', 'annotate_engine.py', (),
+              {'reference_dataset': 'default', 'min_genes': 200, 'max_percent_mt': 20},
+              reference_param='reference_dataset', module='app.tasks.annotate_engine', provides='annotate'),
+    ]
+}
+
+# Stages per job type in execution order, and which of them are published to the job
+JOB_PIPELINES = {
+    'clustering': ['load', 'qc', 'normalize', 'pca', 'neighbors', 'cluster', 'embed'],
+    'annotation': ['load', 'qc', 'normalize', 'annotate'],
+    'differential_expression': ['load', 'qc', 'normalize', 'de'],
+}
+
+# Alternative stage lists selected by the 'engine' job parameter
+DEFAULT_ENGINE = 'r'
+ENGINE_PIPELINES = {
+    ('differential_expression', 'native'): ['de_native'],
+    ('clustering', 'native'): ['cluster_native', 'embed_native'],
+    ('annotation', 'native'): ['annotate_native'],
+}
+
+# Cluster assignments (cell,cluster) in a clustering job's outputs; used for one-vs-rest DE.
+# Jobs name them by labels_job_id and are keyed by their labels_sha256; the worker
+# resolves labels_path just before running
+CLUSTER_LABELS_FILE = os.path.join('cluster', 'clusters.csv')
+
+# Job parameters that only locate an input (its content is keyed separately), so they
+# never enter a cache key
+LOCATION_PARAMETERS = ('labels_job_id', 'labels_path')
+
+PUBLISHED_STAGES = {
+    'clustering': ['cluster', 'embed'],
+    'annotation': ['annotate'],
+    'differential_expression': ['de'],
+}
+
+# The stage whose summary.json becomes the job's summary.json
+SUMMARY_STAGE = {
+    'clustering': 'embed',
+    'annotation': 'annotate',
+    'differential_expression': 'de',
+}
+
+_script_versions = {}
+
+class StageFailed(Exception):
+    """Raised when a stage script exits non-zero"""
+
+    def __init__(self, stage: str, stderr: str, usage: Optional[dict] = None):
+        super().__init__(f"Stage '{stage}' failed: {stderr}")
+        self.stage = stage
+        self.stderr = stderr
+        self.usage = usage
+
+def get_pipeline(job_type: str, params: Optional[dict] = None) -> List[Stage]:
+    """Stages for a job type (and the engine chosen in params), in execution order"""
+    if job_type not in JOB_PIPELINES:
+        raise ValueError(f"Unknown job type: {job_type}")
+    engine = (params or {}).get('engine') or DEFAULT_ENGINE
+    if engine != DEFAULT_ENGINE and (job_type, engine) not in ENGINE_PIPELINES:
+        raise ValueError(f"Engine '{engine}' is not available for {job_type}")
+    names = ENGINE_PIPELINES.get((job_type, engine), JOB_PIPELINES[job_type])
+    return [STAGES[name] for name in names]
+
+def pipeline_defaults(job_type: str) -> dict:
+    """Default parameters consumed by a job type's stages"""
+    defaults = {}
+    for stage in get_pipeline(job_type):
+        defaults.update(stage.defaults)
+    return defaults
+
+def stage_parameters(stage: Stage, params: dict) -> dict:
+    """The subset of job parameters a stage depends on, with defaults"""
+    return {
+        name: params[name] if params.get(name) is not None else default
+        for name, default in stage.defaults.items()
+    }
+
+def script_version(path: str) -> str:
+    """SHA-256 of a script file, memoized by mtime"""
+    if not os.path.exists(path):
+        return 'unknown'
+
+    mtime = os.path.getmtime(path)
+    cached = _script_versions.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+
+    version = hasher.hexdigest()
+    _script_versions[path] = (mtime, version)
+    return version
+
+def pipeline_script_version(job_type: str, params: Optional[dict] = None) -> str:
+    """Combined version of every script a job type runs"""
+    versions = [f"{stage.name}:{script_version(stage.script_path)}" for stage in get_pipeline(job_type, params)]
+    return hashlib.sha256('\n'.join(versions).encode('utf-8')).hexdigest()
+
+def compute_stage_keys(job_type: str, input_sha256: str, params: dict) -> Dict[str, str]:
+    """Key every stage by its upstream keys, its own parameters and its script"""
+    keys = {}
+    for stage in get_pipeline(job_type, params):
+        upstream = [keys[name] for name in stage.upstream] if stage.upstream else [input_sha256]
+        stage_params = stage_parameters(stage, params)
+        key_fields = {
+            'stage': stage.name,
+            'upstream': upstream,
+            'params': stage_params,
+            'script': script_version(stage.script_path),
+        }
+        if stage.reference_param:
+            # An updated atlas invalidates annotations made against the old one
+            key_fields['reference'] = reference_version(stage_params[stage.reference_param])
+        payload = json.dumps(key_fields, sort_keys=True, separators=(',', ':'))
+        keys[stage.name] = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    return keys
+
+def stage_artifact_dir(stage_name: str, key: str) -> str:
+    """Where a stage's output for a given key lives"""
+    return os.path.join(STAGE_DIR, stage_name, key)
+
+def is_stage_complete(stage_name: str, key: str) -> bool:
+    """Whether a stage artifact has been fully written"""
+    return os.path.exists(os.path.join(stage_artifact_dir(stage_name, key), SUCCESS_MARKER))
+
+def touch_stage(stage_name: str, key: str) -> bool:
+    """Mark a complete stage artifact as used now, so eviction keeps it; False if there is none"""
+    try:
+        os.utime(os.path.join(stage_artifact_dir(stage_name, key), SUCCESS_MARKER))
+        return True
+    except FileNotFoundError:
+        return False
+
+def evict_stage_artifacts(referenced: Set[Tuple[str, str]]) -> int:
+    """
+    Remove stage artifacts (and abandoned scratch directories) unused for STAGE_IDLE_DAYS,
+    except the (stage, key) pairs in referenced. Job outputs keep their own hard links,
+    so this frees the intermediate stages and the uncompressed copies of outputs that
+    were stored compressed. Returns the bytes freed.
+    """
+    freed = 0
+    cutoff = time.time() - STAGE_IDLE_DAYS * 86400
+    for stage_name in (os.listdir(STAGE_DIR) if os.path.isdir(STAGE_DIR) else []):
+        stage_root = os.path.join(STAGE_DIR, stage_name)
+        if not os.path.isdir(stage_root):
+            continue
+        for name in os.listdir(stage_root):
+            path = os.path.join(stage_root, name)
+            if (stage_name, name) in referenced:
+                continue
+            try:
+                marker = os.path.join(path, SUCCESS_MARKER)
+                last_used = os.stat(marker if os.path.exists(marker) else path).st_mtime
+                if last_used >= cutoff:
+                    continue
+                # Renamed first, so no job can start reusing it while it is removed
+                doomed = f"{path}.evict-{uuid.uuid4().hex[:8]}"
+                os.rename(path, doomed)
+            except OSError:
+                continue
+            for root, _, filenames in os.walk(doomed):
+                for filename in filenames:
+                    try:
+                        info = os.lstat(os.path.join(root, filename))
+                    except OSError:
+                        continue
+                    # Files still linked from job outputs or blobs free nothing
+                    if info.st_nlink == 1:
+                        freed += info.st_size
+            shutil.rmtree(doomed, ignore_errors=True)
+    return freed
+
+def checkpoint_path(checkpoint_dir: str, stage_name: str, key: str) -> str:
+    return os.path.join(checkpoint_dir, stage_name, key)
+
+def has_checkpoint(checkpoint_dir: Optional[str], stage_name: str, key: str) -> bool:
+    return bool(checkpoint_dir) and os.path.exists(
+        os.path.join(checkpoint_path(checkpoint_dir, stage_name, key), SUCCESS_MARKER)
+    )
+
+def save_checkpoint(checkpoint_dir: str, stage_name: str, key: str):
+    """Hard-link a completed stage artifact into the job's checkpoints (once)"""
+    if has_checkpoint(checkpoint_dir, stage_name, key):
+        return
+    _link_tree(stage_artifact_dir(stage_name, key), checkpoint_path(checkpoint_dir, stage_name, key))
+
+def restore_checkpoint(checkpoint_dir: Optional[str], stage_name: str, key: str) -> bool:
+    """Put a checkpointed artifact back in the shared stage store; False if there is none"""
+    if not has_checkpoint(checkpoint_dir, stage_name, key):
+        return False
+    os.makedirs(os.path.join(STAGE_DIR, stage_name), exist_ok=True)
+    _link_tree(checkpoint_path(checkpoint_dir, stage_name, key), stage_artifact_dir(stage_name, key))
+    return touch_stage(stage_name, key)
+
+def _link_tree(source: str, target: str):
+    """Hard-link a complete directory into place via a scratch copy and an atomic rename"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    scratch_dir = f"{target}.tmp-{uuid.uuid4().hex[:8]}"
+    try:
+        shutil.copytree(source, scratch_dir, copy_function=os.link)
+        try:
+            os.rename(scratch_dir, target)
+        except OSError:
+            # Linked concurrently (or already there); the other copy is identical
+            if not os.path.exists(os.path.join(target, SUCCESS_MARKER)):
+                raise
+    finally:
+        if os.path.exists(scratch_dir):
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def build_stage_command(stage: Stage, input_path: str, upstream_dirs: Dict[str, str],
+                        output_dir: str, params: dict, reference_dir: Optional[str] = None) -> List[str]:
+    """Command line for running one stage"""
+    entry = ['-m', stage.module] if stage.module else [stage.script_path]
+    cmd = [stage.interpreter] + entry + ['--input', input_path, '--output', output_dir]
+
+    if reference_dir:
+        cmd += ['--reference_dir', reference_dir]
+
+    # Entry stages read either the raw upload or its ingested store (see app.tasks.ingest)
+    if not stage.upstream and os.path.isdir(input_path):
+        cmd += ['--input_format', 'sparse_store']
+
+    for name in stage.upstream[1:]:
+        cmd += [f'--{name}_dir', upstream_dirs[name]]
+
+    for name, value in stage_parameters(stage, params).items():
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(v) for v in value)
+        cmd += [f'--{name}', str(value)]
+
+    for name in stage.runtime_params:
+        if params.get(name):
+            cmd += [f'--{name}', str(params[name])]
+
+    return cmd
+
+def run_stage(stage: Stage, key: str, input_path: str, upstream_dirs: Dict[str, str], params: dict,
+              stage_usage: Optional[list] = None, on_output=None) -> str:
+    """
+    Run a stage into a scratch directory and atomically publish it under its key.
+    The run's resource usage is appended to stage_usage, including for failed runs,
+    and each output line is passed to on_output(stage_name, stream, line) as it arrives.
+    The run is a span of the job's trace, which the stage process joins via TRACEPARENT.
+    """
+    final_dir = stage_artifact_dir(stage.name, key)
+    scratch_dir = f"{final_dir}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(scratch_dir)
+
+    with span(f"stage.{stage.name}", key=key) as attributes:
+        _run_stage(stage, key, input_path, upstream_dirs, params, stage_usage, on_output,
+                   final_dir, scratch_dir, attributes)
+    return final_dir
+
+def _run_stage(stage: Stage, key: str, input_path: str, upstream_dirs: Dict[str, str], params: dict,
+               stage_usage: Optional[list], on_output, final_dir: str, scratch_dir: str, attributes: dict):
+    try:
+        # Reference atlases are prepared once and shared; the stage gets the prepared copy
+        references = []
+        reference_dir = None
+        if stage.reference_param:
+            references.append(stage_parameters(stage, params)[stage.reference_param])
+            reference_dir = prepare_reference(references[0])
+
+        cmd = build_stage_command(stage, input_path, upstream_dirs, scratch_dir, params, reference_dir)
+        started = time.monotonic()
+
+        def on_line(stream: str, line: str):
+            # Time to first output approximates the script's startup cost
+            attributes.setdefault('first_output_seconds', round(time.monotonic() - started, 3))
+            if on_output:
+                on_output(stage.name, stream, line)
+
+        # Python stages run on a pre-imported warm server when one is free
+        env = stage_environment()
+        outcome = run_warm(cmd, references, on_line, env)
+        attributes['warm'] = outcome is not None
+        returncode, _, stderr, usage = outcome or run_monitored(cmd, on_line, env)
+        attributes.update(returncode=returncode, cpu_seconds=usage.cpu_seconds, peak_rss_mb=usage.peak_rss_mb)
+
+        if stage_usage is not None:
+            # Start times let the job's peak add up stages that ran concurrently
+            stage_usage.append({'stage': stage.name, 'key': key, 'started': started, 'usage': usage.to_dict()})
+
+        if returncode != 0:
+            raise StageFailed(stage.name, stderr, usage.to_dict())
+
+        open(os.path.join(scratch_dir, SUCCESS_MARKER), 'w').close()
+
+        try:
+            os.rename(scratch_dir, final_dir)
+        except OSError:
+            # Another job published the same artifact first; theirs is equivalent
+            if not is_stage_complete(stage.name, key):
+                raise
+    finally:
+        if os.path.exists(scratch_dir):
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def run_pipeline(job_type: str, input_path: str, input_sha256: Optional[str], params: dict,
+                 output_dir: str, on_stage=None, stage_usage: Optional[list] = None, on_output=None,
+                 on_checkpoint=None) -> dict:
+    """
+    Run a job type's stages, reusing any stage whose key already has an artifact or a
+    checkpoint in output_dir (so a rerun of an interrupted job resumes where it stopped).
+    on_stage(stage_name, index, total, reused) is called before each stage,
+    on_checkpoint(stage_name, key) after each is checkpointed, the usage of every stage
+    actually run is appended to stage_usage, and stage output lines go to on_output
+    (see run_stage).
+    Returns the parsed summary.json of the job's summary stage.
+    """
+    stages = get_pipeline(job_type, params)
+    keys = compute_stage_keys(job_type, input_sha256 or _fallback_input_key(input_path), params)
+    checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIR)
+    stage_dirs = {}
+    stage_log = []
+
+    for index, stage in enumerate(stages):
+        key = keys[stage.name]
+        reused = is_stage_complete(stage.name, key) or has_checkpoint(checkpoint_dir, stage.name, key)
+
+        if on_stage:
+            on_stage(stage.name, index, len(stages), reused)
+
+        stage_dirs[stage.name] = ensure_stage(
+            stage, key, input_path, stage_dirs, params, stage_usage, on_output, checkpoint_dir, on_checkpoint
+        )
+        stage_log.append({'stage': stage.name, 'key': key, 'reused': reused})
+
+    summary = finish_outputs(job_type, stage_dirs, stage_log, output_dir)
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    return summary
+
+def ensure_stage(stage: Stage, key: str, input_path: str, stage_dirs: Dict[str, str], params: dict,
+                 stage_usage: Optional[list] = None, on_output=None, checkpoint_dir: Optional[str] = None,
+                 on_checkpoint=None) -> str:
+    """
+    Artifact directory for a stage key, running the stage only if neither the artifact
+    nor a checkpoint of it exists. With checkpoint_dir the artifact is checkpointed there.
+    """
+    if not touch_stage(stage.name, key) and not restore_checkpoint(checkpoint_dir, stage.name, key):
+        os.makedirs(os.path.join(STAGE_DIR, stage.name), exist_ok=True)
+        stage_input = stage_dirs[stage.upstream[0]] if stage.upstream else input_path
+        run_stage(stage, key, stage_input, stage_dirs, params, stage_usage, on_output)
+
+    if checkpoint_dir:
+        save_checkpoint(checkpoint_dir, stage.name, key)
+        if on_checkpoint:
+            on_checkpoint(stage.name, key)
+    return stage_artifact_dir(stage.name, key)
+
+def finish_outputs(job_type: str, stage_dirs: Dict[str, str], stage_log: List[dict], output_dir: str) -> dict:
+    """Publish a run's outputs and stage log into output_dir and return its summary"""
+    os.makedirs(output_dir, exist_ok=True)
+    publish_outputs(job_type, stage_dirs, output_dir)
+
+    with open(os.path.join(output_dir, 'stages.json'), 'w') as f:
+        json.dump(stage_log, f, indent=2)
+
+    summary_file = os.path.join(output_dir, 'summary.json')
+    if os.path.exists(summary_file):
+        with open(summary_file, 'r') as f:
+            return json.load(f)
+
+    return {
+        "message": "Analysis completed but summary not found",
+        "stages": stage_log
+    }
+
+def run_sweep(job_type: str, input_path: str, input_sha256: Optional[str], points: List[dict],
+              output_dir: str, on_point=None, max_workers: Optional[int] = None,
+              stage_usage: Optional[list] = None, on_output=None, on_checkpoint=None) -> List[dict]:
+    """
+    Run a job type at several parameter points, computing each distinct stage key once.
+    Stages shared by all points (load, qc, normalize, ...) run a single time and the
+    point-specific stages fan out over a thread pool. Each point's outputs are published
+    to output_dir/point_<i>. on_point(index, result) is called as each point finishes,
+    the usage of every stage run is appended to stage_usage, and output lines and
+    checkpoints are reported as in run_pipeline (all from pool threads).
+    Returns one result per point: {'index', 'parameters', 'status', 'summary' | 'error'}.
+    """
+    # The engine is fixed across a sweep (it is not a sweepable parameter)
+    stages = get_pipeline(job_type, points[0] if points else None)
+    input_key = input_sha256 or _fallback_input_key(input_path)
+    point_keys = [compute_stage_keys(job_type, input_key, params) for params in points]
+    checkpoint_dir = os.path.join(output_dir, CHECKPOINT_DIR)
+    results = [None] * len(points)
+
+    with ThreadPoolExecutor(max_workers=max_workers or SWEEP_MAX_WORKERS) as pool:
+        # Submitted in DAG order, so every upstream future is started before its dependents
+        stage_futures = {}
+        for stage in stages:
+            for params, keys in zip(points, point_keys):
+                key = keys[stage.name]
+                if (stage.name, key) in stage_futures:
+                    continue
+                upstream = {name: stage_futures[(name, keys[name])] for name in stage.upstream}
+                stage_futures[(stage.name, key)] = pool.submit(
+                    _run_stage_after, stage, key, input_path, upstream, params, stage_usage, on_output,
+                    checkpoint_dir, on_checkpoint
+                )
+
+        point_futures = {
+            pool.submit(
+                _finish_point, job_type,
+                {stage.name: stage_futures[(stage.name, keys[stage.name])] for stage in stages},
+                keys, os.path.join(output_dir, f"point_{index}")
+            ): index
+            for index, keys in enumerate(point_keys)
+        }
+
+        try:
+            for future in as_completed(point_futures):
+                index = point_futures[future]
+                result = {'index': index, 'parameters': points[index]}
+                try:
+                    result.update(status='completed', summary=future.result())
+                except Exception as e:
+                    result.update(status='failed', error=str(e))
+
+                results[index] = result
+                if on_point:
+                    on_point(index, result)
+        except BaseException:
+            # Cancelled or timed out: drop queued stages and stop running ones, or
+            # leaving the pool would wait for every stage to finish
+            pool.shutdown(wait=False, cancel_futures=True)
+            stop_job_processes()
+            raise
+
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    return results
+
+def expand_sweep(parameters: dict, sweep: Dict[str, list]) -> List[dict]:
+    """Grid of parameter points: every combination of the sweep values over the fixed parameters"""
+    names = sorted(sweep)
+    points = []
+    for values in itertools.product(*(sweep[name] for name in names)):
+        point = dict(parameters or {})
+        point.update(zip(names, values))
+        points.append(point)
+    return points
+
+def summarize_sweep(sweep: Dict[str, list], results: List[Optional[dict]]) -> dict:
+    """Comparison table of a sweep: swept values and scalar summary fields per point"""
+    rows = []
+    for result in results:
+        if result is None:
+            continue
+        row = {name: result['parameters'].get(name) for name in sorted(sweep)}
+        row.update(index=result['index'], status=result['status'])
+        if result['status'] == 'completed':
+            row.update({
+                name: value for name, value in (result.get('summary') or {}).items()
+                if isinstance(value, (int, float, str, bool)) and name not in row
+            })
+        else:
+            row['error'] = result.get('error')
+        rows.append(row)
+
+    return {
+        'swept_parameters': sorted(sweep),
+        'total_points': len(results),
+        'completed_points': sum(1 for r in results if r and r['status'] == 'completed'),
+        'failed_points': sum(1 for r in results if r and r['status'] == 'failed'),
+        'points': sorted(rows, key=lambda row: row['index']),
+    }
+
+def _run_stage_after(stage: Stage, key: str, input_path: str, upstream: Dict[str, object], params: dict,
+                     stage_usage: Optional[list], on_output=None, checkpoint_dir: Optional[str] = None,
+                     on_checkpoint=None) -> str:
+    """Wait for upstream stage futures, then ensure this stage's artifact"""
+    stage_dirs = {name: future.result() for name, future in upstream.items()}
+    return ensure_stage(stage, key, input_path, stage_dirs, params, stage_usage, on_output, checkpoint_dir, on_checkpoint)
+
+def _finish_point(job_type: str, stage_futures: Dict[str, object], keys: Dict[str, str], output_dir: str) -> dict:
+    """Publish one sweep point once all of its stages are available"""
+    stage_dirs = {name: future.result() for name, future in stage_futures.items()}
+    stage_log = [{'stage': name, 'key': keys[name]} for name in stage_dirs]
+    return finish_outputs(job_type, stage_dirs, stage_log, output_dir)
+
+def publish_outputs(job_type: str, stage_dirs: Dict[str, str], output_dir: str):
+    """Hard-link the job's published stage artifacts into its output directory"""
+    # Engine stages publish under the name of the stage they replace
+    published_dirs = dict(stage_dirs)
+    for name, path in stage_dirs.items():
+        if STAGES[name].provides:
+            published_dirs[STAGES[name].provides] = path
+
+    for name in PUBLISHED_STAGES[job_type]:
+        target = os.path.join(output_dir, name)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        # Hard links keep the job's results alive when the stage artifact is evicted
+        shutil.copytree(published_dirs[name], target, copy_function=os.link,
+                        ignore=shutil.ignore_patterns(SUCCESS_MARKER))
+
+    summary_src = os.path.join(published_dirs[SUMMARY_STAGE[job_type]], 'summary.json')
+    if os.path.exists(summary_src):
+        shutil.copyfile(summary_src, os.path.join(output_dir, 'summary.json'))
+
+def input_dimensions(input_path: str, input_sha256: Optional[str]) -> dict:
+    """Cell and gene counts reported by the load stage's summary.json, if it has run"""
+    # load has no parameters, so its key depends only on the input
+    key = compute_stage_keys('clustering', input_sha256 or _fallback_input_key(input_path), {})['load']
+    summary_file = os.path.join(stage_artifact_dir('load', key), 'summary.json')
+    try:
+        with open(summary_file, 'r') as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {name: summary[name] for name in ('n_cells', 'n_genes') if name in summary}
+
+def _fallback_input_key(input_path: str) -> str:
+    """Key inputs with no recorded content hash by path, size and mtime"""
+    stat = os.stat(input_path)
+    return hashlib.sha256(f"{input_path}:{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()
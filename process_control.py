@@ -0,0 +1,107 @@
+from typing import Dict, Optional
+import os
+import signal
+import threading
+import time
+
+# Stage processes get SIGTERM first and SIGKILL if still alive after this long
+TERMINATE_GRACE_SECONDS = float(os.getenv('TERMINATE_GRACE_SECONDS', 10))
+
+# After SIGKILL, how long to wait for the kernel to tear the processes down
+KILL_WAIT_SECONDS = 5
+
+POLL_SECONDS = 0.1
+
+# Process groups (stage subprocesses, busy warm servers) running for this worker
+# process's current job; a worker process runs one job at a time
+_groups: Dict[int, int] = {}
+_lock = threading.Lock()
+_stopping = threading.Event()
+
+class JobStopped(Exception):
+    """Raised instead of starting a stage once the job's processes are being stopped"""
+
+def register_group(pgid: int):
+    """
+    Track a process group started for the current job. A group started after
+    stop_job_processes() began is killed at once and JobStopped is raised.
+    """
+    with _lock:
+        if not _stopping.is_set():
+            _groups[pgid] = _groups.get(pgid, 0) + 1
+            return
+    _signal_group(pgid, signal.SIGKILL)
+    raise JobStopped("Job is being stopped")
+
+def unregister_group(pgid: int):
+    with _lock:
+        count = _groups.pop(pgid, 0) - 1
+        if count > 0:
+            _groups[pgid] = count
+
+def check_not_stopping():
+    if _stopping.is_set():
+        raise JobStopped("Job is being stopped")
+
+def reset_job_processes():
+    """Called as a job starts; groups of an earlier job are already gone"""
+    with _lock:
+        _groups.clear()
+        _stopping.clear()
+
+def stop_job_processes(grace: Optional[float] = None) -> float:
+    """
+    Terminate every tracked process group (SIGTERM, then SIGKILL after grace) and stop
+    new ones from starting. Returns the seconds until all of them were gone.
+    The threads running them still reap their own children.
+    """
+    started = time.monotonic()
+    with _lock:
+        _stopping.set()
+        groups = list(_groups)
+
+    for pgid in groups:
+        _signal_group(pgid, signal.SIGTERM)
+    deadline = started + (TERMINATE_GRACE_SECONDS if grace is None else grace)
+    for pgid in groups:
+        if not _wait_group(pgid, deadline - time.monotonic(), reap=False):
+            _signal_group(pgid, signal.SIGKILL)
+    for pgid in groups:
+        _wait_group(pgid, KILL_WAIT_SECONDS, reap=False)
+    return time.monotonic() - started
+
+def terminate_group(pgid: int, grace: Optional[float] = None) -> bool:
+    """
+    SIGTERM a process group led by our child, SIGKILL it after grace, and reap the
+    leader. True once the whole group has exited.
+    """
+    _signal_group(pgid, signal.SIGTERM)
+    if _wait_group(pgid, TERMINATE_GRACE_SECONDS if grace is None else grace):
+        return True
+    _signal_group(pgid, signal.SIGKILL)
+    return _wait_group(pgid, KILL_WAIT_SECONDS)
+
+def _signal_group(pgid: int, sig: int):
+    try:
+        os.killpg(pgid, sig)
+    except OSError:
+        pass
+
+def _wait_group(pgid: int, timeout: float, reap: bool = True) -> bool:
+    deadline = time.monotonic() + timeout
+    while True:
+        # An unreaped leader keeps the group alive
+        if reap:
+            try:
+                os.waitpid(pgid, os.WNOHANG)
+            except ChildProcessError:
+                pass
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_SECONDS)
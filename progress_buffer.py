@@ -0,0 +1,61 @@
+from datetime import datetime
+import os
+import threading
+
+# How often buffered progress (and the job heartbeat) is written to Postgres
+PROGRESS_FLUSH_SECONDS = float(os.getenv('PROGRESS_FLUSH_SECONDS', 30))
+
+class ProgressBuffer:
+    """
+    Write-behind buffer for one running job's progress columns.
+    Updates are coalesced in memory and written as a single UPDATE on a timer,
+    which also refreshes heartbeat_at. Call stop() before a state transition
+    so the final values land before the transition commits.
+    """
+
+    def __init__(self, engine, job_id: int, interval: float = PROGRESS_FLUSH_SECONDS):
+        self.engine = engine
+        self.job_id = job_id
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def update(self, **fields):
+        with self._lock:
+            self._pending.update(fields)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"progress-{self.job_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self, flush: bool = True):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Write pending fields plus a heartbeat in one statement"""
+        from sqlalchemy import update
+        from app.models.job import AnalysisJob
+
+        with self._lock:
+            fields, self._pending = self._pending, {}
+        fields['heartbeat_at'] = datetime.utcnow()
+
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(update(AnalysisJob).where(AnalysisJob.id == self.job_id).values(**fields))
+        except Exception:
+            # Keep the values for the next flush unless newer ones arrived meanwhile
+            with self._lock:
+                for name, value in fields.items():
+                    self._pending.setdefault(name, value)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
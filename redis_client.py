@@ -0,0 +1,25 @@
+import os
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+_redis = None
+_async_redis = None
+
+def get_redis():
+    """
+    Redis client shared by everything in this process (caches, reservations, job
+    events); its connection pool reconnects by itself in forked children
+    """
+    global _redis
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(REDIS_URL)
+    return _redis
+
+def get_async_redis():
+    """asyncio Redis client shared by the API's requests and event streams"""
+    global _async_redis
+    if _async_redis is None:
+        import redis.asyncio
+        _async_redis = redis.asyncio.Redis.from_url(REDIS_URL)
+    return _async_redis
@@ -0,0 +1,361 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional, Tuple
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+from app.tasks.ingest import open_store
+
+# Source atlases: <REFERENCE_DIR>/<name>/store (an ingested sparse store) and
+# <REFERENCE_DIR>/<name>/labels.txt[.gz] (one cell type per store cell)
+REFERENCE_DIR = os.getenv('REFERENCE_DIR', '/data/references')
+
+# Prepared references: <REFERENCE_CACHE_DIR>/<name>/<version>/
+REFERENCE_CACHE_DIR = os.getenv('REFERENCE_CACHE_DIR', '/data/references/.prepared')
+
+# Prepared references kept open per process. The arrays are memory-mapped, so every
+# process on a node shares one copy through the page cache.
+REFERENCE_CACHE_SIZE = int(os.getenv('REFERENCE_CACHE_SIZE', 4))
+
+MARKERS_PER_TYPE = 50
+N_PCS = 30
+PCA_SAMPLE_CELLS = 50000
+PROJECT_BLOCK_CELLS = 10000
+TARGET_SUM = 1e4
+
+# Inverted-file kNN index: cells are bucketed by their nearest coarse centroid
+IVF_MAX_LISTS = 1024
+KMEANS_SAMPLE_CELLS = 20000
+KMEANS_ITERATIONS = 10
+
+META_FILE = 'meta.json'
+SUCCESS_MARKER = '_SUCCESS'
+
+_cache: 'OrderedDict[Tuple[str, str], Reference]' = OrderedDict()
+_cache_lock = threading.Lock()
+_versions = {}
+
+def reference_source_dir(name: str) -> str:
+    if not name or os.path.basename(name) != name or name.startswith('.'):
+        raise ValueError(f"Invalid reference dataset: {name!r}")
+    return os.path.join(REFERENCE_DIR, name)
+
+def reference_exists(name: str) -> bool:
+    try:
+        return os.path.isdir(os.path.join(reference_source_dir(name), 'store'))
+    except ValueError:
+        return False
+
+def list_references() -> List[str]:
+    if not os.path.isdir(REFERENCE_DIR):
+        return []
+    return sorted(name for name in os.listdir(REFERENCE_DIR) if reference_exists(name))
+
+def _labels_path(source_dir: str) -> str:
+    for filename in ('labels.txt.gz', 'labels.txt'):
+        path = os.path.join(source_dir, filename)
+        if os.path.exists(path):
+            return path
+    raise ValueError(f"Reference {os.path.basename(source_dir)} has no labels.txt")
+
+def reference_version(name: str) -> str:
+    """Content version of a source atlas, memoized by the mtimes of its inputs"""
+    source_dir = reference_source_dir(name)
+    if not reference_exists(name):
+        raise ValueError(f"Unknown reference dataset: {name}")
+
+    inputs = [os.path.join(source_dir, 'store', 'meta.json'), _labels_path(source_dir)]
+    stamp = tuple(os.path.getmtime(path) for path in inputs)
+    cached = _versions.get(name)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    hasher = hashlib.sha256()
+    for path in inputs:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+
+    version = hasher.hexdigest()[:16]
+    _versions[name] = (stamp, version)
+    return version
+
+def prepared_dir(name: str, version: str) -> str:
+    return os.path.join(REFERENCE_CACHE_DIR, name, version)
+
+def prepare_reference(name: str) -> str:
+    """
+    Directory of the prepared reference, building it first if needed.
+    Builds are serialized per reference with a file lock, so concurrent workers on a
+    node (or sharing the volume) prepare each version once.
+    """
+    version = reference_version(name)
+    final_dir = prepared_dir(name, version)
+    if os.path.exists(os.path.join(final_dir, SUCCESS_MARKER)):
+        return final_dir
+
+    os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+    with open(f"{final_dir}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(os.path.join(final_dir, SUCCESS_MARKER)):
+            return final_dir
+
+        scratch_dir = f"{final_dir}.tmp-{uuid.uuid4().hex[:8]}"
+        os.makedirs(scratch_dir)
+        try:
+            build_reference(name, version, scratch_dir)
+            open(os.path.join(scratch_dir, SUCCESS_MARKER), 'w').close()
+            if os.path.exists(final_dir):
+                shutil.rmtree(final_dir)
+            os.rename(scratch_dir, final_dir)
+        finally:
+            if os.path.exists(scratch_dir):
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return final_dir
+
+def _log_normalize(block):
+    """Library-size normalize and log1p a CSR block of cells"""
+    import numpy as np
+    import scipy.sparse as sp
+
+    totals = np.asarray(block.sum(axis=1)).ravel()
+    scale = np.divide(TARGET_SUM, totals, out=np.zeros_like(totals, dtype=np.float64), where=totals > 0)
+    normalized = sp.diags(scale) @ block.astype(np.float64)
+    normalized.data = np.log1p(normalized.data)
+    return normalized.tocsr()
+
+def build_reference(name: str, version: str, output_dir: str):
+    """Centroids, marker matrix, PCA projection and kNN index of one atlas"""
+    import numpy as np
+
+    source_dir = reference_source_dir(name)
+    store = open_store(os.path.join(source_dir, 'store'))
+    opener = gzip.open if _labels_path(source_dir).endswith('.gz') else open
+    with opener(_labels_path(source_dir), 'rt') as f:
+        labels = [line.rstrip('\n') for line in f]
+    if len(labels) != store.n_cells:
+        raise ValueError(f"Reference {name}: {len(labels)} labels for {store.n_cells} cells")
+
+    types = sorted(set(labels))
+    codes = np.searchsorted(np.array(types), np.array(labels)).astype(np.int32)
+
+    # Mean log-normalized expression per type, one block of cells at a time
+    sums = np.zeros((len(types), store.n_genes))
+    for start in range(0, store.n_cells, PROJECT_BLOCK_CELLS):
+        block = _log_normalize(store.cells(start, start + PROJECT_BLOCK_CELLS))
+        block_codes = codes[start:start + block.shape[0]]
+        for t in np.unique(block_codes):
+            sums[t] += np.asarray(block[block_codes == t].sum(axis=0)).ravel()
+    centroids = sums / np.bincount(codes, minlength=len(types))[:, None]
+
+    # Markers: genes most above the mean of the other types, z-scored across types
+    marker_set = set()
+    for t in range(len(types)):
+        others = (centroids.sum(axis=0) - centroids[t]) / max(len(types) - 1, 1)
+        score = centroids[t] - others
+        top = np.argsort(score)[::-1][:MARKERS_PER_TYPE]
+        marker_set.update(int(g) for g in top if score[g] > 0)
+    markers = np.array(sorted(marker_set), dtype=np.int64)
+    marker_centroids = centroids[:, markers]
+    std = marker_centroids.std(axis=0)
+    marker_matrix = (marker_centroids - marker_centroids.mean(axis=0)) / np.where(std > 0, std, 1)
+
+    # PCA on marker genes, fitted on a sample and applied to every cell
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(store.n_cells, min(store.n_cells, PCA_SAMPLE_CELLS), replace=False))
+    sample_rows = _sampled_rows(store, sample, markers)
+    pca_mean = sample_rows.mean(axis=0)
+    _, _, vt = np.linalg.svd(sample_rows - pca_mean, full_matrices=False)
+    components = vt[:min(N_PCS, vt.shape[0])].astype(np.float32)
+
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(output_dir, 'embeddings.npy'), mode='w+', dtype=np.float32,
+        shape=(store.n_cells, components.shape[0])
+    )
+    for start in range(0, store.n_cells, PROJECT_BLOCK_CELLS):
+        block = _log_normalize(store.cells(start, start + PROJECT_BLOCK_CELLS))[:, markers].toarray()
+        embeddings[start:start + block.shape[0]] = (block - pca_mean) @ components.T
+    embeddings.flush()
+
+    ivf_centroids, order, offsets = build_ivf_index(np.asarray(embeddings), rng)
+
+    gene_names = store.gene_names()
+    for filename, array in (
+        ('centroids.npy', centroids.astype(np.float32)),
+        ('marker_genes.npy', markers),
+        ('marker_matrix.npy', marker_matrix.astype(np.float32)),
+        ('pca_mean.npy', pca_mean.astype(np.float32)),
+        ('pca_components.npy', components),
+        ('cell_labels.npy', codes),
+        ('ivf_centroids.npy', ivf_centroids),
+        ('ivf_order.npy', order),
+        ('ivf_offsets.npy', offsets),
+    ):
+        np.save(os.path.join(output_dir, filename), array)
+
+    with gzip.open(os.path.join(output_dir, 'genes.txt.gz'), 'wt') as f:
+        f.writelines(f"{gene}\n" for gene in gene_names)
+
+    with open(os.path.join(output_dir, META_FILE), 'w') as f:
+        json.dump({
+            'name': name,
+            'version': version,
+            'n_cells': store.n_cells,
+            'n_genes': store.n_genes,
+            'n_markers': len(markers),
+            'n_pcs': int(components.shape[0]),
+            'n_lists': int(len(ivf_centroids)),
+            'cell_types': types,
+            'created_at': datetime.utcnow().isoformat(),
+        }, f, indent=2)
+
+def _sampled_rows(store, sample, markers):
+    """Dense marker rows for sampled cells, read block by block"""
+    import numpy as np
+
+    rows = []
+    for start in range(0, store.n_cells, PROJECT_BLOCK_CELLS):
+        in_block = sample[(sample >= start) & (sample < start + PROJECT_BLOCK_CELLS)] - start
+        if len(in_block):
+            block = _log_normalize(store.cells(start, start + PROJECT_BLOCK_CELLS))
+            rows.append(block[in_block][:, markers].toarray())
+    return np.vstack(rows)
+
+def build_ivf_index(embeddings, rng):
+    """Coarse k-means lists over the embeddings: (centroids, cell order, list offsets)"""
+    import numpy as np
+
+    n_lists = int(min(IVF_MAX_LISTS, max(1, np.sqrt(len(embeddings)))))
+    sample = embeddings[rng.choice(len(embeddings), min(len(embeddings), KMEANS_SAMPLE_CELLS), replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _nearest(sample, centroids)
+        for j in range(n_lists):
+            members = sample[assignment == j]
+            if len(members):
+                centroids[j] = members.mean(axis=0)
+
+    assignment = np.concatenate([
+        _nearest(embeddings[start:start + PROJECT_BLOCK_CELLS], centroids)
+        for start in range(0, len(embeddings), PROJECT_BLOCK_CELLS)
+    ])
+    order = np.argsort(assignment, kind='stable').astype(np.int64)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+    return centroids.astype(np.float32), order, offsets
+
+def ivf_search(queries, embeddings, centroids, order, offsets, k: int, nprobe: int) -> Tuple[object, object]:
+    """
+    Approximate k nearest embeddings of each query, scanning the nprobe index lists
+    with the closest centroids. Returns (indices, squared distances), nearest first;
+    missing neighbors are -1.
+    """
+    import numpy as np
+
+    queries = np.asarray(queries, dtype=np.float32)
+    n_lists = len(centroids)
+    probes = np.argsort(_squared_distances(queries, np.asarray(centroids)), axis=1)[:, :min(nprobe, n_lists)]
+
+    best_d = np.full((len(queries), k), np.inf, dtype=np.float32)
+    best_i = np.full((len(queries), k), -1, dtype=np.int64)
+    for j in np.unique(probes):
+        rows = np.nonzero((probes == j).any(axis=1))[0]
+        members = np.asarray(order[offsets[j]:offsets[j + 1]])
+        if not len(members):
+            continue
+        d = _squared_distances(queries[rows], np.asarray(embeddings[members]))
+        merged_d = np.hstack([best_d[rows], d])
+        merged_i = np.hstack([best_i[rows], np.broadcast_to(members, d.shape)])
+        top = np.argsort(merged_d, axis=1)[:, :k]
+        best_d[rows] = np.take_along_axis(merged_d, top, axis=1)
+        best_i[rows] = np.take_along_axis(merged_i, top, axis=1)
+
+    return best_i, best_d
+
+def _squared_distances(a, b):
+    import numpy as np
+
+    return np.maximum((a * a).sum(axis=1)[:, None] - 2 * a @ b.T + (b * b).sum(axis=1)[None, :], 0)
+
+def _nearest(points, centroids):
+    return _squared_distances(points, centroids).argmin(axis=1)
+
+class Reference:
+    """A prepared reference; arrays are memory-mapped read-only"""
+
+    def __init__(self, path: str):
+        import numpy as np
+
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.cell_types: List[str] = self.meta['cell_types']
+        for name in ('centroids', 'marker_genes', 'marker_matrix', 'pca_mean', 'pca_components',
+                     'embeddings', 'cell_labels', 'ivf_centroids', 'ivf_order', 'ivf_offsets'):
+            setattr(self, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r'))
+        self._gene_names = None
+
+    def gene_names(self) -> List[str]:
+        if self._gene_names is None:
+            with gzip.open(os.path.join(self.path, 'genes.txt.gz'), 'rt') as f:
+                self._gene_names = [line.rstrip('\n') for line in f]
+        return self._gene_names
+
+    def marker_gene_names(self) -> List[str]:
+        names = self.gene_names()
+        return [names[g] for g in self.marker_genes]
+
+    def project(self, marker_expression):
+        """PCA embedding of log-normalized query cells given on the marker genes"""
+        import numpy as np
+
+        return (np.asarray(marker_expression, dtype=np.float32) - self.pca_mean) @ self.pca_components.T
+
+    def knn(self, queries, k: int = 15, nprobe: int = 8) -> Tuple[object, object]:
+        """Approximate k nearest reference cells of each query embedding (see ivf_search)"""
+        return ivf_search(queries, self.embeddings, self.ivf_centroids, self.ivf_order, self.ivf_offsets, k, nprobe)
+
+    def vote(self, queries, k: int = 15, nprobe: int = 8) -> Tuple[List[str], object]:
+        """Majority cell type among each query's neighbors, with the winning fraction"""
+        import numpy as np
+
+        indices, _ = self.knn(queries, k, nprobe)
+        found = indices >= 0
+        neighbor_codes = np.where(found, np.asarray(self.cell_labels)[np.maximum(indices, 0)], -1)
+        counts = np.stack([(neighbor_codes == t).sum(axis=1) for t in range(len(self.cell_types))], axis=1)
+        winners = counts.argmax(axis=1)
+        confidence = counts.max(axis=1) / np.maximum(found.sum(axis=1), 1)
+        return [self.cell_types[t] for t in winners], confidence
+
+def get_reference(name: str) -> 'Reference':
+    """Prepared reference from this process's LRU cache, preparing it on first use"""
+    version = reference_version(name)
+    key = (name, version)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    reference = Reference(prepare_reference(name))
+    with _cache_lock:
+        _cache[key] = reference
+        _cache.move_to_end(key)
+        while len(_cache) > REFERENCE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return reference
+
+def warm_references(names) -> Optional[str]:
+    """Load references into this process's cache; returns an error message instead of raising"""
+    try:
+        for name in names:
+            get_reference(name)
+    except Exception as e:
+        return str(e)
+    return None
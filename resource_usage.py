@@ -0,0 +1,304 @@
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+import os
+import subprocess
+import threading
+import time
+
+# How often the process tree is sampled for RSS and I/O while a stage runs
+SAMPLE_INTERVAL_SECONDS = float(os.getenv('USAGE_SAMPLE_INTERVAL', 0.5))
+
+# Last lines of each output stream kept in memory (e.g. for a failed stage's error)
+OUTPUT_TAIL_LINES = int(os.getenv('OUTPUT_TAIL_LINES', 200))
+
+# Recent stage runs used to fit the memory-per-cell model
+MEMORY_MODEL_SAMPLES = 200
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+@dataclass
+class ProcessUsage:
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+    read_mb: float = 0.0
+    write_mb: float = 0.0
+    max_processes: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+def run_monitored(cmd: List[str], on_line: Optional[Callable[[str, str], None]] = None,
+                  env: Optional[Dict[str, str]] = None) -> Tuple[int, str, str, ProcessUsage]:
+    """
+    Run a command to completion while sampling its process tree.
+    CPU time comes from wait4 rusage (which includes reaped descendants); peak RSS,
+    I/O bytes and process count are sampled from /proc, with rusage as a floor.
+    Output is passed line by line to on_line(stream, line) as it arrives and only the
+    last OUTPUT_TAIL_LINES lines of each stream are kept. The command runs in its own
+    process group, which is terminated as a whole if the wait is interrupted (job
+    cancelled or timed out) or the job's processes are stopped. env is added to the
+    inherited environment.
+    Returns (returncode, stdout tail, stderr tail, usage).
+    """
+    from app.core.process_control import JobStopped, check_not_stopping, register_group, terminate_group, unregister_group
+
+    check_not_stopping()
+    usage = ProcessUsage()
+    started = time.monotonic()
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace', start_new_session=True,
+        env={**os.environ, **env} if env else None
+    )
+    try:
+        register_group(process.pid)
+    except JobStopped:
+        process.communicate()
+        raise
+
+    # Drain pipes in threads so we can reap the child ourselves with wait4
+    tails = {'stdout': deque(maxlen=OUTPUT_TAIL_LINES), 'stderr': deque(maxlen=OUTPUT_TAIL_LINES)}
+    readers = [
+        threading.Thread(target=pump_lines, args=(pipe, name, tails[name], on_line), daemon=True)
+        for name, pipe in (('stdout', process.stdout), ('stderr', process.stderr))
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        process.returncode = monitor_pid(process.pid, usage, started)
+    except BaseException:
+        terminate_group(process.pid)
+        raise
+    finally:
+        unregister_group(process.pid)
+    for reader in readers:
+        reader.join()
+    process.stdout.close()
+    process.stderr.close()
+
+    return process.returncode, ''.join(tails['stdout']), ''.join(tails['stderr']), usage
+
+def pump_lines(pipe, name: str, tail: deque, on_line: Optional[Callable[[str, str], None]] = None):
+    """Read a text pipe to EOF, keeping its last lines in tail and passing each to on_line"""
+    for line in pipe:
+        tail.append(line)
+        if on_line:
+            try:
+                on_line(name, line.rstrip('\n'))
+            except Exception:
+                # A failing log sink must not stop the pipe being drained
+                pass
+
+def monitor_pid(pid: int, usage: ProcessUsage, started: float) -> int:
+    """
+    Sample a child process tree until it exits, reap it with wait4 and fill in usage.
+    Returns the exit code (negative for a signal).
+    """
+    # Per-pid I/O counters; summed so bytes from exited children are kept
+    io_by_pid: Dict[int, Tuple[int, int]] = {}
+    while True:
+        reaped, status, rusage = os.wait4(pid, os.WNOHANG)
+        if reaped:
+            break
+        _sample_tree(pid, usage, io_by_pid)
+        time.sleep(SAMPLE_INTERVAL_SECONDS)
+
+    usage.wall_seconds = time.monotonic() - started
+    usage.cpu_seconds = rusage.ru_utime + rusage.ru_stime
+    # ru_maxrss is in KB on Linux and is the largest single descendant
+    usage.peak_rss_mb = max(usage.peak_rss_mb, rusage.ru_maxrss / 1024)
+    usage.read_mb = max(sum(r for r, _ in io_by_pid.values()) / (1024**2), rusage.ru_inblock * 512 / (1024**2))
+    usage.write_mb = max(sum(w for _, w in io_by_pid.values()) / (1024**2), rusage.ru_oublock * 512 / (1024**2))
+    usage.max_processes = max(usage.max_processes, 1)
+
+    return os.waitstatus_to_exitcode(status)
+
+def _sample_tree(root_pid: int, usage: ProcessUsage, io_by_pid: Dict[int, Tuple[int, int]]):
+    """Fold one /proc sample of root_pid and its descendants into usage"""
+    pids = _process_tree(root_pid)
+    rss_bytes = 0
+    for pid in pids:
+        rss_bytes += _read_rss(pid)
+        io = _read_io(pid)
+        if io:
+            io_by_pid[pid] = io
+
+    usage.peak_rss_mb = max(usage.peak_rss_mb, rss_bytes / (1024**2))
+    usage.max_processes = max(usage.max_processes, len(pids))
+
+def _process_tree(root_pid: int) -> List[int]:
+    """root_pid and all of its live descendants"""
+    children: Dict[int, List[int]] = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return [root_pid]
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # The command name may contain spaces; fields resume after the last ')'
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+def _read_rss(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+def _read_io(pid: int) -> Optional[Tuple[int, int]]:
+    try:
+        with open(f'/proc/{pid}/io', 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def charge_usage(user_id: int, storage_mb: float = 0.0, compute_hours: float = 0.0):
+    """
+    UPDATE adding to a user's usage counters in SQL, clamped at 0, so concurrent jobs,
+    uploads and retention runs never overwrite each other's charges. Execute it on
+    either the sync or the async session; the caller commits.
+    """
+    from sqlalchemy import case, func, update
+    from app.models.user import User
+
+    # CASE rather than GREATEST, which SQLite (used by local benchmark runs) lacks
+    def clamped(column, amount):
+        total = func.coalesce(column, 0) + amount
+        return case((total > 0, total), else_=0)
+
+    return update(User).where(User.id == user_id).values(
+        storage_used_mb=clamped(User.storage_used_mb, storage_mb),
+        compute_hours_used=clamped(User.compute_hours_used, compute_hours)
+    )
+
+def record_stage_usage(db, job, stage_usage: List[dict], n_cells: Optional[int] = None):
+    """
+    Persist per-stage usage for a job and roll it up into the job and its user.
+    Caller commits. The job's memory peak is concurrent_peak_mb of its stages.
+    """
+    from app.models.usage import JobStageUsage
+
+    cpu_seconds = 0.0
+    for entry in stage_usage:
+        usage = entry['usage']
+        cpu_seconds += usage['cpu_seconds']
+        db.add(JobStageUsage(
+            job_id=job.id,
+            job_type=job.job_type,
+            stage=entry['stage'],
+            stage_key=entry['key'],
+            n_cells=n_cells,
+            **usage
+        ))
+
+    cpu_hours = cpu_seconds / 3600
+    job.cpu_hours = cpu_hours
+    job.memory_peak_gb = concurrent_peak_mb(stage_usage) / 1024
+    db.execute(charge_usage(job.user_id, compute_hours=cpu_hours))
+
+def concurrent_peak_mb(stage_usage: List[dict]) -> float:
+    """
+    Largest sum of stage peaks over any moment stages ran together (sweep points run
+    their stages in parallel); an upper bound, since overlapping peaks need not
+    coincide. Entries without a 'started' time count on their own.
+    """
+    peak_mb = 0.0
+    events = []
+    for entry in stage_usage:
+        usage = entry['usage']
+        started = entry.get('started')
+        if started is None:
+            peak_mb = max(peak_mb, usage['peak_rss_mb'])
+            continue
+        events.append((started, 1, usage['peak_rss_mb']))
+        events.append((started + usage['wall_seconds'], 0, usage['peak_rss_mb']))
+
+    # At the same instant a stage ending is counted before one starting
+    running_mb = 0.0
+    for _, is_start, rss_mb in sorted(events):
+        running_mb += rss_mb if is_start else -rss_mb
+        peak_mb = max(peak_mb, running_mb)
+    return peak_mb
+
+def fit_memory_models(db, stages: List[str]) -> Dict[str, Optional[Tuple[float, float]]]:
+    """
+    Memory models of several stages from one query over each stage's last
+    MEMORY_MODEL_SAMPLES runs (see fit_memory_model). Returns stage -> fit or None.
+    """
+    from sqlalchemy import func
+    from app.models.usage import JobStageUsage
+
+    ranked = db.query(
+        JobStageUsage.stage, JobStageUsage.n_cells, JobStageUsage.peak_rss_mb,
+        func.row_number().over(partition_by=JobStageUsage.stage, order_by=JobStageUsage.id.desc()).label('recency')
+    ).filter(
+        JobStageUsage.stage.in_(stages),
+        JobStageUsage.n_cells.isnot(None)
+    ).subquery()
+    rows = db.query(ranked.c.stage, ranked.c.n_cells, ranked.c.peak_rss_mb).filter(
+        ranked.c.recency <= MEMORY_MODEL_SAMPLES
+    ).all()
+
+    samples: Dict[str, List[Tuple[int, float]]] = {stage: [] for stage in stages}
+    for stage, n_cells, peak_rss_mb in rows:
+        samples[stage].append((n_cells, peak_rss_mb))
+    return {stage: fit_memory_model(points) for stage, points in samples.items()}
+
+def fit_memory_model(rows: List[Tuple[int, float]]) -> Optional[Tuple[float, float]]:
+    """
+    Least-squares fit of peak RSS (MB) = base + per_cell * n_cells over (n_cells, peak)
+    samples of a stage. Returns (base_mb, mb_per_cell), or None without enough data.
+    """
+    if len(rows) < 2:
+        return None
+
+    n = len(rows)
+    mean_x = sum(x for x, _ in rows) / n
+    mean_y = sum(y for _, y in rows) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in rows)
+    if var_x == 0:
+        return None
+
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in rows) / var_x
+    slope = max(slope, 0.0)
+    return max(mean_y - slope * mean_x, 0.0), slope
+
+def estimate_peak_memory_mb(db, job_type: str, n_cells: int, models: Optional[dict] = None,
+                            params: Optional[dict] = None) -> Optional[float]:
+    """
+    Predicted peak memory of a job: the largest predicted peak of the stages it runs
+    (which depend on the engine in params). Fitted models are kept in models
+    (stage -> fit), if given, to plan many jobs with one fit each.
+    """
+    from app.tasks.pipeline import get_pipeline
+
+    models = {} if models is None else models
+    stages = get_pipeline(job_type, params)
+    missing = [stage.name for stage in stages if stage.name not in models]
+    if missing:
+        models.update(fit_memory_models(db, missing))
+
+    estimates = []
+    for stage in stages:
+        model = models[stage.name]
+        if model:
+            base_mb, mb_per_cell = model
+            estimates.append(base_mb + mb_per_cell * n_cells)
+    return max(estimates) if estimates else None
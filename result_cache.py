@@ -0,0 +1,209 @@
+from datetime import datetime
+from typing import List, Tuple
+import hashlib
+import json
+import os
+import shutil
+
+from app.core.redis_client import get_redis
+from app.tasks.pipeline import DEFAULT_ENGINE, LOCATION_PARAMETERS, pipeline_defaults, pipeline_script_version
+
+# Share of the user's storage quota that cached results may occupy before eviction
+CACHE_QUOTA_FRACTION = float(os.getenv('RESULT_CACHE_QUOTA_FRACTION', 0.5))
+
+def canonicalize_parameters(job_type: str, params: dict) -> str:
+    """Stable JSON encoding of job parameters with defaults applied"""
+    # Defaults are folded in so {} and explicitly passed defaults share a key
+    merged = pipeline_defaults(job_type)
+    merged.update({k: v for k, v in (params or {}).items() if v is not None and k not in LOCATION_PARAMETERS})
+    if merged.get('engine') == DEFAULT_ENGINE:
+        del merged['engine']
+    return json.dumps(_normalize(merged), sort_keys=True, separators=(',', ':'))
+
+def _normalize(value):
+    """Normalize values so equivalent parameters encode identically"""
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def compute_cache_key(input_sha256: str, job_type: str, params: dict) -> str:
+    """Content-addressed key for an analysis run"""
+    parts = [
+        input_sha256,
+        job_type,
+        canonicalize_parameters(job_type, params),
+        pipeline_script_version(job_type, params),
+    ]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+def lookup_result(db, user_id: int, cache_key: str, job_type: str):
+    """Return a usable cache entry for the key, recording the hit or miss"""
+    return lookup_results(db, user_id, [(cache_key, job_type)]).get(cache_key)
+
+def lookup_results(db, user_id: int, lookups: List[Tuple[str, str]]) -> dict:
+    """
+    lookup_result for many (cache key, job type) pairs with one query and one commit.
+    Returns cache key -> entry for the keys that hit.
+    """
+    from app.models.cache import ResultCacheEntry
+
+    if not lookups:
+        return {}
+    entries = {entry.cache_key: entry for entry in db.query(ResultCacheEntry).filter(
+        ResultCacheEntry.user_id == user_id,
+        ResultCacheEntry.cache_key.in_({cache_key for cache_key, _ in lookups})
+    )}
+
+    hits = {}
+    now = datetime.utcnow()
+    for cache_key, job_type in lookups:
+        entry = entries.get(cache_key)
+        # Outputs removed from disk behind our back invalidate the entry
+        if entry and not os.path.isdir(entry.output_directory):
+            db.delete(entry)
+            del entries[cache_key]
+            entry = None
+
+        if entry is not None:
+            entry.hit_count = (entry.hit_count or 0) + 1
+            entry.last_used_at = now
+            hits[cache_key] = entry
+        _record_lookup(job_type, hit=entry is not None)
+
+    db.commit()
+    return hits
+
+def complete_from_cache(job, entry):
+    """Mark a job completed using a cache entry's outputs (caller commits)"""
+    from app.models.job import JobStatus
+
+    now = datetime.utcnow()
+    job.status = JobStatus.COMPLETED
+    job.started_at = job.started_at or now
+    job.completed_at = now
+    job.output_directory = entry.output_directory
+    job.result_summary = entry.result_summary
+    job.result_manifest = entry.result_manifest
+    job.progress_percent = 100
+    job.current_step = 'Completed (cached)'
+    job.cpu_hours = 0
+
+def store_result(db, job, input_sha256: str, result: dict):
+    """Register a completed job's outputs under its cache key"""
+    from app.models.cache import ResultCacheEntry
+    from app.core.output_store import stored_size_mb
+
+    if not job.cache_key or not job.output_directory:
+        return None
+
+    entry = db.query(ResultCacheEntry).filter(
+        ResultCacheEntry.user_id == job.user_id,
+        ResultCacheEntry.cache_key == job.cache_key
+    ).first()
+
+    if entry is None:
+        entry = ResultCacheEntry(user_id=job.user_id, cache_key=job.cache_key)
+        db.add(entry)
+
+    entry.job_type = job.job_type
+    entry.input_sha256 = input_sha256
+    entry.script_version = pipeline_script_version(job.job_type, json.loads(job.parameters or '{}'))
+    entry.source_job_id = job.id
+    entry.output_directory = job.output_directory
+    entry.result_summary = json.dumps(result)
+    entry.result_manifest = job.result_manifest
+    entry.size_mb = stored_size_mb(json.loads(job.result_manifest)) if job.result_manifest \
+        else directory_size_mb(job.output_directory)
+    entry.last_used_at = datetime.utcnow()
+    db.commit()
+
+    return entry
+
+def evict_results(db, user) -> int:
+    """
+    Evict least recently used entries beyond the user's cache budget. Only entries whose
+    outputs no live job uses count toward the budget: a job's own directory is charged to
+    the job and stays until retention removes it, so evicting its entry would free nothing.
+    """
+    from app.core.config import settings
+    from app.models.cache import ResultCacheEntry
+    from app.models.job import AnalysisJob
+
+    limits = settings.SUBSCRIPTION_LIMITS[user.subscription_tier]
+    budget_mb = limits["storage_gb"] * 1024 * CACHE_QUOTA_FRACTION
+
+    entries = db.query(ResultCacheEntry).filter(
+        ResultCacheEntry.user_id == user.id
+    ).order_by(ResultCacheEntry.last_used_at.desc()).all()
+    if not entries:
+        return 0
+
+    backed = {row.output_directory for row in db.query(AnalysisJob.output_directory).filter(
+        AnalysisJob.output_directory.in_({entry.output_directory for entry in entries}),
+        AnalysisJob.outputs_deleted_at.is_(None)
+    ).distinct()}
+
+    used_mb = 0
+    evicted = 0
+    for entry in entries:
+        if entry.output_directory in backed:
+            continue
+        used_mb += entry.size_mb or 0
+        if used_mb <= budget_mb:
+            continue
+
+        if os.path.isdir(entry.output_directory):
+            shutil.rmtree(entry.output_directory, ignore_errors=True)
+        db.delete(entry)
+        evicted += 1
+
+    if evicted:
+        db.commit()
+        _increment('result_cache:evictions', evicted)
+
+    return evicted
+
+def get_cache_stats() -> dict:
+    """Hit/miss counters per job type plus total evictions"""
+    stats = {'job_types': {}, 'evictions': 0}
+    try:
+        redis_client = get_redis()
+        counters = redis_client.hgetall('result_cache:lookups')
+        stats['evictions'] = int(redis_client.get('result_cache:evictions') or 0)
+    except Exception:
+        return stats
+
+    for field, count in counters.items():
+        job_type, outcome = field.decode().rsplit(':', 1)
+        stats['job_types'].setdefault(job_type, {'hits': 0, 'misses': 0})[outcome] = int(count)
+
+    return stats
+
+def directory_size_mb(path: str) -> float:
+    """Total size of all files under a directory in MB"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                pass
+    return total / (1024**2)
+
+def _record_lookup(job_type: str, hit: bool):
+    """Count a cache lookup; accounting must never fail a job"""
+    try:
+        get_redis().hincrby('result_cache:lookups', f"{job_type}:{'hits' if hit else 'misses'}", 1)
+    except Exception:
+        pass
+
+def _increment(key: str, amount: int = 1):
+    """Increment a plain Redis counter, ignoring Redis errors"""
+    try:
+        get_redis().incrby(key, amount)
+    except Exception:
+        pass
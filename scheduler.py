@@ -0,0 +1,196 @@
+from typing import List, Optional
+import json
+import os
+import socket
+import time
+import uuid
+
+from app.core.redis_client import get_redis
+
+# Size-class queues, smallest first: (queue, largest estimated peak memory in MB)
+SIZE_CLASSES = [
+    ('analysis.small', 4 * 1024),
+    ('analysis.medium', 16 * 1024),
+    ('analysis.large', 64 * 1024),
+    ('analysis.highmem', None),
+]
+
+# Fallback memory model until enough stage usage is recorded: base MB + MB per cell
+DEFAULT_MEMORY_MODEL = {
+    'clustering': (1024, 0.04),
+    'annotation': (1024, 0.03),
+    'differential_expression': (1024, 0.06),
+}
+
+# Dense-equivalent bytes per input byte when the cell count is unknown
+BYTES_IN_MEMORY_PER_FILE_BYTE = 6
+
+# Redis priority per SubscriptionTier (0 is highest); paying tiers are picked first within a queue
+TIER_PRIORITY = {
+    'enterprise': 0,
+    'pro': 3,
+    'basic': 6,
+    'free': 9,
+}
+
+# Share of a node's memory that admitted jobs may reserve
+NODE_MEMORY_FRACTION = float(os.getenv('SCHEDULER_NODE_MEMORY_FRACTION', 0.85))
+
+# How long a job waits before trying admission again
+ADMISSION_RETRY_SECONDS = int(os.getenv('SCHEDULER_ADMISSION_RETRY_SECONDS', 30))
+
+# Atomically reserve memory on a node if the total stays within its budget.
+# The first job on an idle node is always admitted so oversized jobs still run.
+_RESERVE_SCRIPT = """
+local reserved = 0
+for _, mb in ipairs(redis.call('HVALS', KEYS[1])) do
+    reserved = reserved + tonumber(mb)
+end
+local request = tonumber(ARGV[2])
+if reserved > 0 and reserved + request > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], request)
+return 1
+"""
+
+def estimate_memory_mb(db, job_type: str, n_cells: Optional[int], file_size: Optional[int],
+                       models: Optional[dict] = None, params: Optional[dict] = None) -> float:
+    """Predicted peak memory of a job from its input's dimensions and its engine's stages"""
+    from app.core.resource_usage import estimate_peak_memory_mb
+
+    if n_cells:
+        # Measured stage usage wins over the built-in model once it exists
+        estimate = estimate_peak_memory_mb(db, job_type, n_cells, models, params)
+        if estimate:
+            return estimate
+        base_mb, mb_per_cell = DEFAULT_MEMORY_MODEL.get(job_type, DEFAULT_MEMORY_MODEL['clustering'])
+        return base_mb + mb_per_cell * n_cells
+
+    base_mb = DEFAULT_MEMORY_MODEL.get(job_type, DEFAULT_MEMORY_MODEL['clustering'])[0]
+    return base_mb + (file_size or 0) * BYTES_IN_MEMORY_PER_FILE_BYTE / (1024**2)
+
+def size_class(memory_mb: float) -> str:
+    """Queue for a job with the given estimated peak memory"""
+    for queue, limit_mb in SIZE_CLASSES:
+        if limit_mb is None or memory_mb <= limit_mb:
+            return queue
+    return SIZE_CLASSES[-1][0]
+
+def tier_priority(tier) -> int:
+    return TIER_PRIORITY.get(getattr(tier, 'value', tier), TIER_PRIORITY['free'])
+
+def plan_job(db, job, input_file, user, models: Optional[dict] = None):
+    """
+    Set a job's memory estimate, queue and priority (caller commits). Pass the same
+    models dict when planning several jobs so memory models are fitted once.
+    """
+    job_type = job.job_type
+    params = json.loads(job.parameters) if job.parameters else {}
+    parallelism = 1
+    if job_type == 'sweep':
+        from app.tasks.pipeline import SWEEP_MAX_WORKERS
+
+        # Sweep points run side by side, so up to one pool's worth are resident at once
+        spec = params
+        job_type = spec['job_type']
+        params = spec.get('parameters') or {}
+        n_points = 1
+        for values in spec['sweep'].values():
+            n_points *= len(values)
+        parallelism = min(n_points, SWEEP_MAX_WORKERS)
+
+    job.estimated_memory_mb = estimate_memory_mb(
+        db, job_type, input_file.n_cells, input_file.total_size, models, params
+    ) * parallelism
+    job.queue = size_class(job.estimated_memory_mb)
+    job.priority = tier_priority(user.subscription_tier)
+
+def assign_task_id(job):
+    """Give a job the id of the task about to run it; deliveries of older tasks are ignored"""
+    job.celery_task_id = str(uuid.uuid4())
+
+def job_signature(job, traceparent: Optional[str] = None):
+    """
+    The run_analysis task for a planned job: its size-class queue and priority, its
+    task id (assigned here if missing; caller commits) so it can be cancelled from
+    the moment it is queued, the submitting span's traceparent and the time queued.
+    """
+    from app.tasks.analysis import run_analysis
+
+    if not job.celery_task_id:
+        assign_task_id(job)
+    return run_analysis.signature(
+        args=[job.id], queue=job.queue, priority=job.priority, task_id=job.celery_task_id,
+        headers={'traceparent': traceparent, 'enqueued_at': time.time()}
+    )
+
+def dispatch_job(job, traceparent: Optional[str] = None):
+    """Send a planned job to its queue (see job_signature)"""
+    job_signature(job, traceparent).apply_async()
+
+def dispatch_jobs(jobs: List, traceparents: List[Optional[str]]):
+    """Send many planned jobs as one Celery group, published over a single broker connection"""
+    from celery import group
+
+    if jobs:
+        group(job_signature(job, traceparent) for job, traceparent in zip(jobs, traceparents)).apply_async()
+
+def dispatch_ingest(upload):
+    """Send a completed upload to be ingested on a queue sized from its file"""
+    from app.tasks.analysis import ingest_upload
+
+    memory_mb = upload.total_size * BYTES_IN_MEMORY_PER_FILE_BYTE / (1024**2)
+    ingest_upload.apply_async(args=[upload.id], queue=size_class(memory_mb))
+
+def admit_job(job) -> bool:
+    """Reserve the job's estimated memory on this node, or refuse if it would not fit"""
+    budget_mb = node_memory_mb() * NODE_MEMORY_FRACTION
+    try:
+        return bool(get_redis().eval(
+            _RESERVE_SCRIPT, 1, reservation_key(), job.id, job.estimated_memory_mb or 0, budget_mb
+        ))
+    except Exception:
+        # Without Redis we cannot coordinate, so fall back to admitting everything
+        return True
+
+def release_job(job_id: int):
+    try:
+        get_redis().hdel(reservation_key(), job_id)
+    except Exception:
+        pass
+
+def clear_reservations():
+    """Drop this node's reservations; called when a worker starts"""
+    try:
+        get_redis().delete(reservation_key())
+    except Exception:
+        pass
+
+def reservation_key() -> str:
+    return f"scheduler:reserved:{socket.gethostname()}"
+
+def node_memory_mb() -> float:
+    """Total memory of this node (or its cgroup limit, if lower) in MB"""
+    total_mb = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    total_mb = int(line.split()[1]) / 1024
+                    break
+    except OSError:
+        pass
+
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path, 'r') as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            limit_mb = int(limit) / (1024**2)
+            total_mb = min(total_mb, limit_mb) if total_mb else limit_mb
+        break
+
+    return total_mb or 0
@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional
+from jose import JWTError, jwt
+from passlib.context import CryptContext
+from fastapi import Depends, HTTPException, status
+from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.util.concurrency import await_only, in_greenlet
+import asyncio
+import enum
+import json
+import os
+
+from app.core.database import get_db
+from app.core.redis_client import get_async_redis, get_redis
+from app.models.user import User
+
+# Configuration
+SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_HOURS = 24
+
+# Authenticated users are cached by token subject for this long
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", 60))
+
+# Never copied into the cache: the password hash, and the usage counters, which workers
+# change with SQL-side increments while a cached copy would be stale (see load_usage)
+USER_CACHE_EXCLUDED_COLUMNS = {"hashed_password", "storage_used_mb", "compute_hours_used"}
+
+# bcrypt is deliberately slow; it runs on a bounded pool so it never blocks the event loop
+# and a burst of logins cannot take every thread
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 4))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
+
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against a hash off the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, pwd_context.verify, plain_password, hashed_password)
+
+async def hash_password(password: str) -> str:
+    """Hash a password off the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, pwd_context.hash, password)
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    """Create JWT access token"""
+    to_encode = data.copy()
+    if expires_delta:
+        expire = datetime.utcnow() + expires_delta
+    else:
+        expire = datetime.utcnow() + timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
+
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_db)
+) -> User:
+    """Get current authenticated user from JWT token, from the user cache when possible"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username: str = payload.get("sub")
+        if username is None:
+            raise credentials_exception
+    except JWTError:
+        raise credentials_exception
+
+    user = await get_cached_user(db, username)
+    if user is None:
+        user = await db.scalar(select(User).where(User.username == username))
+        if user is None:
+            raise credentials_exception
+        await cache_user(user)
+
+    if not user.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Inactive user"
+        )
+
+    return user
+
+async def get_cached_user(db: AsyncSession, username: str) -> Optional[User]:
+    """
+    Cached user attached to this request's session without a SELECT, so handlers
+    can still modify and commit it as usual.
+    """
+    try:
+        cached = await get_async_redis().get(user_cache_key(username))
+    except Exception:
+        return None
+    if not cached:
+        return None
+
+    values = json.loads(cached)
+    for column in User.__table__.columns:
+        value = values.get(column.key)
+        if value is None:
+            continue
+        if hasattr(column.type, "enum_class") and column.type.enum_class:
+            values[column.key] = column.type.enum_class(value)
+        elif column.type.python_type is datetime:
+            values[column.key] = datetime.fromisoformat(value)
+
+    user = User(**values)
+    make_transient_to_detached(user)
+    return await db.merge(user, load=False)
+
+async def load_usage(db: AsyncSession, user: User):
+    """Read the user's usage counters fresh; they are never taken from the cache"""
+    await db.refresh(user, ["storage_used_mb", "compute_hours_used"])
+
+async def cache_user(user: User):
+    values = {}
+    for column in User.__table__.columns:
+        if column.key in USER_CACHE_EXCLUDED_COLUMNS:
+            continue
+        value = getattr(user, column.key)
+        if isinstance(value, enum.Enum):
+            value = value.value
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        values[column.key] = value
+
+    try:
+        await get_async_redis().set(user_cache_key(user.username), json.dumps(values), ex=USER_CACHE_TTL_SECONDS)
+    except Exception:
+        pass
+
+def invalidate_user_cache(*usernames: str):
+    """Drop cached users; ORM updates to User do this automatically on commit"""
+    if not usernames:
+        return
+    keys = [user_cache_key(username) for username in usernames]
+    try:
+        if in_greenlet():
+            # Committed through an AsyncSession: await the async client from the commit
+            # hook, as SQLAlchemy awaits the driver, without blocking the event loop
+            await_only(get_async_redis().delete(*keys))
+        else:
+            get_redis().delete(*keys)
+    except Exception:
+        pass
+
+def user_cache_key(username: str) -> str:
+    return f"user_cache:{username}"
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _mark_user_changed(mapper, connection, target):
+    """Remember changed users (old and new usernames) until the transaction commits"""
+    session = Session.object_session(target)
+    if session is None:
+        return
+    changed = session.info.setdefault("changed_usernames", set())
+    changed.add(target.username)
+    changed.update(inspect(target).attrs.username.history.deleted or ())
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session):
+    # Invalidate after commit so a concurrent request cannot re-cache the old row
+    invalidate_user_cache(*session.info.pop("changed_usernames", ()))
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_usernames", None)
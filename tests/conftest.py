@@ -0,0 +1,180 @@
+import os
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import cache, job, upload, usage, user  # every table registers on the metadata
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    """A scratch SQLite database with every table created"""
+    url = f"sqlite:///{tmp_path / 'test.db'}"
+    engine = create_engine(url)
+    user.User.metadata.create_all(engine)
+    engine.dispose()
+    return url
+
+
+@pytest.fixture
+def db(database_url):
+    """Sync session, as the workers use"""
+    engine = create_engine(database_url)
+    session = sessionmaker(bind=engine, expire_on_commit=False)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def async_sessions(database_url):
+    """Factory of async sessions on the same database, as the API uses"""
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+    engine = create_async_engine(database_url.replace('sqlite://', 'sqlite+aiosqlite://'))
+    return async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False, autoflush=False)
+
+
+@pytest.fixture
+def redis_server():
+    """A live, emptied Redis database (TEST_REDIS_URL); tests using it are skipped when none is reachable"""
+    import redis
+
+    client = redis.Redis.from_url(os.getenv('TEST_REDIS_URL', 'redis://localhost:6379/15'))
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        pytest.skip('Redis is not running')
+    client.flushdb()
+    yield client
+    client.flushdb()
+    client.close()
+
+
+@pytest.fixture
+def account(db):
+    account = user.User(email='test@localhost', username='test', hashed_password='!',
+                        subscription_tier=user.SubscriptionTier.PRO)
+    db.add(account)
+    db.commit()
+    return account
+
+
+@pytest.fixture
+def make_job(db, account):
+    def make(**values):
+        analysis = job.AnalysisJob(**{
+            'user_id': account.id, 'job_name': 'test', 'job_type': 'clustering',
+            'input_file_path': '/data/uploads/counts.mtx', **values
+        })
+        db.add(analysis)
+        db.commit()
+        return analysis
+    return make
+
+
+@pytest.fixture
+def sparse_store(tmp_path):
+    """Writes a cells x genes count matrix as an ingested store (via a gene-rows CSV); returns its path"""
+    from app.tasks.ingest import open_matrix, write_store
+
+    def make(counts, cell_names=None, gene_names=None, name='store'):
+        cell_names = cell_names or [f'cell_{c}' for c in range(counts.shape[0])]
+        gene_names = gene_names or [f'gene_{g}' for g in range(counts.shape[1])]
+        source = tmp_path / f'{name}.csv'
+        with open(source, 'w') as f:
+            f.write('gene,' + ','.join(cell_names) + '\n')
+            for gene, row in zip(gene_names, counts.T):
+                f.write(gene + ',' + ','.join(f'{value:g}' for value in row) + '\n')
+        write_store(str(tmp_path / name), open_matrix(str(source), source.name))
+        return str(tmp_path / name)
+    return make
+
+
+TOY_SCRIPT = '''
+import json, os, sys
+
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+stage = os.path.basename(os.path.dirname(args['--output']))
+with open(os.environ['TOY_RUNS'], 'a') as f:
+    f.write(stage + '\\n')
+if os.environ.get('TOY_FAIL') == stage:
+    sys.exit(f'{stage} failed')
+
+source = args['--input']
+if os.path.isdir(source):
+    with open(os.path.join(source, 'value.txt')) as f:
+        value = float(f.read())
+else:
+    value = float(os.path.getsize(source))
+value = value * float(args.get('--scale', 1)) + float(args.get('--offset', 0))
+
+with open(os.path.join(args['--output'], 'value.txt'), 'w') as f:
+    f.write(str(value))
+with open(os.path.join(args['--output'], 'summary.json'), 'w') as f:
+    json.dump({'value': value}, f)
+'''
+
+
+@pytest.fixture
+def toy_pipeline(tmp_path, monkeypatch):
+    """
+    A 'toy' job type of three python stages (load -> scale -> shift), each a subprocess
+    that records its run in the file named by TOY_RUNS; TOY_FAIL makes one stage fail.
+    Returns a function listing the stages run so far.
+    """
+    from app.tasks import pipeline, warm_pool
+    from app.tasks.pipeline import Stage
+
+    scripts = tmp_path / 'scripts'
+    scripts.mkdir()
+    (scripts / 'toy.py').write_text(TOY_SCRIPT)
+    runs = tmp_path / 'runs.txt'
+    runs.write_text('')
+
+    monkeypatch.setattr(pipeline, 'STAGE_DIR', str(tmp_path / 'stages'))
+    monkeypatch.setattr(pipeline, 'SCRIPTS_DIR', str(scripts))
+    monkeypatch.setattr(warm_pool, 'WARM_POOL_SIZE', 0)
+    monkeypatch.setattr(warm_pool, '_pool', None)
+    monkeypatch.setenv('TOY_RUNS', str(runs))
+    monkeypatch.delenv('TOY_FAIL', raising=False)
+
+    for stage in [
+        Stage('toy_load', 'python', 'toy.py'),
+        Stage('toy_scale', 'python', 'toy.py', ('toy_load',), {'scale': 2}),
+        Stage('toy_shift', 'python', 'toy.py', ('toy_scale',), {'offset': 0}),
+    ]:
+        monkeypatch.setitem(pipeline.STAGES, stage.name, stage)
+    monkeypatch.setitem(pipeline.JOB_PIPELINES, 'toy', ['toy_load', 'toy_scale', 'toy_shift'])
+    monkeypatch.setitem(pipeline.PUBLISHED_STAGES, 'toy', ['toy_shift'])
+    monkeypatch.setitem(pipeline.SUMMARY_STAGE, 'toy', 'toy_shift')
+
+    return lambda: runs.read_text().split()
+
+
+@pytest.fixture
+def worker_db(database_url, monkeypatch):
+    """Points the worker's per-process engine at the test database"""
+    from app.core.process_control import reset_job_processes
+    from app.tasks import analysis
+
+    monkeypatch.setattr(analysis, 'DATABASE_URL', database_url)
+    monkeypatch.setattr(analysis, '_engine', None)
+    monkeypatch.setattr(analysis, '_SessionLocal', None)
+    yield
+    analysis.dispose_worker_db()
+    # A failed run leaves the process refusing new stages until its next job starts
+    reset_job_processes()
+
+
+@pytest.fixture
+def worker(worker_db, tmp_path, monkeypatch):
+    """Runs run_analysis in-process against the test database, as a delivery with the given task id"""
+    from app.tasks import analysis
+
+    monkeypatch.setattr(analysis, 'OUTPUT_ROOT', str(tmp_path / 'outputs'))
+
+    def run(job_id, task_id):
+        return analysis.run_analysis.apply(args=[job_id], task_id=task_id)
+    return run
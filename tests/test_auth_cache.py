@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from app.core import security
+from app.core.security import create_access_token, get_current_user, user_cache_key
+from app.models.user import SubscriptionTier, User
+
+
+@pytest.fixture
+def redis(redis_server, monkeypatch):
+    import redis.asyncio
+
+    server = {key: redis_server.connection_pool.connection_kwargs[key] for key in ('host', 'port', 'db')}
+    monkeypatch.setattr(security, 'get_redis', lambda: redis_server)
+    # A client per call, as each test request runs on its own event loop
+    monkeypatch.setattr(security, 'get_async_redis', lambda: redis.asyncio.Redis(**server))
+    return redis_server
+
+
+def authenticate(async_sessions, username):
+    async def run():
+        async with async_sessions() as session:
+            user = await get_current_user(create_access_token({'sub': username}), db=session)
+            return {'id': user.id, 'tier': user.subscription_tier}
+    return asyncio.run(run())
+
+
+def test_user_is_cached_without_secrets_or_usage(async_sessions, account, redis):
+    authenticate(async_sessions, account.username)
+
+    cached = json.loads(redis.get(user_cache_key(account.username)))
+    assert cached['id'] == account.id
+    assert cached['subscription_tier'] == 'pro'
+    assert not security.USER_CACHE_EXCLUDED_COLUMNS & set(cached)
+    assert 0 < redis.ttl(user_cache_key(account.username)) <= security.USER_CACHE_TTL_SECONDS
+
+
+def test_cached_user_is_served_without_reading_the_table(db, async_sessions, account, redis):
+    authenticate(async_sessions, account.username)
+    # Bypasses the ORM, so nothing invalidates the cache
+    db.execute(text("UPDATE users SET subscription_tier = 'FREE' WHERE id = :id"), {'id': account.id})
+    db.commit()
+
+    assert authenticate(async_sessions, account.username)['tier'] == SubscriptionTier.PRO
+
+
+def test_orm_updates_invalidate_the_cached_user(db, async_sessions, account, redis):
+    authenticate(async_sessions, account.username)
+    account.subscription_tier = SubscriptionTier.ENTERPRISE
+    db.commit()
+
+    assert redis.get(user_cache_key(account.username)) is None
+    assert authenticate(async_sessions, account.username)['tier'] == SubscriptionTier.ENTERPRISE
+
+    async def rename():
+        async with async_sessions() as session:
+            user = await session.get(User, account.id)
+            user.username = 'renamed'
+            await session.commit()
+
+    asyncio.run(rename())
+    assert redis.get(user_cache_key('test')) is None
+    with pytest.raises(HTTPException) as error:
+        authenticate(async_sessions, 'test')
+    assert error.value.status_code == 401
+
+
+def test_usage_is_never_served_from_the_cache(db, async_sessions, account, redis):
+    authenticate(async_sessions, account.username)
+    db.execute(text('UPDATE users SET storage_used_mb = 7 WHERE id = :id'), {'id': account.id})
+    db.commit()
+
+    async def run():
+        async with async_sessions() as session:
+            user = await get_current_user(create_access_token({'sub': account.username}), db=session)
+            await security.load_usage(session, user)
+            return user.storage_used_mb
+
+    assert asyncio.run(run()) == 7
+
+
+def test_inactive_and_unknown_users_are_refused(db, async_sessions, account, redis):
+    account.is_active = False
+    db.commit()
+
+    with pytest.raises(HTTPException) as inactive:
+        authenticate(async_sessions, account.username)
+    with pytest.raises(HTTPException) as unknown:
+        authenticate(async_sessions, 'nobody')
+    with pytest.raises(HTTPException) as forged:
+        asyncio.run(get_current_user('not-a-token', db=None))
+
+    assert (inactive.value.status_code, unknown.value.status_code, forged.value.status_code) == (403, 401, 401)
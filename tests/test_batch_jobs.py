@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.api import jobs as jobs_api
+from app.core import redis_client, scheduler, tracing
+from app.core.result_cache import compute_cache_key
+from app.core.tracing import parse_traceparent
+from app.models.cache import ResultCacheEntry
+from app.models.job import AnalysisJob, JobStatus
+from app.models.upload import IngestStatus, UploadedFile, UploadStatus
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    """No Redis, and spans written under tmp_path"""
+    import redis
+    from redis.backoff import NoBackoff
+    from redis.retry import Retry
+
+    monkeypatch.setattr(redis_client, '_redis', redis.Redis(port=1, retry=Retry(NoBackoff(), 0)))
+    monkeypatch.setattr(tracing, 'LOG_DIR', str(tmp_path / 'logs'))
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    """Each call of dispatch_jobs, as (job ids, traceparents)"""
+    calls = []
+    monkeypatch.setattr(scheduler, 'dispatch_jobs',
+                        lambda jobs, traceparents: calls.append(([job.id for job in jobs], traceparents)))
+    return calls
+
+
+@pytest.fixture
+def upload(db, account, tmp_path):
+    def make(name, ingest_status=IngestStatus.READY, **values):
+        record = UploadedFile(id=name, user_id=account.id, filename=f'{name}.csv', file_path=str(tmp_path / name),
+                              status=UploadStatus.COMPLETED, total_size=10, chunk_size=10,
+                              sha256=name.ljust(64, '0'), ingest_status=ingest_status, n_cells=1000, **values)
+        db.add(record)
+        db.commit()
+        return record
+    return make
+
+
+def submit(async_sessions, account, jobs):
+    batch = jobs_api.JobBatchCreate(jobs=[
+        jobs_api.JobCreate(job_name=f'job {index}', job_type=job_type, input_file_id=file_id, parameters=parameters)
+        for index, (job_type, file_id, parameters) in enumerate(jobs)
+    ])
+
+    async def run():
+        async with async_sessions() as session:
+            return await jobs_api.create_jobs(batch, current_user=account, db=session)
+    return asyncio.run(run())
+
+
+def test_invalid_jobs_are_rejected_one_by_one(db, async_sessions, account, toy_pipeline, upload, dispatched):
+    upload('good')
+    upload('broken', ingest_status=IngestStatus.FAILED, ingest_error='no header row')
+
+    response = submit(async_sessions, account, [
+        ('toy', 'good', {}),
+        ('no_such_type', 'good', {}),
+        ('toy', 'missing', {}),
+        ('toy', 'broken', {}),
+        ('toy', 'good', {'offset': 1}),
+    ])
+
+    assert response.created == 2
+    assert [item.index for item in response.results] == [0, 1, 2, 3, 4]
+    assert [item.status_code for item in response.results] == [201, 400, 404, 422, 201]
+    assert response.results[1].error == 'Unknown job type: no_such_type'
+    assert response.results[3].error == 'Input file is not a valid count matrix: no header row'
+    assert [item.job is None for item in response.results] == [False, True, True, True, False]
+
+    jobs = db.query(AnalysisJob).order_by(AnalysisJob.id).all()
+    assert [job.id for job in jobs] == [response.results[0].job.id, response.results[4].job.id]
+    assert all(job.celery_task_id and job.queue and job.status == JobStatus.PENDING for job in jobs)
+
+
+def test_queued_jobs_are_dispatched_together_under_their_own_traces(db, async_sessions, account, toy_pipeline,
+                                                                    upload, dispatched):
+    upload('good')
+
+    response = submit(async_sessions, account, [('toy', 'good', {'offset': n}) for n in range(3)])
+
+    jobs = {job.id: job for job in db.query(AnalysisJob)}
+    assert len(dispatched) == 1
+    job_ids, traceparents = dispatched[0]
+    assert job_ids == [item.job.id for item in response.results]
+    assert [parse_traceparent(value)[0] for value in traceparents] == [jobs[job_id].trace_id for job_id in job_ids]
+    for job_id, traceparent in zip(job_ids, traceparents):
+        spans = tracing.read_trace(job_id)
+        assert [(entry['name'], entry['span_id']) for entry in spans] == \
+            [('api.create_jobs', parse_traceparent(traceparent)[1])]
+        assert spans[0]['attributes']['batch_size'] == 3
+
+
+def test_cached_results_complete_without_being_queued(db, async_sessions, account, toy_pipeline, upload,
+                                                      dispatched, tmp_path):
+    good = upload('good')
+    (tmp_path / 'outputs' / 'job_1').mkdir(parents=True)
+    db.add(ResultCacheEntry(user_id=account.id, cache_key=compute_cache_key(good.sha256, 'toy', {}), job_type='toy',
+                            input_sha256=good.sha256, script_version='v', output_directory=str(tmp_path / 'outputs' / 'job_1'),
+                            result_summary='{"value": 20.0}'))
+    db.commit()
+
+    response = submit(async_sessions, account, [('toy', 'good', {}), ('toy', 'good', {'offset': 1})])
+
+    cached, queued = (item.job for item in response.results)
+    assert (cached.status, queued.status) == ('completed', 'pending')
+    assert dispatched == [([queued.id], dispatched[0][1])]
+
+
+@pytest.mark.parametrize('size', [0, jobs_api.MAX_BATCH_JOBS + 1])
+def test_batch_size_is_bounded(async_sessions, account, dispatched, size):
+    with pytest.raises(HTTPException) as error:
+        submit(async_sessions, account, [('toy', 'good', {})] * size)
+
+    assert error.value.status_code == 400
+    assert dispatched == []
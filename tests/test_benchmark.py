@@ -0,0 +1,133 @@
+import json
+
+import numpy as np
+import pytest
+
+from app import benchmark
+from app.benchmark import (
+    compare_reports, flatten_metrics, generate_counts, plan_requests, summarize_latencies, write_h5ad
+)
+from app.core import job_logs, output_store
+from app.tasks import analysis, ingest, pipeline, warm_pool
+from app.tasks.ingest import open_matrix, open_store, write_store
+
+
+def report(seconds=10.0, p95_ms=50.0, throughput_rps=100.0, status='completed'):
+    return {
+        'datasets': {'10k': {'n_cells': 10000, 'ingest_seconds': 2.0}},
+        'jobs': {'10k/clustering': {'status': status, 'seconds': seconds, 'peak_rss_mb': 800.0, 'job_id': 1}},
+        'api': {'total': {'count': 100, 'p95_ms': p95_ms, 'throughput_rps': throughput_rps}},
+    }
+
+
+def test_synthetic_counts_are_reproducible():
+    labels, blocks = generate_counts(250, seed=4)
+    again, blocks_again = generate_counts(250, seed=4)
+    other, _ = generate_counts(250, seed=5)
+
+    matrix = np.vstack([block.toarray() for _, block in blocks])
+    assert (labels == again).all()
+    assert (matrix == np.vstack([block.toarray() for _, block in blocks_again])).all()
+    assert not (labels == other).all()
+    assert matrix.shape == (250, benchmark.N_GENES)
+    assert set(labels) <= set(range(benchmark.N_CLUSTERS))
+
+
+def test_written_dataset_is_ingested_as_generated(tmp_path):
+    path = tmp_path / 'synthetic.h5ad'
+
+    labels = write_h5ad(str(path), 120, seed=1)
+
+    write_store(str(tmp_path / 'store'), open_matrix(str(path), path.name))
+    store = open_store(str(tmp_path / 'store'))
+    generated, blocks = generate_counts(120, seed=1)
+    assert (store.cells(0, 120).toarray() == np.vstack([block.toarray() for _, block in blocks])).all()
+    assert store.cell_names()[:2] == ['cell_1', 'cell_2']
+    assert store.gene_names()[:2] == ['MT-1', 'MT-2']
+    assert labels == [f'type_{label}' for label in generated]
+    assert not (tmp_path / 'synthetic.h5ad.tmp').exists()
+
+
+def test_request_plan_is_deterministic_and_follows_the_mix():
+    plan = plan_requests(2000, [7, 8], 'upload-1')
+
+    assert plan == plan_requests(2000, [7, 8], 'upload-1')
+    shares = {name: sum(1 for request in plan if request[0] == name) / len(plan) for name, _ in benchmark.API_MIX}
+    assert all(abs(shares[name] - weight) < 0.05 for name, weight in benchmark.API_MIX)
+    bodies = [body for name, _, _, body in plan if name == 'create_job']
+    assert len({json.dumps(body) for body in bodies}) == len(bodies)
+    assert {path for name, _, path, _ in plan if name == 'get_job_results'} == \
+        {'/api/jobs/7/results', '/api/jobs/8/results'}
+
+
+def test_latency_summary():
+    summary = summarize_latencies([0.001 * n for n in range(1, 101)], errors=2, elapsed=4.0)
+
+    assert summary['count'] == 100
+    assert summary['errors'] == 2
+    assert summary['p50_ms'] == pytest.approx(51)
+    assert summary['p99_ms'] == pytest.approx(99)
+    assert summary['throughput_rps'] == 25.0
+    assert summarize_latencies([], errors=0, elapsed=0)['p95_ms'] == 0.0
+
+
+def test_only_comparable_metrics_of_completed_jobs_are_flattened():
+    metrics = flatten_metrics(report())
+
+    assert metrics == {
+        'datasets.10k.ingest_seconds': 2.0,
+        'jobs.10k/clustering.seconds': 10.0,
+        'jobs.10k/clustering.peak_rss_mb': 800.0,
+        'api.total.p95_ms': 50.0,
+        'api.total.throughput_rps': 100.0,
+    }
+    assert 'jobs.10k/clustering.seconds' not in flatten_metrics(report(status='failed'))
+
+
+def test_regressions_beyond_the_tolerance_are_reported_in_either_direction():
+    baseline = report()
+
+    assert compare_reports(report(seconds=11.5, p95_ms=40.0, throughput_rps=90.0), baseline, 0.2) == []
+    regressions = compare_reports(report(seconds=13.0, throughput_rps=70.0), baseline, 0.2)
+    assert regressions == [
+        'jobs.10k/clustering.seconds: 10 -> 13 (+30%)',
+        'api.total.throughput_rps: 100 -> 70 (-30%)',
+    ]
+    # A job that failed now has no timing to compare
+    assert compare_reports(report(seconds=99.0, status='failed'), baseline, 0.2) == []
+
+
+@pytest.mark.parametrize('argv, message', [
+    (['--scales', '10k,2m'], 'Unknown scales: 2m'),
+    (['--api-requests', '0'], 'Set DATABASE_URL'),
+])
+def test_command_line_is_checked_before_anything_runs(argv, message, monkeypatch, capsys):
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+
+    with pytest.raises(SystemExit) as exit:
+        benchmark.main(argv)
+
+    assert exit.value.code == 2
+    assert message in capsys.readouterr().err
+
+
+def test_clustering_job_is_measured_end_to_end(db, worker, tmp_path, monkeypatch):
+    for module, name, subdir in [(ingest, 'INGEST_DIR', 'stores'), (pipeline, 'STAGE_DIR', 'stages'),
+                                 (job_logs, 'LOG_DIR', 'logs'), (output_store, 'BLOB_DIR', 'blobs')]:
+        monkeypatch.setattr(module, name, str(tmp_path / subdir))
+    monkeypatch.setattr(warm_pool, 'WARM_POOL_SIZE', 0)
+    monkeypatch.setattr(warm_pool, '_pool', None)
+    monkeypatch.setattr(analysis, 'admit_job', lambda analysis_job: True)
+    monkeypatch.setattr(analysis, 'release_job', lambda job_id: None)
+    path = tmp_path / 'synthetic.h5ad'
+    write_h5ad(str(path), 300, seed=2)
+
+    user = benchmark.ensure_user(db)
+    upload, ingest_seconds = benchmark.register_upload(db, user, str(path))
+    result = benchmark.run_job(db, user, upload, 'clustering', {'engine': 'native', 'min_genes': 10})
+
+    assert upload.n_cells == 300 and ingest_seconds > 0
+    assert result['status'] == 'completed', result.get('error')
+    assert result['seconds'] > 0
+    assert [stage['stage'] for stage in result['stages']] == ['cluster_native', 'embed_native']
+    assert benchmark.ensure_user(db).id == user.id
@@ -0,0 +1,111 @@
+import json
+import shutil
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.core import scheduler
+from app.models.job import AnalysisJob, JobStatus
+from app.tasks import analysis
+from app.tasks.pipeline import CHECKPOINT_DIR, StageFailed, run_pipeline
+
+SHA = 'e' * 64
+
+
+@pytest.fixture
+def counts(tmp_path):
+    path = tmp_path / 'counts.bin'
+    path.write_bytes(b'x' * 10)
+    return str(path)
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    jobs = []
+    monkeypatch.setattr(scheduler, 'dispatch_job', lambda job, traceparent=None: jobs.append(job.id))
+    return jobs
+
+
+def stale(minutes=60):
+    return datetime.utcnow() - timedelta(minutes=minutes)
+
+
+def reload(db, job):
+    db.expire_all()
+    return db.get(AnalysisJob, job.id)
+
+
+def test_checkpointed_stages_survive_eviction_of_the_shared_artifacts(toy_pipeline, counts, tmp_path, monkeypatch):
+    output_dir = tmp_path / 'job'
+    checkpointed = []
+    monkeypatch.setenv('TOY_FAIL', 'toy_scale')
+    with pytest.raises(StageFailed):
+        run_pipeline('toy', counts, SHA, {}, str(output_dir), on_checkpoint=lambda *stage: checkpointed.append(stage[0]))
+    assert checkpointed == ['toy_load']
+
+    # The idle shared artifact was evicted while the job waited to be resumed
+    shutil.rmtree(tmp_path / 'stages' / 'toy_load')
+    monkeypatch.delenv('TOY_FAIL')
+    assert run_pipeline('toy', counts, SHA, {}, str(output_dir)) == {'value': 20.0}
+
+    assert toy_pipeline() == ['toy_load', 'toy_scale', 'toy_scale', 'toy_shift']
+    assert json.loads((output_dir / 'stages.json').read_text())[0]['reused']
+    assert not (output_dir / CHECKPOINT_DIR).exists()
+
+
+def test_orphaned_job_is_requeued_and_resumes_from_its_checkpoints(
+        db, make_job, toy_pipeline, worker, counts, tmp_path, dispatched, monkeypatch):
+    monkeypatch.setattr(analysis, 'admit_job', lambda analysis_job: True)
+    monkeypatch.setattr(analysis, 'release_job', lambda job_id: None)
+    job = make_job(job_type='toy', input_file_path=counts, parameters='{}', celery_task_id='first')
+
+    # The first run gets as far as toy_scale, then its worker is lost
+    monkeypatch.setenv('TOY_FAIL', 'toy_scale')
+    worker(job.id, 'first')
+    job = reload(db, job)
+    assert [entry['stage'] for entry in json.loads(job.checkpoints)] == ['toy_load']
+    job.status, job.heartbeat_at = JobStatus.RUNNING, stale()
+    db.commit()
+    shutil.rmtree(tmp_path / 'stages' / 'toy_load')
+
+    assert analysis.reap_orphaned_jobs() == {'requeued': [job.id], 'failed': []}
+    job = reload(db, job)
+    assert (job.status, job.resume_count) == (JobStatus.PENDING, 1)
+    assert job.celery_task_id != 'first'
+    assert dispatched == [job.id]
+
+    # A late redelivery of the lost task is ignored; the requeued one resumes
+    monkeypatch.delenv('TOY_FAIL')
+    assert worker(job.id, 'first').result['status'] == 'superseded'
+    assert worker(job.id, job.celery_task_id).result['status'] == 'completed'
+    assert toy_pipeline() == ['toy_load', 'toy_scale', 'toy_scale', 'toy_shift']
+    assert json.loads(reload(db, job).result_summary) == {'value': 20.0}
+
+
+def test_reaper_leaves_live_jobs_and_gives_up_after_max_resumes(db, make_job, worker_db, dispatched, monkeypatch):
+    monkeypatch.setattr(analysis, 'MAX_RESUMES', 2)
+    live = make_job(status=JobStatus.RUNNING, started_at=stale(), heartbeat_at=datetime.utcnow())
+    never_beat = make_job(status=JobStatus.RUNNING, started_at=stale())
+    exhausted = make_job(status=JobStatus.RUNNING, started_at=stale(), heartbeat_at=stale(), resume_count=2)
+    make_job(status=JobStatus.PENDING, heartbeat_at=stale())
+
+    assert analysis.reap_orphaned_jobs() == {'requeued': [never_beat.id], 'failed': [exhausted.id]}
+
+    assert reload(db, live).status == JobStatus.RUNNING
+    exhausted = reload(db, exhausted)
+    assert exhausted.status == JobStatus.FAILED
+    assert exhausted.error_message == 'Lost its worker 3 times; giving up'
+    assert dispatched == [never_beat.id]
+
+
+def test_redelivery_of_a_job_that_still_heartbeats_is_retried_later(db, make_job, worker, monkeypatch):
+    from celery.exceptions import Retry
+
+    retries = []
+    monkeypatch.setattr(analysis.run_analysis, 'retry', lambda **options: retries.append(options) or Retry())
+    job = make_job(status=JobStatus.RUNNING, started_at=stale(), heartbeat_at=datetime.utcnow(), celery_task_id='task')
+
+    worker(job.id, 'task')
+
+    assert [options['countdown'] for options in retries] == [analysis.HEARTBEAT_TIMEOUT_SECONDS]
+    assert reload(db, job).status == JobStatus.RUNNING
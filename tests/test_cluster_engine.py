@@ -0,0 +1,138 @@
+import json
+
+import numpy as np
+import pytest
+
+from app.tasks import cluster_engine
+from app.tasks.cluster_engine import (
+    CellMatrix, knn_graph, louvain, randomized_pca, run_clustering, select_genes, snn_graph,
+)
+from app.tasks.de_engine import select_cells
+from app.tasks.ingest import open_store
+
+N_PER_CLUSTER, N_CLUSTERS, N_GENES = 50, 3, 90
+QC = {'min_genes': 0, 'min_cells': 0, 'max_percent_mt': 100}
+
+
+@pytest.fixture
+def counts():
+    """Each of three cell groups expresses its own block of 30 genes strongly"""
+    rng = np.random.default_rng(5)
+    counts = rng.poisson(0.5, size=(N_PER_CLUSTER * N_CLUSTERS, N_GENES)).astype(np.float64)
+    for c in range(N_CLUSTERS):
+        block = slice(c * N_PER_CLUSTER, (c + 1) * N_PER_CLUSTER)
+        counts[block, c * 30:(c + 1) * 30] += rng.poisson(6.0, size=(N_PER_CLUSTER, 30))
+    return counts
+
+
+@pytest.fixture
+def store(counts, sparse_store):
+    return sparse_store(counts)
+
+
+def standardized(store):
+    """The matrix CellMatrix applies lazily, built densely; returns (matrix, CellMatrix)"""
+    store = open_store(store)
+    cells, scales = select_cells(store, 0, 100)
+    genes, mean, std = select_genes(store, cells, scales, min_cells=0, n_hvg=N_GENES)
+    matrix = CellMatrix(store, cells, scales, genes, mean, std)
+    dense = np.vstack([matrix.block(start, stop).toarray() for start, stop in matrix.blocks])
+    return (dense - mean) / std, matrix
+
+
+def test_blocked_products_match_the_dense_standardized_matrix(store, monkeypatch):
+    monkeypatch.setattr(cluster_engine, 'CELL_BLOCK', 16)
+    dense, matrix = standardized(store)
+    rng = np.random.default_rng(0)
+    m, q = rng.normal(size=(matrix.shape[1], 4)), rng.normal(size=(matrix.shape[0], 4))
+
+    assert len(matrix.blocks) == 10
+    assert np.allclose(matrix.dot(m), dense @ m)
+    assert np.allclose(matrix.tdot(q), dense.T @ q)
+
+
+def test_randomized_pca_finds_the_leading_components(store):
+    dense, matrix = standardized(store)
+
+    pcs, variance = randomized_pca(matrix, 5, np.random.default_rng(0))
+
+    u, s, _ = np.linalg.svd(dense - dense.mean(axis=0), full_matrices=False)
+    assert pcs.shape == (matrix.shape[0], 5)
+    # The two group-separating components dominate and are recovered exactly
+    assert np.allclose(variance[:2], s[:2] ** 2 / (matrix.shape[0] - 1), rtol=1e-3)
+    for component in range(2):
+        cosine = abs(pcs[:, component] @ u[:, component]) / np.linalg.norm(pcs[:, component])
+        assert cosine > 0.999
+
+
+def test_neighbor_graph_matches_exact_search_when_every_list_is_probed(monkeypatch):
+    monkeypatch.setattr(cluster_engine, 'KNN_NPROBE', 1000)
+    monkeypatch.setattr(cluster_engine, 'CELL_BLOCK', 64)
+    points = np.random.default_rng(2).normal(size=(200, 6)).astype(np.float32)
+
+    neighbors = knn_graph(points, 8, np.random.default_rng(0))
+
+    distances = ((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2)
+    np.fill_diagonal(distances, np.inf)
+    assert (np.sort(neighbors, axis=1) == np.sort(np.argsort(distances, axis=1)[:, :8], axis=1)).all()
+
+
+def test_shared_neighbor_weights_are_jaccard_overlaps():
+    # Cells 0-2 are mutual neighbors; cell 3 only points into them
+    neighbors = np.array([[1, 2], [0, 2], [0, 1], [0, 1]])
+
+    graph = snn_graph(neighbors).toarray()
+
+    assert np.allclose(graph, graph.T)
+    assert (np.diag(graph) == 0).all()
+    assert graph[0, 1] == pytest.approx(1.0)  # {0, 1, 2} on both sides
+    assert graph[3, 0] == pytest.approx(2 / 4)  # {0, 1, 3} and {0, 1, 2}
+    assert graph[2, 3] == 0  # not a kNN edge in either direction
+
+
+def test_louvain_separates_disconnected_cliques():
+    import scipy.sparse as sp
+
+    sizes = [12, 8, 5]
+    graph = sp.block_diag([np.ones((n, n)) - np.eye(n) for n in sizes]).tocsr()
+
+    clusters = louvain(graph, 1.0, np.random.default_rng(0))
+
+    # Cluster 0 is the largest
+    assert clusters.tolist() == [0] * 12 + [1] * 8 + [2] * 5
+
+
+def test_clustering_recovers_the_cell_groups_and_writes_its_outputs(store, tmp_path):
+    output_dir = tmp_path / 'cluster'
+
+    summary = run_clustering(store, str(output_dir), n_hvg=60, n_pcs=10, n_neighbors=10, **QC)
+
+    rows = (output_dir / 'clusters.csv').read_text().splitlines()
+    assert rows[0] == 'cell,cluster'
+    clusters = np.array([int(row.split(',')[1]) for row in rows[1:]])
+    groups = clusters.reshape(N_CLUSTERS, N_PER_CLUSTER)
+    assert all(len(set(group)) == 1 for group in groups)
+    assert len({group[0] for group in groups}) == N_CLUSTERS
+
+    assert json.loads((output_dir / 'summary.json').read_text()) == summary
+    assert summary['n_cells'] == N_PER_CLUSTER * N_CLUSTERS
+    assert summary['n_variable_genes'] == 60
+    assert summary['n_clusters'] == N_CLUSTERS
+    assert summary['cluster_sizes'] == {str(c): N_PER_CLUSTER for c in range(N_CLUSTERS)}
+    assert len(summary['variance_explained']) == summary['n_pcs'] == 10
+    assert np.load(output_dir / 'pcs.npy').shape == (150, 10)
+    assert np.load(output_dir / 'neighbors.npy').shape == (150, 10)
+    assert len((output_dir / 'variable_genes.txt').read_text().splitlines()) == 60
+
+
+def test_cell_block_size_does_not_change_the_clustering(store, tmp_path, monkeypatch):
+    run_clustering(store, str(tmp_path / 'whole'), n_pcs=10, n_neighbors=10, **QC)
+    monkeypatch.setattr(cluster_engine, 'CELL_BLOCK', 16)
+    run_clustering(store, str(tmp_path / 'blocks'), n_pcs=10, n_neighbors=10, **QC)
+
+    assert (tmp_path / 'whole' / 'clusters.csv').read_text() == (tmp_path / 'blocks' / 'clusters.csv').read_text()
+
+
+def test_too_few_cells_are_refused(store, tmp_path):
+    with pytest.raises(ValueError, match='cells pass QC'):
+        run_clustering(store, str(tmp_path / 'cluster'), n_neighbors=200, **QC)
@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+from fastapi import Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.api import jobs as jobs_api
+from app.core import database
+from app.core.database import async_database_url, engine_options
+
+
+@pytest.mark.parametrize('url, async_url', [
+    ('postgresql://u:p@db:5432/scrna', 'postgresql+asyncpg://u:p@db:5432/scrna'),
+    ('postgres://u:p@db/scrna', 'postgresql+asyncpg://u:p@db/scrna'),
+    ('postgresql+psycopg2://u:p@db/scrna', 'postgresql+asyncpg://u:p@db/scrna'),
+    ('sqlite:////tmp/bench.db', 'sqlite+aiosqlite:////tmp/bench.db'),
+    ('postgresql+asyncpg://u:p@db/scrna', 'postgresql+asyncpg://u:p@db/scrna'),
+])
+def test_database_url_is_served_by_an_async_driver(url, async_url):
+    assert async_database_url(url) == async_url
+
+
+def test_postgres_connections_are_pooled_with_a_statement_timeout(monkeypatch):
+    monkeypatch.setattr(database, 'DB_STATEMENT_TIMEOUT_MS', 5000)
+
+    options = engine_options('postgresql://u:p@db/scrna')
+
+    assert options['pool_size'] == database.DB_POOL_SIZE
+    assert options['max_overflow'] == database.DB_MAX_OVERFLOW
+    assert options['connect_args'] == {'server_settings': {'statement_timeout': '5000'}}
+    assert engine_options('sqlite:////tmp/bench.db') == {}
+
+
+def test_concurrent_requests_each_get_their_own_session(async_sessions, account, make_job, monkeypatch):
+    monkeypatch.setattr(database, 'AsyncSessionLocal', async_sessions)
+    job_ids = [make_job().id for _ in range(3)]
+
+    async def request():
+        dependency = database.get_db()
+        session = await anext(dependency)
+        assert isinstance(session, AsyncSession)
+        try:
+            jobs = await jobs_api.list_jobs(Response(), cursor=None, limit=100, status=None,
+                                            current_user=account, db=session)
+            return session, [job.id for job in jobs]
+        finally:
+            await dependency.aclose()
+
+    async def run():
+        return await asyncio.gather(*(request() for _ in range(10)))
+
+    results = asyncio.run(run())
+    assert len({id(session) for session, _ in results}) == 10
+    assert all(listed == job_ids[::-1] for _, listed in results)
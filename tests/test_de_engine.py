@@ -0,0 +1,126 @@
+import csv
+import gzip
+
+import numpy as np
+import pytest
+from scipy import stats
+
+from app.tasks import de_engine
+from app.tasks.de_engine import benjamini_hochberg, run_de
+
+N_CELLS, N_GENES = 60, 30
+QC = {'min_genes': 0, 'min_cells': 0, 'max_percent_mt': 100}
+
+
+@pytest.fixture
+def counts():
+    """Small integer counts (many ties and zeros); the first 5 genes are up in the first 25 cells"""
+    rng = np.random.default_rng(3)
+    counts = rng.poisson(1.0, size=(N_CELLS, N_GENES)).astype(np.float64)
+    counts[:25, :5] += rng.poisson(6.0, size=(25, 5))
+    counts[:, -1] += 1  # no empty cells
+    counts[:, 5] = 0  # a gene detected nowhere
+    return counts
+
+
+@pytest.fixture
+def store(counts, sparse_store):
+    return sparse_store(counts)
+
+
+def log_normalized(counts):
+    return np.log1p(counts * (de_engine.TARGET_SUM / counts.sum(axis=1, keepdims=True)))
+
+
+def read_results(output_dir):
+    with open(output_dir / 'de_results.csv', newline='') as f:
+        rows = list(csv.DictReader(f))
+    return {(row['group'], int(row['gene'].split('_')[1])): row for row in rows}
+
+
+def column(rows, group, name):
+    return np.array([float(rows[(group, g)][name]) for g in range(N_GENES)])
+
+
+def names(cells):
+    return [f'cell_{c}' for c in cells]
+
+
+@pytest.mark.parametrize('test_method, reference', [
+    ('wilcoxon', lambda x, y: stats.mannwhitneyu(x, y, use_continuity=True, method='asymptotic')),
+    ('t_test', lambda x, y: stats.ttest_ind(x, y, equal_var=False)),
+])
+def test_two_group_tests_match_scipy(counts, store, tmp_path, test_method, reference):
+    group1, group2 = range(0, 25), range(25, 50)  # the last 10 cells are not compared
+
+    summary = run_de(store, str(tmp_path / 'de'), names(group1), names(group2), test_method, workers=1, **QC)
+
+    rows = read_results(tmp_path / 'de')
+    values = log_normalized(counts)
+    expected = [reference(values[list(group1), g], values[list(group2), g]) for g in range(N_GENES)]
+    tested = [g for g in range(N_GENES) if g != 5]
+    assert np.allclose(column(rows, 'group1', 'statistic')[tested], [expected[g].statistic for g in tested], rtol=1e-5)
+    assert np.allclose(column(rows, 'group1', 'p_val')[tested], [expected[g].pvalue for g in tested], rtol=1e-4)
+    assert float(rows[('group1', 5)]['p_val']) == 1.0
+    assert (column(rows, 'group1', 'p_val_adj')[:5] < de_engine.SIGNIFICANCE).all()
+    assert summary['n_cells'] == 50
+
+
+def test_fold_change_and_detection_rates(counts, store, tmp_path):
+    run_de(store, str(tmp_path / 'de'), names(range(25)), [], 'wilcoxon', workers=1, **QC)
+
+    rows = read_results(tmp_path / 'de')
+    expression = np.expm1(log_normalized(counts))
+    first, rest = expression[:25], expression[25:]
+    fold_change = np.log2(first.mean(axis=0) + 1) - np.log2(rest.mean(axis=0) + 1)
+    assert np.allclose(column(rows, 'group1', 'avg_log2FC'), fold_change, rtol=1e-5, atol=1e-6)
+    assert np.allclose(column(rows, 'group1', 'pct_1'), (first > 0).mean(axis=0), rtol=1e-5)
+    assert np.allclose(column(rows, 'group1', 'pct_2'), (rest > 0).mean(axis=0), rtol=1e-5)
+
+
+def test_every_cluster_is_tested_against_the_rest_in_one_pass(counts, store, tmp_path):
+    labels = tmp_path / 'clusters.csv.gz'
+    clusters = {c: 'a' if c < 25 else ('b' if c < 45 else 'c') for c in range(55)}  # 5 cells unlabelled
+    with gzip.open(labels, 'wt') as f:
+        f.write('cell,cluster\n' + ''.join(f'cell_{c},{cluster}\n' for c, cluster in clusters.items()))
+
+    summary = run_de(store, str(tmp_path / 'de'), [], [], 'wilcoxon', labels_path=str(labels), workers=1, **QC)
+
+    rows = read_results(tmp_path / 'de')
+    values = log_normalized(counts)[:55]
+    for group in 'abc':
+        inside = np.array([clusters[c] == group for c in range(55)])
+        expected = [stats.mannwhitneyu(values[inside, g], values[~inside, g], method='asymptotic').pvalue
+                    for g in range(N_GENES) if g != 5]
+        assert np.allclose(np.delete(column(rows, group, 'p_val'), 5), expected, rtol=1e-4)
+    assert [c['group'] for c in summary['comparisons']] == ['a', 'b', 'c']
+    assert [c['n_cells'] for c in summary['comparisons']] == [25, 20, 10]
+
+
+def test_process_pool_gives_the_same_results(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(de_engine, 'GENE_BLOCK', 7)
+
+    run_de(store, str(tmp_path / 'one'), names(range(25)), [], 't_test', workers=1, **QC)
+    run_de(store, str(tmp_path / 'pool'), names(range(25)), [], 't_test', workers=3, **QC)
+
+    assert (tmp_path / 'one' / 'de_results.csv').read_text() == (tmp_path / 'pool' / 'de_results.csv').read_text()
+
+
+def test_genes_detected_in_too_few_cells_are_not_reported(counts, store, tmp_path):
+    run_de(store, str(tmp_path / 'de'), names(range(25)), [], 'wilcoxon', workers=1,
+           min_genes=0, min_cells=1, max_percent_mt=100)
+
+    assert ('group1', 5) not in read_results(tmp_path / 'de')
+
+
+def test_adjusted_p_values_match_scipy():
+    p_values = np.random.default_rng(0).uniform(size=200) ** 3
+
+    assert np.allclose(benjamini_hochberg(p_values), stats.false_discovery_control(p_values))
+
+
+def test_groups_without_cells_are_refused(store, tmp_path):
+    with pytest.raises(ValueError, match='Every compared group needs cells'):
+        run_de(store, str(tmp_path / 'de'), ['no_such_cell'], [], 'wilcoxon', workers=1, **QC)
+    with pytest.raises(ValueError, match='Unsupported test_method'):
+        run_de(store, str(tmp_path / 'de'), names(range(25)), [], 'negbinom', workers=1, **QC)
@@ -0,0 +1,133 @@
+import gzip
+import io
+import json
+import zipfile
+from datetime import datetime
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api import jobs as jobs_api
+from app.core import job_outputs, output_store
+from app.core.database import get_db
+from app.core.job_outputs import build_manifest
+from app.core.output_store import store_outputs
+from app.core.security import get_current_user
+from app.models.job import JobStatus
+
+CLUSTERS = b'cell,cluster\n' + b''.join(b'cell_%d,%d\n' % (i, i % 7) for i in range(20))
+MATRIX = b''.join(b'gene_%d\t%d\t%d\n' % (i, i * 3, i * 5) for i in range(20000))
+
+
+@pytest.fixture
+def job(make_job, tmp_path, monkeypatch):
+    """A completed job whose outputs are stored as jobs store them: the matrix gzip-compressed"""
+    monkeypatch.setattr(output_store, 'BLOB_DIR', str(tmp_path / 'blobs'))
+    monkeypatch.setattr(output_store, 'COMPRESS_MIN_BYTES', 64 * 1024)
+    output_dir = tmp_path / 'outputs' / 'job_1'
+    (output_dir / 'cluster').mkdir(parents=True)
+    (output_dir / 'cluster' / 'clusters.csv').write_bytes(CLUSTERS)
+    (output_dir / 'matrix.tsv').write_bytes(MATRIX)
+    manifest = store_outputs(str(output_dir), build_manifest(str(output_dir)))
+    return make_job(status=JobStatus.COMPLETED, output_directory=str(output_dir),
+                    result_manifest=json.dumps(manifest), result_summary='{"n_clusters": 7}')
+
+
+@pytest.fixture
+def client(async_sessions, account):
+    app = FastAPI()
+    app.include_router(jobs_api.router, prefix='/api/jobs')
+
+    async def session():
+        async with async_sessions() as db:
+            yield db
+    app.dependency_overrides[get_db] = session
+    app.dependency_overrides[get_current_user] = lambda: account
+    with TestClient(app) as client:
+        yield client
+
+
+def test_results_are_listed_from_the_manifest(client, job):
+    results = client.get(f'/api/jobs/{job.id}/results').json()
+
+    assert [(f['filename'], f['size']) for f in results['output_files']] == \
+        [('matrix.tsv', len(MATRIX)), ('cluster/clusters.csv', len(CLUSTERS))]
+    assert results['stored_size'] < results['total_size'] == len(MATRIX) + len(CLUSTERS)
+    assert results['output_files'][1]['download_url'] == f'/api/jobs/{job.id}/download/cluster/clusters.csv'
+
+
+def test_file_is_downloaded_with_validators(client, job):
+    url = f'/api/jobs/{job.id}/download/cluster/clusters.csv'
+    response = client.get(url)
+
+    assert response.status_code == 200
+    assert response.content == CLUSTERS
+    assert response.headers['accept-ranges'] == 'bytes'
+    assert client.get(url, headers={'If-None-Match': response.headers['etag']}).status_code == 304
+
+
+def test_range_requests_resume_a_download(client, job):
+    url = f'/api/jobs/{job.id}/download/cluster/clusters.csv'
+    etag = client.get(url).headers['etag']
+
+    part = client.get(url, headers={'Range': 'bytes=5-', 'If-Range': etag})
+    stale = client.get(url, headers={'Range': 'bytes=5-', 'If-Range': '"old"'})
+    beyond = client.get(url, headers={'Range': f'bytes={len(CLUSTERS)}-'})
+
+    assert part.status_code == 206
+    assert part.content == CLUSTERS[5:]
+    assert part.headers['content-range'] == f'bytes 5-{len(CLUSTERS) - 1}/{len(CLUSTERS)}'
+    assert (stale.status_code, stale.content) == (200, CLUSTERS)
+    assert beyond.status_code == 416
+    assert beyond.headers['content-range'] == f'bytes */{len(CLUSTERS)}'
+
+
+def test_compressed_file_is_sent_as_stored_only_to_clients_that_accept_gzip(client, job):
+    url = f'/api/jobs/{job.id}/download/matrix.tsv'
+
+    packed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    plain = client.get(url, headers={'Accept-Encoding': 'identity'})
+    tail = client.get(url, headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=-10'})
+
+    assert packed.headers['content-encoding'] == 'gzip'
+    assert packed.content == MATRIX  # decoded by the client
+    assert packed.headers['etag'] != plain.headers['etag']
+    assert 'content-encoding' not in plain.headers
+    assert plain.content == MATRIX
+    assert plain.headers['vary'] == 'Accept-Encoding'
+    assert (tail.status_code, tail.content) == (206, MATRIX[-10:])
+
+
+def test_unlisted_files_are_not_served(client, job):
+    for name in ('missing.csv', '../job_2/matrix.tsv', 'matrix.tsv.gz'):
+        assert client.get(f'/api/jobs/{job.id}/download/{name}').status_code == 404
+
+
+def test_downloads_are_handed_to_nginx_when_configured(client, job, tmp_path, monkeypatch):
+    monkeypatch.setattr(job_outputs, 'OUTPUT_ROOT', str(tmp_path / 'outputs'))
+    monkeypatch.setattr(job_outputs, 'DOWNLOAD_ACCEL_PREFIX', '/protected-outputs/')
+
+    response = client.get(f'/api/jobs/{job.id}/download/cluster/clusters.csv')
+
+    assert response.headers['x-accel-redirect'] == '/protected-outputs/job_1/cluster/clusters.csv'
+    assert response.content == b''
+
+
+def test_archive_streams_every_output_uncompressed(client, job):
+    response = client.get(f'/api/jobs/{job.id}/download.zip')
+
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == ['matrix.tsv', 'cluster/clusters.csv']
+    assert archive.read('matrix.tsv') == MATRIX
+    assert archive.read('cluster/clusters.csv') == CLUSTERS
+    assert gzip.decompress(open(f'{job.output_directory}/matrix.tsv.gz', 'rb').read()) == MATRIX
+
+
+def test_outputs_removed_by_retention_are_gone(client, db, job):
+    job.outputs_deleted_at = datetime.utcnow()
+    db.commit()
+
+    assert client.get(f'/api/jobs/{job.id}/download/matrix.tsv').status_code == 410
+    assert client.get(f'/api/jobs/{job.id}/download.zip').status_code == 410
+    assert client.get(f'/api/jobs/{job.id}/results').json()['output_files'] == []
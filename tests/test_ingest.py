@@ -0,0 +1,149 @@
+import gzip
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from app.models.upload import IngestStatus, UploadedFile, UploadStatus
+from app.tasks import analysis, ingest
+from app.tasks.ingest import IngestError, open_matrix, open_store, write_store
+
+
+def write_mtx(path, matrix, entries=None):
+    """10x-style MatrixMarket (genes x cells) of a cells x genes matrix"""
+    coo = matrix.T.tocoo()
+    entries = entries if entries is not None else list(zip(coo.row + 1, coo.col + 1, coo.data))
+    lines = ['%%MatrixMarket matrix coordinate integer general', '% comment',
+             f'{coo.shape[0]} {coo.shape[1]} {len(entries)}']
+    lines += [f'{g} {c} {v:g}' for g, c, v in entries]
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def random_counts(n_cells, n_genes, seed=0):
+    rng = np.random.default_rng(seed)
+    dense = rng.poisson(0.3, size=(n_cells, n_genes)).astype(np.float64)
+    dense[3] = 0  # an empty cell
+    return sp.csr_matrix(dense)
+
+
+def build(path, filename, target):
+    write_store(str(target), open_matrix(str(path), filename))
+    return open_store(str(target))
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # Many tiny blocks exercise the spill and bucket boundaries
+    monkeypatch.setattr(ingest, 'INGEST_BLOCK_NNZ', 7)
+
+
+def test_mtx_store_matches_scipy(tmp_path):
+    matrix = random_counts(40, 25)
+    write_mtx(tmp_path / 'counts.mtx', matrix)
+
+    store = build(tmp_path / 'counts.mtx', 'counts.mtx', tmp_path / 'store')
+
+    assert (store.n_cells, store.n_genes, store.nnz) == (40, 25, matrix.nnz)
+    assert store.meta['dtype'] == 'uint16'
+    assert (store.cells(0, 40) != matrix).nnz == 0
+    assert (store.genes([24, 0, 7]) != matrix[:, [24, 0, 7]]).nnz == 0
+    assert store.cells(10, 20).has_canonical_format
+
+
+def test_mtx_duplicate_entries_are_summed(tmp_path):
+    write_mtx(tmp_path / 'dup.mtx', sp.csr_matrix((2, 3)), entries=[(1, 1, 2), (3, 2, 1), (1, 1, 5), (2, 1, 0)])
+
+    store = build(tmp_path / 'dup.mtx', 'dup.mtx', tmp_path / 'store')
+
+    expected = np.array([[7, 0, 0], [0, 0, 1]])
+    assert store.nnz == 2
+    assert np.array_equal(store.cells().toarray(), expected)
+    assert np.array_equal(store.genes([0, 1, 2]).toarray(), expected)
+
+
+def test_gzipped_csv_store_keeps_names_and_values(tmp_path):
+    matrix = random_counts(12, 9, seed=1)
+    dense = matrix.toarray().T  # genes are rows
+    dense[2, 5] = 0.5
+    lines = ['gene,' + ','.join(f'c{i}' for i in range(12))]
+    lines += [f'g{g},' + ','.join(f'{v:g}' for v in row) for g, row in enumerate(dense)]
+    with gzip.open(tmp_path / 'counts.csv.gz', 'wt') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    store = build(tmp_path / 'counts.csv.gz', 'counts.csv.gz', tmp_path / 'store')
+
+    assert store.cell_names() == [f'c{i}' for i in range(12)]
+    assert store.gene_names() == [f'g{g}' for g in range(9)]
+    assert store.meta['dtype'] == 'float32'
+    assert np.array_equal(store.cells().toarray(), dense.T)
+
+
+@pytest.mark.parametrize('body, message', [
+    ('2 2 1\n1 1 -3\n', 'negative'),
+    ('2 2 1\n3 1 1\n', 'outside'),
+    ('2 2 0\n', 'no non-zero'),
+    ('2 2 1\n1 x 1\n', 'Could not parse'),
+])
+def test_bad_mtx_is_rejected(tmp_path, body, message):
+    (tmp_path / 'bad.mtx').write_text('%%MatrixMarket matrix coordinate integer general\n' + body)
+
+    with pytest.raises(IngestError, match=message):
+        write_store(str(tmp_path / 'store'), open_matrix(str(tmp_path / 'bad.mtx'), 'bad.mtx'))
+
+
+def test_non_numeric_csv_is_rejected(tmp_path):
+    (tmp_path / 'bad.csv').write_text('gene,c1,c2\ng1,1,x\n')
+
+    with pytest.raises(IngestError, match='c2'):
+        write_store(str(tmp_path / 'store'), open_matrix(str(tmp_path / 'bad.csv'), 'bad.csv'))
+
+
+def test_unsupported_format_is_rejected(tmp_path):
+    with pytest.raises(IngestError):
+        open_matrix(str(tmp_path / 'counts.xlsx'), 'counts.xlsx')
+
+
+@pytest.fixture
+def upload(db, account, tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, 'INGEST_DIR', str(tmp_path / 'stores'))
+
+    def make(body, filename='matrix.mtx'):
+        path = tmp_path / filename
+        path.write_text(body)
+        record = UploadedFile(id=filename, user_id=account.id, filename=filename, file_path=str(path),
+                              status=UploadStatus.COMPLETED, total_size=len(body), chunk_size=len(body),
+                              sha256=filename.ljust(64, '0'), ingest_status=IngestStatus.PENDING)
+        db.add(record)
+        db.commit()
+        return record
+    return make
+
+
+def reload(db, record):
+    db.expire_all()
+    return db.get(UploadedFile, record.id)
+
+
+def test_ingest_task_records_the_store_and_its_dimensions(db, upload, worker_db, tmp_path):
+    write_mtx(tmp_path / 'source.mtx', random_counts(6, 4))
+    record = upload((tmp_path / 'source.mtx').read_text())
+
+    result = analysis.ingest_upload.apply(args=[record.id]).result
+
+    record = reload(db, record)
+    assert record.ingest_status == IngestStatus.READY
+    assert (record.n_cells, record.n_genes, record.nnz) == (6, 4, result['nnz'])
+    assert open_store(record.store_path).cells().shape == (6, 4)
+    assert analysis.ingest_upload.apply(args=[record.id]).result is None
+
+
+def test_ingest_task_fails_malformed_uploads_without_retrying(db, upload, worker_db):
+    record = upload('%%MatrixMarket matrix coordinate integer general\n2 2 1\n3 1 5\n')
+
+    result = analysis.ingest_upload.apply(args=[record.id]).result
+
+    record = reload(db, record)
+    assert result['status'] == 'failed'
+    assert record.ingest_status == IngestStatus.FAILED
+    assert record.ingest_error == result['error']
+    assert record.store_path is None
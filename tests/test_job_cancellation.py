@@ -0,0 +1,124 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+from app.api import jobs as jobs_api
+from app.core import scheduler
+from app.models.job import AnalysisJob, JobStatus
+from app.tasks import analysis
+
+
+@pytest.fixture
+def revoked(monkeypatch):
+    calls = []
+    monkeypatch.setattr(analysis.celery_app.control, 'revoke', lambda task_id, **options: calls.append(task_id))
+    return calls
+
+
+@pytest.fixture
+def dispatched(monkeypatch):
+    calls = []
+    monkeypatch.setattr(scheduler, 'dispatch_job', lambda job, *args: calls.append(job.id))
+    return calls
+
+
+def call(async_sessions, endpoint, job_id, account):
+    async def run():
+        async with async_sessions() as session:
+            return await endpoint(job_id, current_user=account, db=session)
+    return asyncio.run(run())
+
+
+def reload(db, analysis_job):
+    db.expire_all()
+    return db.get(AnalysisJob, analysis_job.id)
+
+
+def test_cancel_queued_job_frees_nothing(db, async_sessions, account, make_job, revoked):
+    queued = make_job(status=JobStatus.PENDING, celery_task_id='task-1')
+
+    call(async_sessions, jobs_api.cancel_job, queued.id, account)
+
+    queued = reload(db, queued)
+    assert queued.status == JobStatus.CANCELLED
+    assert queued.time_to_free_seconds == 0.0
+    assert queued.completed_at == queued.cancel_requested_at
+    assert revoked == ['task-1']
+
+
+def test_cancel_running_job_leaves_teardown_to_the_worker(db, async_sessions, account, make_job, revoked):
+    running = make_job(status=JobStatus.RUNNING, celery_task_id='task-2')
+
+    call(async_sessions, jobs_api.cancel_job, running.id, account)
+
+    running = reload(db, running)
+    assert running.status == JobStatus.CANCELLED
+    assert running.cancel_requested_at is not None
+    assert running.completed_at is None
+    assert revoked == ['task-2']
+
+
+@pytest.mark.parametrize('final_status', [JobStatus.COMPLETED, JobStatus.FAILED])
+def test_cancel_never_overrides_a_finished_job(db, async_sessions, account, make_job, revoked, final_status):
+    finished = make_job(status=final_status, celery_task_id='task-3')
+
+    with pytest.raises(HTTPException) as error:
+        call(async_sessions, jobs_api.cancel_job, finished.id, account)
+
+    assert error.value.status_code == 400
+    assert reload(db, finished).status == final_status
+    assert revoked == []
+
+
+def test_retry_waits_for_cancellation_teardown(db, async_sessions, account, make_job, dispatched):
+    cancelled = make_job(status=JobStatus.CANCELLED, cancel_requested_at=datetime.utcnow(),
+                         checkpoints='["qc"]')
+
+    with pytest.raises(HTTPException) as error:
+        call(async_sessions, jobs_api.retry_job, cancelled.id, account)
+    assert error.value.status_code == 409
+    assert dispatched == []
+
+    cancelled.completed_at = datetime.utcnow()
+    db.commit()
+    call(async_sessions, jobs_api.retry_job, cancelled.id, account)
+
+    retried = reload(db, cancelled)
+    assert retried.status == JobStatus.PENDING
+    assert retried.checkpoints is None
+    assert dispatched == [cancelled.id]
+
+
+def test_retry_of_cancelled_job_whose_worker_vanished(db, async_sessions, account, make_job, dispatched):
+    stale = datetime.utcnow() - timedelta(seconds=analysis.HEARTBEAT_TIMEOUT_SECONDS + 60)
+    cancelled = make_job(status=JobStatus.CANCELLED, cancel_requested_at=stale)
+
+    call(async_sessions, jobs_api.retry_job, cancelled.id, account)
+
+    assert dispatched == [cancelled.id]
+
+
+@pytest.mark.parametrize('current, claimed', [
+    (JobStatus.PENDING, True),
+    (JobStatus.RUNNING, True),
+    (JobStatus.CANCELLED, False),
+    (JobStatus.COMPLETED, False),
+])
+def test_worker_transitions_never_overwrite_a_cancel(db, make_job, current, claimed):
+    analysis_job = make_job(status=current)
+
+    assert analysis.claim_job_status(db, analysis_job, JobStatus.COMPLETED) is claimed
+    db.commit()
+
+    assert reload(db, analysis_job).status == (JobStatus.COMPLETED if claimed else current)
+
+
+@pytest.mark.parametrize('pool', ['solo', 'threads'])
+def test_workers_refuse_pools_that_cannot_cancel_running_jobs(pool):
+    with pytest.raises(SystemExit):
+        analysis.require_prefork_pool(sender=SimpleNamespace(pool_cls=pool))
+
+    analysis.require_prefork_pool(sender=SimpleNamespace(pool_cls='prefork'))
@@ -0,0 +1,124 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.api import jobs as jobs_api
+from app.core import job_events
+from app.core.job_events import build_event, format_sse, stream_events
+from app.models.job import JobStatus
+
+
+class Redis:
+    """The part of the async Redis client the event stream uses, fed from a list of messages"""
+
+    def __init__(self, messages=(), snapshots=None):
+        self.messages = list(messages)
+        self.snapshots = snapshots or {}
+        self.subscribed = []
+
+    def pubsub(self):
+        return self
+
+    async def subscribe(self, *channels):
+        self.subscribed.extend(channels)
+
+    async def unsubscribe(self, *channels):
+        for channel in channels:
+            self.subscribed.remove(channel)
+
+    async def close(self):
+        pass
+
+    async def get_message(self, ignore_subscribe_messages, timeout):
+        if not self.messages:
+            raise asyncio.CancelledError  # the client went away
+        message = self.messages.pop(0)
+        return message and {'data': json.dumps(message).encode()}
+
+    async def mget(self, keys):
+        return [self.snapshots.get(key) for key in keys]
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    def install(*messages, snapshots=None):
+        client = Redis(messages, snapshots)
+        monkeypatch.setattr(job_events, 'get_async_redis', lambda: client)
+        return client
+    return install
+
+
+def collect(stream):
+    async def run():
+        events = []
+        try:
+            async for event in stream:
+                events.append(event)
+        except asyncio.CancelledError:
+            pass
+        return events
+    return asyncio.run(run())
+
+
+def data(event):
+    return json.loads(event.split('data: ', 1)[1])
+
+
+def test_event_defaults_to_the_jobs_columns():
+    job = SimpleNamespace(id=3, status=JobStatus.RUNNING, progress_percent=40, current_step='pca')
+
+    assert build_event(job) | {'ts': None} == \
+        {'job_id': 3, 'status': 'running', 'progress': 40, 'step': 'pca', 'ts': None}
+    assert build_event(job, 55, 'umap', error='x')['progress'] == 55
+    assert format_sse('{}') == 'event: job\ndata: {}\n\n'
+
+
+def test_stream_sends_current_state_then_updates_until_the_job_ends(redis):
+    client = redis({'status': 'running', 'progress': 50}, None,
+                   {'status': 'completed', 'progress': 100}, {'status': 'running'})
+
+    events = collect(stream_events(['job_events:job:1'], initial=[{'status': 'pending', 'progress': 0}],
+                                   until_terminal=True))
+
+    assert [data(event)['progress'] for event in events if event.startswith('event:')] == [0, 50, 100]
+    assert ': keepalive\n\n' in events
+    assert client.subscribed == []
+
+
+def test_stream_of_a_finished_job_ends_after_its_state(redis):
+    client = redis({'status': 'running'})
+
+    events = collect(stream_events(['job_events:job:1'], initial=[{'status': 'failed'}], until_terminal=True))
+
+    assert [data(event)['status'] for event in events] == ['failed']
+    assert client.messages == [{'status': 'running'}]
+
+
+def test_user_stream_keeps_running_across_jobs(redis):
+    redis({'job_id': 1, 'status': 'completed'}, {'job_id': 2, 'status': 'running'})
+
+    events = collect(stream_events(['job_events:user:1']))
+
+    assert [data(event)['job_id'] for event in events] == [1, 2]
+
+
+def test_job_stream_starts_from_the_published_progress_of_a_live_job(redis, async_sessions, account, make_job):
+    running = make_job(status=JobStatus.RUNNING, progress_percent=10)
+    finished = make_job(status=JobStatus.COMPLETED, progress_percent=100)
+    snapshot = {'job_id': running.id, 'status': 'running', 'progress': 70}
+    redis({'job_id': running.id, 'status': 'completed', 'progress': 100}, snapshots={
+        job_events.snapshot_key(running.id): json.dumps(snapshot),
+        job_events.snapshot_key(finished.id): json.dumps({'status': 'running', 'progress': 90}),
+    })
+
+    def stream(job_id):
+        async def run():
+            async with async_sessions() as session:
+                response = await jobs_api.stream_job_events(job_id, current_user=account, db=session)
+                return response.body_iterator
+        return [data(event) for event in collect(asyncio.run(run()))]
+
+    assert [event['progress'] for event in stream(running.id)] == [70, 100]
+    assert [event['progress'] for event in stream(finished.id)] == [100]
@@ -0,0 +1,65 @@
+import asyncio
+import base64
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException, Response
+
+from app.api import jobs as jobs_api
+from app.api.jobs import decode_job_cursor, encode_job_cursor
+from app.models.job import JobStatus
+
+
+def list_page(async_sessions, account, **query):
+    async def run():
+        response = Response()
+        async with async_sessions() as session:
+            jobs = await jobs_api.list_jobs(response, **{'cursor': None, 'limit': 100, 'status': None, **query},
+                                            current_user=account, db=session)
+        return [job.id for job in jobs], response.headers.get('X-Next-Cursor')
+    return asyncio.run(run())
+
+
+def test_cursor_round_trips_its_position():
+    submitted_at = datetime(2024, 3, 1, 12, 30, 15, 250000)
+
+    assert decode_job_cursor(encode_job_cursor(submitted_at, 42)) == (submitted_at, 42)
+
+
+@pytest.mark.parametrize('cursor', [
+    'not base64!',
+    base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+    base64.urlsafe_b64encode(b'2024-03-01T12:00:00').decode(),
+    base64.urlsafe_b64encode(b'yesterday|7').decode(),
+    base64.urlsafe_b64encode(b'2024-03-01T12:00:00|seven').decode(),
+])
+def test_malformed_cursor_is_a_bad_request(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_job_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+def test_pages_walk_every_job_once_newest_first(async_sessions, account, make_job):
+    start = datetime(2024, 1, 1)
+    # Pairs of jobs share a submission time, so pages must break ties on id
+    jobs = [make_job(submitted_at=start + timedelta(minutes=i // 2)) for i in range(7)]
+
+    seen, cursor = [], None
+    for _ in range(4):
+        page, cursor = list_page(async_sessions, account, cursor=cursor, limit=2)
+        seen += page
+        if cursor is None:
+            break
+
+    assert seen == [job.id for job in sorted(jobs, key=lambda job: (job.submitted_at, job.id), reverse=True)]
+    assert cursor is None
+
+
+def test_listing_filters_by_status_and_owner(db, async_sessions, account, make_job):
+    running = make_job(status=JobStatus.RUNNING)
+    make_job(status=JobStatus.COMPLETED)
+    other = make_job(status=JobStatus.RUNNING)
+    other.user_id = account.id + 1
+    db.commit()
+
+    assert list_page(async_sessions, account, status='running') == ([running.id], None)
@@ -0,0 +1,109 @@
+import asyncio
+import os
+
+import pytest
+from fastapi import HTTPException, Response
+
+from app.api import jobs as jobs_api
+from app.core import job_logs
+from app.core.job_logs import JobLog, parse_progress, read_log
+from app.models.job import JobStatus
+from app.tasks import analysis
+
+
+@pytest.fixture(autouse=True)
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_logs, 'LOG_DIR', str(tmp_path / 'logs'))
+    return tmp_path / 'logs'
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('PROGRESS 40 Running PCA', (40.0, 'Running PCA')),
+    ('  PROGRESS 12.5%  ', (12.5, '')),
+    ('PROGRESS 250 done', (100.0, 'done')),
+    ('progress 40', None),
+    ('Computing PROGRESS 40', None),
+])
+def test_parse_progress(line, expected):
+    assert parse_progress(line) == expected
+
+
+def test_stage_lines_are_written_as_they_arrive_and_progress_is_reported(log_dir):
+    reported = []
+    log = JobLog(1, on_progress=lambda *progress: reported.append(progress))
+
+    log.write('qc', 'stdout', 'PROGRESS 30 Filtering')
+    log.write('qc', 'stderr', 'warning: few cells')
+    assert (log_dir / 'job_1.log').read_text() == '[qc] PROGRESS 30 Filtering\n[qc:stderr] warning: few cells\n'
+
+    log.close()
+    log.write('qc', 'stdout', 'after the job ended')
+    assert reported == [('qc', 30.0, 'Filtering')]
+    assert 'after' not in (log_dir / 'job_1.log').read_text()
+
+
+def test_log_rolls_over_keeping_a_bounded_number_of_files(log_dir, monkeypatch):
+    monkeypatch.setattr(job_logs, 'LOG_MAX_BYTES', 100)
+    monkeypatch.setattr(job_logs, 'LOG_BACKUPS', 2)
+    log = JobLog(1)
+
+    for n in range(40):
+        log.write('qc', 'stdout', f'line {n:02d}')  # 14 bytes, 7 per file
+    log.close()
+
+    assert sorted(os.listdir(log_dir)) == ['job_1.log', 'job_1.log.1', 'job_1.log.2']
+    assert all(os.path.getsize(log_dir / name) <= 100 for name in os.listdir(log_dir))
+    assert (log_dir / 'job_1.log').read_text().splitlines()[-1] == '[qc] line 39'
+    assert (log_dir / 'job_1.log.2').read_text().splitlines()[0] == '[qc] line 21'
+
+
+def test_reads_return_only_the_requested_range(log_dir, monkeypatch):
+    monkeypatch.setattr(job_logs, 'LOG_TAIL_BYTES', 4)
+    log_dir.mkdir()
+    (log_dir / 'job_1.log').write_bytes(b'0123456789')
+
+    assert read_log(1) == (b'6789', 10, 10)
+    assert read_log(1, offset=-3) == (b'789', 10, 10)
+    assert read_log(1, offset=2, limit=3) == (b'234', 5, 10)
+    assert read_log(1, offset=10) == (b'', 10, 10)
+    # Beyond the end: the log rotated since the last poll
+    assert read_log(1, offset=50) == (b'0123456789', 10, 10)
+    assert read_log(2) == (b'', 0, 0)
+
+
+def test_logs_endpoint_follows_a_job_by_offset(db, async_sessions, account, make_job, log_dir):
+    job = make_job()
+    other = make_job(user_id=account.id + 1)
+    log_dir.mkdir()
+    (log_dir / f'job_{job.id}.log').write_text('[qc] one\n[qc] two\n')
+
+    async def get(job_id, offset):
+        async with async_sessions() as session:
+            return await jobs_api.get_job_logs(job_id, offset=offset, limit=256 * 1024,
+                                               current_user=account, db=session)
+
+    response = asyncio.run(get(job.id, None))
+    assert isinstance(response, Response)
+    assert response.body == b'[qc] one\n[qc] two\n'
+    assert response.headers['x-log-offset'] == response.headers['x-log-size'] == '18'
+
+    with open(log_dir / f'job_{job.id}.log', 'a') as f:
+        f.write('[qc] three\n')
+    assert asyncio.run(get(job.id, 18)).body == b'[qc] three\n'
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(get(other.id, None))
+    assert error.value.status_code == 404
+
+
+def test_failed_stage_output_is_kept_in_the_job_log(make_job, toy_pipeline, worker, tmp_path, log_dir, monkeypatch):
+    monkeypatch.setattr(analysis, 'admit_job', lambda analysis_job: True)
+    monkeypatch.setattr(analysis, 'release_job', lambda job_id: None)
+    monkeypatch.setenv('TOY_FAIL', 'toy_scale')
+    counts = tmp_path / 'counts.bin'
+    counts.write_bytes(b'x' * 10)
+    job = make_job(job_type='toy', input_file_path=str(counts), parameters='{}', celery_task_id='task')
+
+    worker(job.id, 'task')
+
+    assert '[toy_scale:stderr] toy_scale failed' in (log_dir / f'job_{job.id}.log').read_text().splitlines()
@@ -0,0 +1,62 @@
+import gzip
+import os
+
+import pytest
+
+from app.core.job_outputs import build_manifest, iter_file_range, parse_range
+
+
+@pytest.mark.parametrize('header, size, expected', [
+    (None, 10, None),
+    ('', 10, None),
+    ('items=0-4', 10, None),
+    ('bytes=0-1,4-5', 10, None),
+    ('bytes=0-4', 10, (0, 4)),
+    ('bytes=5-', 10, (5, 9)),
+    ('bytes=0-99', 10, (0, 9)),
+    ('bytes=-3', 10, (7, 9)),
+    ('bytes=-30', 10, (0, 9)),
+])
+def test_parse_range(header, size, expected):
+    assert parse_range(header, size) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=abc-', 'bytes=-', 'bytes=1-x', 'bytes=', 'bytes=5-2', 'bytes=--3'])
+def test_parse_range_ignores_malformed_ranges(header):
+    # RFC 9110: an invalid Range is ignored and the whole file is sent
+    assert parse_range(header, 10) is None
+
+
+@pytest.mark.parametrize('header, size', [
+    ('bytes=10-', 10),
+    ('bytes=-0', 10),
+    ('bytes=-3', 0),
+    ('bytes=0-', 0),
+])
+def test_parse_range_rejects_unsatisfiable_ranges(header, size):
+    with pytest.raises(ValueError):
+        parse_range(header, size)
+
+
+def test_iter_file_range_reads_stored_bytes(tmp_path):
+    content = bytes(range(256)) * 100
+    plain = tmp_path / 'data.bin'
+    plain.write_bytes(content)
+    packed = tmp_path / 'data.bin.gz'
+    packed.write_bytes(gzip.compress(content))
+
+    assert b''.join(iter_file_range(str(plain), 10, 5000)) == content[10:5001]
+    assert b''.join(iter_file_range(str(packed), 10, 5000, 'gzip')) == content[10:5001]
+
+
+def test_build_manifest_lists_files_without_itself(tmp_path):
+    (tmp_path / 'cluster').mkdir()
+    (tmp_path / 'cluster' / 'clusters.csv').write_text('cell,cluster\n')
+    (tmp_path / 'summary.json').write_text('{}')
+    (tmp_path / 'manifest.json').write_text('{}')
+
+    manifest = build_manifest(str(tmp_path))
+
+    assert [entry['name'] for entry in manifest['files']] == ['summary.json', os.path.join('cluster', 'clusters.csv')]
+    assert manifest['total_size'] == len('cell,cluster\n') + 2
+    assert manifest['files'][0]['content_type'] == 'application/json'
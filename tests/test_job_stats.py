@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from app.api import users as users_api
+from app.core import job_stats
+from app.core.job_stats import get_job_counts, invalidate_job_counts
+from app.models.job import JobStatus
+from app.models.user import User
+
+
+@pytest.fixture
+def redis(redis_server, monkeypatch):
+    monkeypatch.setattr(job_stats, 'get_redis', lambda: redis_server)
+    return redis_server
+
+
+@pytest.fixture
+def no_redis(monkeypatch):
+    """A client of a Redis that is down, without connection retries"""
+    import redis
+    from redis.backoff import NoBackoff
+    from redis.retry import Retry
+
+    client = redis.Redis(port=1, retry=Retry(NoBackoff(), 0))
+    monkeypatch.setattr(job_stats, 'get_redis', lambda: client)
+
+
+def test_counts_come_from_one_grouped_query(db, account, make_job, no_redis):
+    for status in (JobStatus.COMPLETED, JobStatus.COMPLETED, JobStatus.RUNNING, JobStatus.FAILED):
+        make_job(status=status)
+
+    assert get_job_counts(db, account.id) == {
+        'pending': 0, 'running': 1, 'completed': 2, 'failed': 1, 'cancelled': 0
+    }
+    assert get_job_counts(db, account.id + 1)['completed'] == 0
+
+
+def test_counts_are_cached_until_a_transition_invalidates_them(db, account, make_job, redis):
+    make_job(status=JobStatus.RUNNING)
+    assert get_job_counts(db, account.id)['running'] == 1
+
+    make_job(status=JobStatus.RUNNING)
+    assert get_job_counts(db, account.id)['running'] == 1
+    assert redis.ttl(job_stats.stats_key(account.id)) <= job_stats.STATS_TTL_SECONDS
+
+    invalidate_job_counts(account.id)
+    assert get_job_counts(db, account.id)['running'] == 2
+
+
+def test_dashboard_stats_combine_counts_and_fresh_usage(db, async_sessions, account, make_job, no_redis):
+    make_job(status=JobStatus.COMPLETED)
+    make_job(status=JobStatus.PENDING)
+    account.storage_used_mb = 12.5
+    db.commit()
+
+    async def run():
+        async with async_sessions() as session:
+            user = await session.get(User, account.id)
+            return await users_api.get_user_stats(current_user=user, db=session)
+
+    assert asyncio.run(run()) == {
+        'total_jobs': 2, 'running_jobs': 0, 'completed_jobs': 1, 'failed_jobs': 0,
+        'storage_used_mb': 12.5, 'compute_hours_used': 0.0,
+    }
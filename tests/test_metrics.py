@@ -0,0 +1,87 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import CollectorRegistry
+
+from app.core import metrics, redis_client
+from app.core.metrics import PRIORITY_SEPARATOR, QueueDepthCollector, WorkerHistogramCollector, observe
+from app.core.scheduler import SIZE_CLASSES
+
+
+@pytest.fixture
+def redis(redis_server, monkeypatch):
+    monkeypatch.setattr(redis_client, '_redis', redis_server)
+    return redis_server
+
+
+@pytest.fixture
+def no_redis(monkeypatch):
+    import redis
+    from redis.backoff import NoBackoff
+    from redis.retry import Retry
+
+    monkeypatch.setattr(redis_client, '_redis', redis.Redis(port=1, retry=Retry(NoBackoff(), 0)))
+
+
+def samples(collector, name):
+    return {(sample.name, tuple(sample.labels.items())): sample.value
+            for family in collector.collect() if family.name == name for sample in family.samples}
+
+
+def test_worker_observations_are_collected_as_histograms(redis):
+    for seconds in (0.5, 3, 3, 7200):
+        observe('job_stage_duration_seconds', seconds, stage='qc')
+    observe('job_stage_duration_seconds', 20, stage='pca')
+
+    values = samples(WorkerHistogramCollector(), 'job_stage_duration_seconds')
+
+    qc = (('stage', 'qc'),)
+    assert values[('job_stage_duration_seconds_bucket', qc + (('le', '1'),))] == 1
+    assert values[('job_stage_duration_seconds_bucket', qc + (('le', '5'),))] == 3
+    assert values[('job_stage_duration_seconds_bucket', qc + (('le', '3600'),))] == 3
+    assert values[('job_stage_duration_seconds_bucket', qc + (('le', '+Inf'),))] == 4
+    assert values[('job_stage_duration_seconds_count', qc)] == 4
+    assert values[('job_stage_duration_seconds_sum', qc)] == pytest.approx(7206.5)
+    assert values[('job_stage_duration_seconds_count', (('stage', 'pca'),))] == 1
+
+
+def test_queue_depth_adds_up_every_priority_of_a_queue(redis):
+    queue = SIZE_CLASSES[0][0]
+    redis.rpush(queue, 'a', 'b')
+    redis.rpush(f'{queue}{PRIORITY_SEPARATOR}3', 'c')
+
+    values = samples(QueueDepthCollector(), 'celery_queue_depth')
+
+    assert values[('celery_queue_depth', (('queue', queue),))] == 3
+    assert values[('celery_queue_depth', (('queue', SIZE_CLASSES[-1][0]),))] == 0
+
+
+def test_metrics_never_fail_without_redis(no_redis):
+    observe('job_queue_wait_seconds', 1.0, queue='small')
+
+    assert samples(WorkerHistogramCollector(), 'job_queue_wait_seconds') == {}
+    assert list(QueueDepthCollector().collect()) == []
+
+
+def test_requests_are_timed_by_route_and_served_with_the_collectors(no_redis, monkeypatch):
+    registry = CollectorRegistry()
+    registry.register(metrics.REQUEST_LATENCY)
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    monkeypatch.delenv('PROMETHEUS_MULTIPROC_DIR', raising=False)
+    app = FastAPI()
+
+    @app.get('/api/jobs/{job_id}')
+    async def get_job(job_id: int):
+        return {'id': job_id}
+    metrics.install(app)
+
+    with TestClient(app) as client:
+        for job_id in (1, 2):
+            client.get(f'/api/jobs/{job_id}')
+        client.get('/nowhere')
+        body = client.get('/metrics').text
+
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/jobs/{job_id}",status="200"} 2.0' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="unmatched",status="404"} 1.0' in body
+    assert 'db_pool_connections{state="checked_out"} 0.0' in body
+    assert 'db_pool_saturation 0.0' in body
@@ -0,0 +1,145 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.core import output_store
+from app.core.job_outputs import build_manifest, open_stored, stored_name
+from app.core.output_store import collect_garbage, remove_outputs, store_outputs, stored_size_mb
+from app.core.resource_usage import charge_usage
+from app.models.job import AnalysisJob, JobStatus
+from app.models.user import SubscriptionTier, User
+from app.tasks import analysis, pipeline
+
+TABLE = b''.join(b'gene_%d\t%d\t%d\n' % (i, i * 3, i * 5) for i in range(8000))  # ~165 KB, compresses well
+NOISE = os.urandom(100 * 1024)
+
+
+@pytest.fixture(autouse=True)
+def blobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(output_store, 'BLOB_DIR', str(tmp_path / 'blobs'))
+    monkeypatch.setattr(output_store, 'COMPRESS_MIN_BYTES', 64 * 1024)
+    return tmp_path / 'blobs'
+
+
+@pytest.fixture
+def outputs(tmp_path):
+    """Writes a job output directory from {name: bytes}; returns (dir, stored manifest)"""
+    def make(name, files, codec=output_store.HOT_CODEC):
+        output_dir = tmp_path / 'outputs' / name
+        for filename, data in files.items():
+            (output_dir / filename).parent.mkdir(parents=True, exist_ok=True)
+            (output_dir / filename).write_bytes(data)
+        return output_dir, store_outputs(str(output_dir), build_manifest(str(output_dir)), codec=codec)
+    return make
+
+
+def entries(manifest):
+    return {entry['name']: entry for entry in manifest['files']}
+
+
+def read(output_dir, entry):
+    with open_stored(str(output_dir / stored_name(entry)), entry['encoding']) as f:
+        return f.read()
+
+
+def test_outputs_are_compressed_only_where_it_pays(outputs):
+    originals = {'matrix.tsv': TABLE, 'noise.bin': NOISE, 'plot.png': TABLE, 'small.csv': b'cell,cluster\n'}
+    output_dir, manifest = outputs('job_1', originals)
+
+    files = entries(manifest)
+    assert {name: entry['encoding'] for name, entry in files.items()} == \
+        {'matrix.tsv': 'gzip', 'noise.bin': 'identity', 'plot.png': 'identity', 'small.csv': 'identity'}
+    assert sorted(os.listdir(output_dir)) == ['matrix.tsv.gz', 'noise.bin', 'plot.png', 'small.csv']
+    assert files['matrix.tsv']['stored_size'] < len(TABLE) / 2
+    assert manifest['stored_size'] == sum(entry['stored_size'] for entry in files.values())
+    assert {name: read(output_dir, entry) for name, entry in files.items()} == originals
+
+
+def test_identical_outputs_of_different_jobs_are_stored_once(outputs, blobs):
+    first, manifest = outputs('job_1', {'matrix.tsv': TABLE, 'noise.bin': NOISE})
+    second, _ = outputs('job_2', {'copy/matrix.tsv': TABLE, 'noise.bin': NOISE})
+
+    assert os.path.samefile(first / 'matrix.tsv.gz', second / 'copy' / 'matrix.tsv.gz')
+    assert os.path.samefile(first / 'noise.bin', second / 'noise.bin')
+    assert os.stat(first / 'noise.bin').st_nlink == 3  # both jobs and the blob
+    assert len([name for _, _, names in os.walk(blobs) for name in names]) == 2
+
+
+def test_compressed_copy_never_replaces_another_output(outputs):
+    output_dir, manifest = outputs('job_1', {'a.csv': TABLE, 'a.csv.gz': b'already here'})
+
+    assert entries(manifest)['a.csv']['encoding'] == 'identity'
+    assert (output_dir / 'a.csv').read_bytes() == TABLE
+    assert (output_dir / 'a.csv.gz').read_bytes() == b'already here'
+
+
+def test_cold_codec_recompresses_stored_outputs(outputs):
+    output_dir, manifest = outputs('job_1', {'matrix.tsv': TABLE})
+    hot_size = manifest['stored_size']
+
+    cold = store_outputs(str(output_dir), manifest, codec=output_store.COLD_CODEC)
+
+    entry = entries(cold)['matrix.tsv']
+    assert entry['encoding'] == 'xz'
+    assert os.listdir(output_dir) == ['matrix.tsv.xz']
+    assert cold['stored_size'] < hot_size
+    assert read(output_dir, entry) == TABLE
+
+
+def test_only_unlinked_blobs_past_the_grace_period_are_collected(outputs, blobs, monkeypatch):
+    first, _ = outputs('job_1', {'matrix.tsv': TABLE, 'noise.bin': NOISE})
+    second, _ = outputs('job_2', {'noise.bin': NOISE})
+    remove_outputs(str(first))
+
+    assert collect_garbage() == 0  # just unlinked: still within the grace period
+    monkeypatch.setattr(output_store, 'BLOB_GRACE_SECONDS', -60)
+    freed = collect_garbage()
+
+    assert 0 < freed < len(TABLE)
+    assert (second / 'noise.bin').read_bytes() == NOISE
+    assert len([name for _, _, names in os.walk(blobs) for name in names]) == 1
+
+
+def test_stored_size_is_charged_from_the_manifest():
+    assert stored_size_mb(None) == 0.0
+    assert stored_size_mb({'total_size': 2 * 1024**2}) == 2.0
+    assert stored_size_mb({'total_size': 2 * 1024**2, 'stored_size': 1024**2 // 2}) == 0.5
+
+
+def test_retention_expires_old_outputs_and_moves_older_ones_to_cold_storage(
+        db, account, make_job, outputs, worker_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, 'STAGE_DIR', str(tmp_path / 'stages'))
+    free = User(email='free@localhost', username='free', hashed_password='!', subscription_tier=SubscriptionTier.FREE)
+    db.add(free)
+    db.commit()
+
+    def finished(user, name, days_ago):
+        output_dir, manifest = outputs(name, {'matrix.tsv': TABLE})
+        job = make_job(user_id=user.id, status=JobStatus.COMPLETED, output_directory=str(output_dir),
+                       completed_at=datetime.utcnow() - timedelta(days=days_ago),
+                       result_manifest=json.dumps(manifest), stored_mb=stored_size_mb(manifest))
+        db.execute(charge_usage(user.id, storage_mb=job.stored_mb))
+        db.commit()
+        return job
+
+    expired = finished(free, 'free_old', 40)
+    cold = finished(account, 'pro_old', 40)
+    recent = finished(account, 'pro_new', 1)
+    hot_mb = cold.stored_mb
+
+    result = analysis.apply_output_retention()
+
+    assert (result['removed'], result['cold']) == (1, 1)
+    db.expire_all()
+    expired, cold, recent = (db.get(AnalysisJob, job.id) for job in (expired, cold, recent))
+    assert expired.outputs_deleted_at is not None
+    assert not os.path.exists(expired.output_directory)
+    assert db.get(User, free.id).storage_used_mb == 0
+
+    assert cold.storage_tier == 'cold'
+    assert entries(json.loads(cold.result_manifest))['matrix.tsv']['encoding'] == 'xz'
+    assert cold.stored_mb < hot_mb
+    assert db.get(User, account.id).storage_used_mb == pytest.approx(cold.stored_mb + recent.stored_mb)
+    assert recent.storage_tier == 'hot'
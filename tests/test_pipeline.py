@@ -0,0 +1,93 @@
+import json
+import os
+import time
+
+import pytest
+
+from app.tasks import pipeline
+from app.tasks.pipeline import (
+    Stage, StageFailed, build_stage_command, compute_stage_keys, evict_stage_artifacts, run_pipeline,
+    stage_artifact_dir
+)
+
+SHA = 'c' * 64
+
+
+@pytest.fixture
+def counts(tmp_path):
+    path = tmp_path / 'counts.bin'
+    path.write_bytes(b'x' * 10)
+    return str(path)
+
+
+def test_parameter_change_rekeys_its_stage_and_everything_downstream(toy_pipeline):
+    base = compute_stage_keys('toy', SHA, {})
+
+    assert compute_stage_keys('toy', SHA, {'scale': 2, 'offset': None}) == base
+
+    shifted = compute_stage_keys('toy', SHA, {'offset': 1})
+    assert [shifted[name] == base[name] for name in base] == [True, True, False]
+
+    scaled = compute_stage_keys('toy', SHA, {'scale': 3})
+    assert [scaled[name] == base[name] for name in base] == [True, False, False]
+
+    other_input = compute_stage_keys('toy', 'd' * 64, {})
+    assert not set(other_input.values()) & set(base.values())
+
+
+def test_completed_stages_are_reused_by_later_jobs(toy_pipeline, counts, tmp_path):
+    summary = run_pipeline('toy', counts, SHA, {}, str(tmp_path / 'job1'))
+    assert summary == {'value': 20.0}
+    assert toy_pipeline() == ['toy_load', 'toy_scale', 'toy_shift']
+
+    assert run_pipeline('toy', counts, SHA, {}, str(tmp_path / 'job2')) == summary
+    assert len(toy_pipeline()) == 3
+
+    assert run_pipeline('toy', counts, SHA, {'offset': 5}, str(tmp_path / 'job3')) == {'value': 25.0}
+    assert toy_pipeline()[3:] == ['toy_shift']
+
+    stages = json.loads((tmp_path / 'job3' / 'stages.json').read_text())
+    assert [stage['reused'] for stage in stages] == [True, True, False]
+    assert (tmp_path / 'job3' / 'toy_shift' / 'value.txt').read_text() == '25.0'
+
+
+def test_failed_stage_publishes_nothing_and_a_rerun_resumes_after_the_last_good_stage(
+        toy_pipeline, counts, tmp_path, monkeypatch):
+    monkeypatch.setenv('TOY_FAIL', 'toy_scale')
+    with pytest.raises(StageFailed) as error:
+        run_pipeline('toy', counts, SHA, {}, str(tmp_path / 'job'))
+
+    assert error.value.stage == 'toy_scale'
+    keys = compute_stage_keys('toy', SHA, {})
+    assert os.listdir(os.path.dirname(stage_artifact_dir('toy_scale', keys['toy_scale']))) == []
+
+    monkeypatch.delenv('TOY_FAIL')
+    assert run_pipeline('toy', counts, SHA, {}, str(tmp_path / 'job')) == {'value': 20.0}
+    assert toy_pipeline() == ['toy_load', 'toy_scale', 'toy_scale', 'toy_shift']
+
+
+def test_runtime_parameters_reach_the_stage_but_not_its_key(toy_pipeline, monkeypatch):
+    stage = Stage('toy_labels', 'python', 'toy.py', (), {'labels_sha256': ''}, runtime_params=('labels_path',))
+    monkeypatch.setitem(pipeline.STAGES, stage.name, stage)
+    monkeypatch.setitem(pipeline.JOB_PIPELINES, 'toy_labels', [stage.name])
+    params = {'labels_sha256': 'e' * 64}
+
+    assert compute_stage_keys('toy_labels', SHA, {**params, 'labels_path': '/a/clusters.csv'}) == \
+        compute_stage_keys('toy_labels', SHA, {**params, 'labels_path': '/b/clusters.csv'})
+
+    cmd = build_stage_command(stage, '/in', {}, '/out', {**params, 'labels_path': '/a/clusters.csv'})
+    assert cmd[-4:] == ['--labels_sha256', 'e' * 64, '--labels_path', '/a/clusters.csv']
+
+
+def test_idle_artifacts_are_evicted_unless_referenced(toy_pipeline, counts, tmp_path):
+    run_pipeline('toy', counts, SHA, {}, str(tmp_path / 'job'))
+    keys = compute_stage_keys('toy', SHA, {})
+    idle = time.time() - (pipeline.STAGE_IDLE_DAYS + 1) * 86400
+    for name, key in keys.items():
+        os.utime(os.path.join(stage_artifact_dir(name, key), pipeline.SUCCESS_MARKER), (idle, idle))
+
+    evict_stage_artifacts({('toy_load', keys['toy_load'])})
+
+    assert [os.path.isdir(stage_artifact_dir(name, key)) for name, key in keys.items()] == [True, False, False]
+    # The job's published outputs are hard links and survive eviction
+    assert (tmp_path / 'job' / 'toy_shift' / 'value.txt').read_text() == '20.0'
@@ -0,0 +1,91 @@
+import time
+
+import pytest
+from sqlalchemy import create_engine, event
+
+from app.models.job import AnalysisJob
+from app.tasks import analysis
+from app.tasks.progress_buffer import ProgressBuffer
+
+
+@pytest.fixture
+def engine(database_url):
+    engine = create_engine(database_url)
+    engine.updates = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def record_update(conn, cursor, statement, *args):
+        if statement.startswith('UPDATE'):
+            engine.updates.append(statement)
+
+    yield engine
+    engine.dispose()
+
+
+def reload(db, job):
+    db.expire_all()
+    return db.get(AnalysisJob, job.id)
+
+
+def test_updates_are_coalesced_into_one_write(db, engine, make_job):
+    job = make_job()
+    buffer = ProgressBuffer(engine, job.id, interval=60)
+
+    for percent in range(10, 60, 10):
+        buffer.update(progress_percent=percent, current_step=f"step {percent}")
+    assert engine.updates == []
+
+    buffer.stop()
+
+    job = reload(db, job)
+    assert (job.progress_percent, job.current_step) == (50, 'step 50')
+    assert job.heartbeat_at is not None
+    assert len(engine.updates) == 1
+
+
+def test_timer_flushes_a_heartbeat_while_the_job_runs(db, engine, make_job):
+    job = make_job()
+    buffer = ProgressBuffer(engine, job.id, interval=0.05)
+
+    buffer.start()
+    time.sleep(0.3)
+    buffer.stop(flush=False)
+
+    assert reload(db, job).heartbeat_at is not None
+    assert len(engine.updates) >= 2
+
+
+def test_failed_write_keeps_values_older_than_later_updates(db, engine, make_job, monkeypatch):
+    job = make_job()
+    buffer = ProgressBuffer(engine, job.id, interval=60)
+    buffer.update(progress_percent=20, current_step='qc')
+
+    def fail():
+        buffer.update(progress_percent=30)
+        raise ConnectionError('database went away')
+    monkeypatch.setattr(engine, 'begin', fail)
+    buffer.flush()
+    monkeypatch.undo()
+
+    buffer.flush()
+    job = reload(db, job)
+    assert (job.progress_percent, job.current_step) == (30, 'qc')
+
+
+def test_each_worker_process_keeps_one_engine(database_url, monkeypatch):
+    monkeypatch.setattr(analysis, 'DATABASE_URL', database_url)
+    monkeypatch.setattr(analysis, '_engine', None)
+    monkeypatch.setattr(analysis, '_SessionLocal', None)
+
+    first, second = analysis.get_worker_session(), analysis.get_worker_session()
+    assert first.get_bind() is second.get_bind() is analysis._engine
+    inherited = analysis._engine
+
+    # After a fork the child replaces the parent's engine without closing its connections
+    analysis.init_worker_db()
+    assert analysis._engine is not inherited
+    assert analysis.get_worker_session().get_bind() is analysis._engine
+
+    first.close()
+    second.close()
+    analysis.dispose_worker_db()
@@ -0,0 +1,115 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from app.tasks import references
+from app.tasks.ingest import open_matrix, write_store
+from app.tasks.references import get_reference, ivf_search, prepare_reference, reference_exists, warm_references
+
+TYPES = ['B cell', 'NK cell', 'T cell']
+
+
+def atlas_counts(n_per_type, n_genes=60, seed=0):
+    """Cells of each type express their own block of 20 genes strongly"""
+    rng = np.random.default_rng(seed)
+    dense = rng.poisson(0.2, size=(n_per_type * len(TYPES), n_genes)).astype(np.float64)
+    for t in range(len(TYPES)):
+        dense[t * n_per_type:(t + 1) * n_per_type, t * 20:(t + 1) * 20] += rng.poisson(8, size=(n_per_type, 20))
+    return dense
+
+
+@pytest.fixture
+def atlas(tmp_path, monkeypatch):
+    """Writes a reference atlas under REFERENCE_DIR; returns a function (name) -> source dir"""
+    monkeypatch.setattr(references, 'REFERENCE_DIR', str(tmp_path / 'references'))
+    monkeypatch.setattr(references, 'REFERENCE_CACHE_DIR', str(tmp_path / 'prepared'))
+    monkeypatch.setattr(references, '_cache', OrderedDict())
+    monkeypatch.setattr(references, '_versions', {})
+    monkeypatch.setattr(references, 'IVF_MAX_LISTS', 4)
+
+    def make(name, n_per_type=40):
+        source_dir = tmp_path / 'references' / name
+        source_dir.mkdir(parents=True)
+        counts = atlas_counts(n_per_type)
+        matrix = tmp_path / f'{name}.csv'
+        # Genes as rows, as uploads are
+        header = 'gene,' + ','.join(f'cell_{c}' for c in range(counts.shape[0]))
+        rows = [f'gene_{g},' + ','.join(str(int(v)) for v in row) for g, row in enumerate(counts.T)]
+        matrix.write_text('\n'.join([header, *rows]) + '\n')
+        write_store(str(source_dir / 'store'), open_matrix(str(matrix), matrix.name))
+        (source_dir / 'labels.txt').write_text(''.join(f'{t}\n' for t in TYPES for _ in range(n_per_type)))
+        return source_dir
+    return make
+
+
+def test_reference_names_cannot_leave_the_reference_directory(atlas):
+    atlas('pbmc')
+
+    assert references.list_references() == ['pbmc']
+    for name in ('../pbmc', '.prepared', 'pbmc/store', ''):
+        assert not reference_exists(name)
+
+
+def test_reference_is_prepared_once_per_version(atlas, monkeypatch):
+    source_dir = atlas('pbmc')
+    builds = []
+    build = references.build_reference
+
+    def counted_build(name, version, output_dir):
+        builds.append(version)
+        build(name, version, output_dir)
+    monkeypatch.setattr(references, 'build_reference', counted_build)
+
+    first = prepare_reference('pbmc')
+    assert prepare_reference('pbmc') == first
+
+    (source_dir / 'labels.txt').write_text((source_dir / 'labels.txt').read_text().replace('NK cell', 'NK'))
+    os.utime(source_dir / 'labels.txt', (0, 1))
+    second = prepare_reference('pbmc')
+
+    assert second != first
+    assert builds == [os.path.basename(first), os.path.basename(second)]
+    assert not [name for name in os.listdir(os.path.dirname(first)) if '.tmp-' in name]
+
+
+def test_index_search_matches_exact_search_when_every_list_is_probed():
+    rng = np.random.default_rng(1)
+    embeddings = rng.normal(size=(300, 5)).astype(np.float32)
+    queries = rng.normal(size=(20, 5)).astype(np.float32)
+    centroids, order, offsets = references.build_ivf_index(embeddings, rng)
+
+    indices, distances = ivf_search(queries, embeddings, centroids, order, offsets, k=5, nprobe=len(centroids))
+
+    exact = ((queries[:, None, :] - embeddings[None, :, :]) ** 2).sum(axis=2)
+    assert (indices == np.argsort(exact, axis=1)[:, :5]).all()
+    assert np.allclose(distances, np.sort(exact, axis=1)[:, :5], atol=1e-3)
+
+
+def test_query_cells_are_labelled_by_their_reference_neighbours(atlas):
+    atlas('pbmc')
+    reference = get_reference('pbmc')
+    queries = sp.csr_matrix(atlas_counts(10, seed=7))
+
+    markers = references._log_normalize(queries)[:, reference.marker_genes].toarray()
+    labels, confidence = reference.vote(reference.project(markers), k=5)
+
+    assert reference.cell_types == TYPES
+    assert labels == [t for t in TYPES for _ in range(10)]
+    assert (confidence > 0.5).all()
+
+
+def test_prepared_references_are_cached_least_recently_used_first(atlas, monkeypatch):
+    monkeypatch.setattr(references, 'REFERENCE_CACHE_SIZE', 2)
+    for name in ('a', 'b', 'c'):
+        atlas(name, n_per_type=10)
+
+    a = get_reference('a')
+    get_reference('b')
+    assert get_reference('a') is a
+    get_reference('c')
+
+    assert [name for name, _ in references._cache] == ['a', 'c']
+    assert warm_references(['a', 'missing']) == 'Unknown reference dataset: missing'
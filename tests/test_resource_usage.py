@@ -0,0 +1,111 @@
+import sys
+
+import pytest
+
+from app.core import resource_usage
+from app.core.resource_usage import (
+    charge_usage, concurrent_peak_mb, fit_memory_model, fit_memory_models, record_stage_usage, run_monitored
+)
+from app.models.usage import JobStageUsage
+from app.models.user import User
+
+BUSY = '''
+import sys
+block = bytearray(64 * 1024 * 1024)
+total = 0
+for i in range(3000000):
+    total += i
+print('stdout line')
+print('stderr line', file=sys.stderr)
+sys.exit(3)
+'''
+
+
+def usage(peak_rss_mb, started=None, wall_seconds=1.0, cpu_seconds=0.0):
+    entry = {'stage': 'qc', 'key': 'k', 'usage': {
+        'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds, 'peak_rss_mb': peak_rss_mb,
+        'read_mb': 0.0, 'write_mb': 0.0, 'max_processes': 1,
+    }}
+    if started is not None:
+        entry['started'] = started
+    return entry
+
+
+def test_monitored_command_reports_exit_code_output_and_real_usage(monkeypatch):
+    monkeypatch.setattr(resource_usage, 'SAMPLE_INTERVAL_SECONDS', 0.05)
+    lines = []
+
+    returncode, stdout, stderr, measured = run_monitored(
+        [sys.executable, '-c', BUSY], on_line=lambda stream, line: lines.append((stream, line))
+    )
+
+    assert returncode == 3
+    assert (stdout, stderr) == ('stdout line\n', 'stderr line\n')
+    assert sorted(lines) == [('stderr', 'stderr line'), ('stdout', 'stdout line')]
+    assert measured.peak_rss_mb >= 64
+    assert 0 < measured.cpu_seconds <= measured.wall_seconds + 0.5
+    assert measured.max_processes >= 1
+
+
+def test_output_tail_is_bounded(monkeypatch):
+    monkeypatch.setattr(resource_usage, 'OUTPUT_TAIL_LINES', 2)
+
+    _, stdout, _, _ = run_monitored([sys.executable, '-c', 'for i in range(5): print(i)'])
+
+    assert stdout == '3\n4\n'
+
+
+@pytest.mark.parametrize('stage_usage, peak', [
+    ([], 0.0),
+    ([usage(100), usage(300)], 300.0),
+    ([usage(100, started=0), usage(300, started=0.5)], 400.0),
+    ([usage(100, started=0), usage(300, started=1.0)], 300.0),
+    ([usage(100, started=0, wall_seconds=10), usage(50, started=1), usage(70, started=5), usage(500)], 500.0),
+    ([usage(100, started=0, wall_seconds=10), usage(50, started=1), usage(70, started=1.5)], 220.0),
+])
+def test_job_peak_sums_stages_that_overlap(stage_usage, peak):
+    assert concurrent_peak_mb(stage_usage) == peak
+
+
+def test_stage_usage_is_stored_and_charged_to_the_user(db, account, make_job):
+    job = make_job()
+
+    record_stage_usage(db, job, [usage(512, started=0, cpu_seconds=1800), usage(1024, started=5, cpu_seconds=1800)],
+                       n_cells=1000)
+    db.commit()
+
+    assert [(row.stage, row.n_cells, row.peak_rss_mb) for row in db.query(JobStageUsage)] == \
+        [('qc', 1000, 512.0), ('qc', 1000, 1024.0)]
+    assert job.cpu_hours == 1.0
+    assert job.memory_peak_gb == 1.0
+    db.expire_all()
+    assert db.get(User, account.id).compute_hours_used == 1.0
+
+
+def test_usage_refunds_never_take_a_counter_below_zero(db, account):
+    db.execute(charge_usage(account.id, storage_mb=5.0))
+    db.execute(charge_usage(account.id, storage_mb=-8.0, compute_hours=-1.0))
+    db.commit()
+
+    db.expire_all()
+    user = db.get(User, account.id)
+    assert (user.storage_used_mb, user.compute_hours_used) == (0, 0)
+
+
+def test_memory_model_is_a_least_squares_line_through_recent_runs(db, make_job, monkeypatch):
+    assert fit_memory_model([(1000, 100.0)]) is None
+    assert fit_memory_model([(1000, 100.0), (1000, 200.0)]) is None
+    assert fit_memory_model([(1000, 300.0), (3000, 100.0)]) == (200.0, 0.0)
+
+    job = make_job()
+    monkeypatch.setattr(resource_usage, 'MEMORY_MODEL_SAMPLES', 3)
+    # The oldest run is outside the sample window
+    for n_cells, peak in [(1000, 9999.0), (1000, 150.0), (2000, 250.0), (4000, 450.0)]:
+        db.add(JobStageUsage(job_id=job.id, job_type='clustering', stage='qc', stage_key='k',
+                             n_cells=n_cells, peak_rss_mb=peak))
+    db.add(JobStageUsage(job_id=job.id, job_type='clustering', stage='pca', stage_key='k', peak_rss_mb=1.0))
+    db.commit()
+
+    base_mb, mb_per_cell = fit_memory_models(db, ['qc', 'pca'])['qc']
+    assert (base_mb, mb_per_cell) == (pytest.approx(50.0), pytest.approx(0.1))
+    assert fit_memory_models(db, ['pca']) == {'pca': None}
@@ -0,0 +1,98 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.core import result_cache
+from app.core.result_cache import (
+    canonicalize_parameters, compute_cache_key, evict_results, lookup_result, store_result
+)
+from app.models.cache import ResultCacheEntry
+from app.models.job import JobStatus
+
+SHA = 'a' * 64
+
+
+@pytest.mark.parametrize('params', [
+    {},
+    {'resolution': 0.8, 'n_pcs': 50},
+    {'n_pcs': 50.0, 'resolution': None},
+    {'engine': 'r'},
+    {'labels_job_id': 7, 'labels_path': '/data/outputs/job_7/clusters.csv'},
+])
+def test_equivalent_parameters_share_one_encoding(params):
+    assert canonicalize_parameters('clustering', params) == canonicalize_parameters('clustering', {})
+
+
+def test_encoding_is_stable_json_with_defaults_applied():
+    encoded = canonicalize_parameters('clustering', {'resolution': 1.2})
+
+    assert json.loads(encoded)['resolution'] == 1.2
+    assert json.loads(encoded)['n_neighbors'] == 20
+    assert encoded == json.dumps(json.loads(encoded), sort_keys=True, separators=(',', ':'))
+
+
+def test_cache_key_depends_on_content_type_parameters_and_engine():
+    base = compute_cache_key(SHA, 'clustering', {})
+
+    assert compute_cache_key(SHA, 'clustering', {'resolution': 0.8}) == base
+    assert len({
+        base,
+        compute_cache_key('b' * 64, 'clustering', {}),
+        compute_cache_key(SHA, 'clustering', {'resolution': 1.0}),
+        compute_cache_key(SHA, 'clustering', {'engine': 'native'}),
+        compute_cache_key(SHA, 'differential_expression', {}),
+    }) == 5
+
+
+@pytest.fixture
+def finished_job(make_job, tmp_path):
+    def make(name, size_mb=1.0, **values):
+        output_dir = tmp_path / name
+        output_dir.mkdir()
+        manifest = {'files': [], 'total_size': 0, 'stored_size': int(size_mb * 1024**2)}
+        return make_job(status=JobStatus.COMPLETED, output_directory=str(output_dir),
+                        cache_key=f"key-{name}", parameters='{}', result_manifest=json.dumps(manifest), **values)
+    return make
+
+
+def test_stored_result_is_found_and_counted(db, finished_job):
+    job = finished_job('one')
+    store_result(db, job, SHA, {'n_clusters': 4})
+
+    entry = lookup_result(db, job.user_id, 'key-one', 'clustering')
+    entry = lookup_result(db, job.user_id, 'key-one', 'clustering')
+
+    assert entry.output_directory == job.output_directory
+    assert json.loads(entry.result_summary) == {'n_clusters': 4}
+    assert entry.hit_count == 2
+    assert lookup_result(db, job.user_id + 1, 'key-one', 'clustering') is None
+
+
+def test_entry_whose_outputs_vanished_is_dropped(db, finished_job):
+    job = finished_job('gone')
+    store_result(db, job, SHA, {})
+    os.rmdir(job.output_directory)
+
+    assert lookup_result(db, job.user_id, 'key-gone', 'clustering') is None
+    assert db.query(ResultCacheEntry).count() == 0
+
+
+def test_eviction_drops_least_recently_used_unbacked_entries(db, account, finished_job, monkeypatch):
+    # PRO allows 500 GB; this budget holds 2 MB of cache-only outputs
+    monkeypatch.setattr(result_cache, 'CACHE_QUOTA_FRACTION', 2 / (500 * 1024))
+    jobs = [finished_job(name, size_mb=1.0) for name in ('old', 'mid', 'new', 'live')]
+    for age, job in zip((3, 2, 1, 4), jobs):
+        entry = store_result(db, job, SHA, {})
+        entry.last_used_at = datetime.utcnow() - timedelta(hours=age)
+    # Outputs of all but 'live' were removed from their jobs, so only the cache holds them
+    for job in jobs[:3]:
+        job.outputs_deleted_at = datetime.utcnow()
+    db.commit()
+
+    assert evict_results(db, account) == 1
+
+    remaining = {entry.cache_key for entry in db.query(ResultCacheEntry)}
+    assert remaining == {'key-mid', 'key-new', 'key-live'}
+    assert not os.path.exists(jobs[0].output_directory)
@@ -0,0 +1,95 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from app.core import scheduler
+from app.core.scheduler import admit_job, estimate_memory_mb, plan_job, release_job, size_class
+from app.models.job import JobStatus
+from app.models.usage import JobStageUsage
+from app.models.user import SubscriptionTier
+from app.tasks import analysis
+
+
+@pytest.fixture
+def redis(redis_server, monkeypatch):
+    monkeypatch.setattr(scheduler, 'get_redis', lambda: redis_server)
+    monkeypatch.setattr(scheduler, 'node_memory_mb', lambda: 1000 / scheduler.NODE_MEMORY_FRACTION)
+    return redis_server
+
+
+def job(job_id, memory_mb):
+    return SimpleNamespace(id=job_id, estimated_memory_mb=memory_mb)
+
+
+@pytest.mark.parametrize('memory_mb, queue', [
+    (512, 'analysis.small'),
+    (4 * 1024, 'analysis.small'),
+    (4 * 1024 + 1, 'analysis.medium'),
+    (64 * 1024, 'analysis.large'),
+    (200 * 1024, 'analysis.highmem'),
+])
+def test_jobs_are_routed_by_estimated_memory(memory_mb, queue):
+    assert size_class(memory_mb) == queue
+
+
+def test_memory_estimate_prefers_measured_stage_usage(db, make_job):
+    base_mb, mb_per_cell = scheduler.DEFAULT_MEMORY_MODEL['clustering']
+
+    assert estimate_memory_mb(db, 'clustering', 10000, None) == base_mb + mb_per_cell * 10000
+    assert estimate_memory_mb(db, 'clustering', None, 1024**2) == base_mb + scheduler.BYTES_IN_MEMORY_PER_FILE_BYTE
+
+    analysis_job = make_job()
+    for n_cells, peak in [(1000, 600.0), (3000, 1000.0)]:
+        db.add(JobStageUsage(job_id=analysis_job.id, job_type='clustering', stage='cluster', stage_key='k',
+                             n_cells=n_cells, peak_rss_mb=peak))
+    db.commit()
+    assert estimate_memory_mb(db, 'clustering', 10000, None) == pytest.approx(2400.0)
+
+
+def test_sweep_is_planned_for_the_points_that_run_at_once(db, account, make_job, monkeypatch):
+    monkeypatch.setattr('app.tasks.pipeline.SWEEP_MAX_WORKERS', 4)
+    single = make_job(parameters='{}')
+    sweep = make_job(job_type='sweep', parameters=json.dumps({
+        'job_type': 'clustering', 'parameters': {}, 'sweep': {'resolution': [0.2, 0.4, 0.8], 'n_pcs': [20, 40]}
+    }))
+    input_file = SimpleNamespace(n_cells=10000, total_size=None)
+
+    plan_job(db, single, input_file, account)
+    plan_job(db, sweep, input_file, account)
+
+    assert sweep.estimated_memory_mb == 4 * single.estimated_memory_mb
+    assert single.priority == scheduler.TIER_PRIORITY['pro']
+    assert scheduler.tier_priority(SubscriptionTier.ENTERPRISE) < scheduler.tier_priority('free')
+
+
+def test_node_admits_jobs_while_they_fit_its_budget(redis):
+    assert admit_job(job(1, 600))
+    assert admit_job(job(2, 400))
+    assert not admit_job(job(3, 1))
+
+    release_job(1)
+    assert admit_job(job(3, 500))
+    assert not admit_job(job(4, 200))
+
+
+def test_oversized_job_runs_alone_on_an_idle_node(redis):
+    assert admit_job(job(1, 5000))
+    assert not admit_job(job(2, 1))
+
+
+def test_only_the_admitted_delivery_releases_the_reservation(make_job, toy_pipeline, worker, tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(analysis, 'admit_job', lambda analysis_job: calls.append(('admit', analysis_job.id)) or True)
+    monkeypatch.setattr(analysis, 'release_job', lambda job_id: calls.append(('release', job_id)))
+    counts = tmp_path / 'counts.bin'
+    counts.write_bytes(b'x' * 10)
+    live = make_job(job_type='toy', input_file_path=str(counts), parameters='{}', celery_task_id='live')
+    cancelled = make_job(status=JobStatus.CANCELLED, celery_task_id='task')
+
+    assert worker(live.id, 'duplicate').result['status'] == 'superseded'
+    assert worker(cancelled.id, 'task').result['status'] == 'cancelled'
+    assert calls == []
+
+    assert worker(live.id, 'live').result['status'] == 'completed'
+    assert calls == [('admit', live.id), ('release', live.id)]
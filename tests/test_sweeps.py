@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+from app.api import jobs as jobs_api
+from app.tasks.pipeline import expand_sweep, run_sweep, summarize_sweep
+
+SHA = 'f' * 64
+
+
+def test_sweep_expands_to_the_grid_over_the_fixed_parameters():
+    points = expand_sweep({'n_pcs': 30, 'resolution': 0.8}, {'resolution': [0.4, 1.0], 'n_neighbors': [10, 20]})
+
+    assert points == [
+        {'n_pcs': 30, 'n_neighbors': 10, 'resolution': 0.4},
+        {'n_pcs': 30, 'n_neighbors': 10, 'resolution': 1.0},
+        {'n_pcs': 30, 'n_neighbors': 20, 'resolution': 0.4},
+        {'n_pcs': 30, 'n_neighbors': 20, 'resolution': 1.0},
+    ]
+
+
+def test_summary_compares_scalar_results_of_finished_points():
+    results = [
+        {'index': 1, 'parameters': {'resolution': 1.0}, 'status': 'failed', 'error': 'boom'},
+        {'index': 0, 'parameters': {'resolution': 0.4}, 'status': 'completed',
+         'summary': {'n_clusters': 5, 'resolution': 9, 'sizes': [3, 2]}},
+        None,
+    ]
+
+    assert summarize_sweep({'resolution': [0.4, 1.0, 2.0]}, results) == {
+        'swept_parameters': ['resolution'],
+        'total_points': 3,
+        'completed_points': 1,
+        'failed_points': 1,
+        'points': [
+            {'resolution': 0.4, 'index': 0, 'status': 'completed', 'n_clusters': 5},
+            {'resolution': 1.0, 'index': 1, 'status': 'failed', 'error': 'boom'},
+        ],
+    }
+
+
+def test_shared_stages_run_once_per_sweep(toy_pipeline, tmp_path):
+    counts = tmp_path / 'counts.bin'
+    counts.write_bytes(b'x' * 10)
+    finished = []
+
+    results = run_sweep('toy', str(counts), SHA, expand_sweep({}, {'scale': [1, 2], 'offset': [0, 1]}),
+                        str(tmp_path / 'sweep'), on_point=lambda index, result: finished.append(index),
+                        max_workers=4)
+
+    assert sorted(finished) == [0, 1, 2, 3]
+    assert [result['summary']['value'] for result in results] == [10.0, 20.0, 11.0, 21.0]
+    assert sorted(toy_pipeline()) == ['toy_load'] + ['toy_scale'] * 2 + ['toy_shift'] * 4
+    point = json.loads((tmp_path / 'sweep' / 'point_3' / 'summary.json').read_text())
+    assert point == {'value': 21.0}
+
+
+def test_failed_points_are_reported_and_shared_stages_kept(toy_pipeline, tmp_path, monkeypatch):
+    counts = tmp_path / 'counts.bin'
+    counts.write_bytes(b'x' * 10)
+    monkeypatch.setenv('TOY_FAIL', 'toy_shift')
+
+    results = run_sweep('toy', str(counts), SHA, expand_sweep({}, {'scale': [1, 2]}), str(tmp_path / 'sweep'))
+
+    assert [result['status'] for result in results] == ['failed', 'failed']
+    assert 'toy_shift' in results[0]['error']
+    assert sorted(toy_pipeline()) == ['toy_load', 'toy_scale', 'toy_scale', 'toy_shift', 'toy_shift']
+
+
+@pytest.mark.parametrize('sweep', [
+    {'not_a_parameter': [1, 2]},
+    {},
+    {'resolution': []},
+    {'resolution': list(range(9)), 'n_pcs': list(range(8))},
+])
+def test_invalid_sweeps_are_rejected(async_sessions, account, sweep):
+    request = jobs_api.SweepCreate(job_name='sweep', job_type='clustering', input_file_id='1', sweep=sweep)
+
+    async def run():
+        async with async_sessions() as session:
+            return await jobs_api.create_sweep(request, current_user=account, db=session)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(run())
+    assert error.value.status_code == 400
@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from app.api import jobs as jobs_api
+from app.core import job_logs, tracing
+from app.core.tracing import (
+    TRACEPARENT_ENV, end_job_trace, format_traceparent, new_span_id, new_trace_id, parse_traceparent, read_trace,
+    record_span, span, stage_environment, start_job_trace
+)
+from app.tasks import analysis
+
+TRACE_ID = 'a' * 32
+
+
+@pytest.fixture(autouse=True)
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_logs, 'LOG_DIR', str(tmp_path / 'logs'))
+    monkeypatch.setattr(tracing, 'LOG_DIR', str(tmp_path / 'logs'))
+    yield tmp_path / 'logs'
+    end_job_trace()
+
+
+def by_name(spans):
+    return {entry['name']: entry for entry in spans}
+
+
+def traced(name):
+    with span(name):
+        pass
+
+
+def test_traceparent_round_trip():
+    trace_id, span_id = new_trace_id(), new_span_id()
+
+    value = format_traceparent(trace_id, span_id)
+
+    assert value == f'00-{trace_id}-{span_id}-01'
+    assert parse_traceparent(value) == (trace_id, span_id)
+    for malformed in (None, '', 'garbage', f'00-{trace_id}-short-01', f'00-{trace_id}-{span_id}'):
+        assert parse_traceparent(malformed) is None
+
+
+def test_spans_nest_per_thread_under_the_job_root():
+    start_job_trace(1, TRACE_ID, 'root')
+
+    with span('pipeline', job_type='toy') as attributes:
+        attributes['stages'] = 3
+        traced('stage.load')
+        thread = threading.Thread(target=traced, args=('sweep.point',))
+        thread.start()
+        thread.join()
+    with pytest.raises(ValueError):
+        with span('outputs.store'):
+            raise ValueError('disk full')
+
+    spans = by_name(read_trace(1))
+    assert spans['pipeline']['parent_id'] == 'root'
+    assert spans['pipeline']['attributes'] == {'job_type': 'toy', 'stages': 3}
+    assert spans['stage.load']['parent_id'] == spans['pipeline']['span_id']
+    assert spans['sweep.point']['parent_id'] == 'root'  # other threads start at the root
+    assert spans['outputs.store']['attributes'] == {'error': 'ValueError'}
+    assert {entry['trace_id'] for entry in spans.values()} == {TRACE_ID}
+
+
+def test_nothing_is_recorded_outside_a_job(log_dir):
+    with span('pipeline') as attributes:
+        attributes['stages'] = 1
+
+    assert stage_environment() == {}
+    assert not log_dir.exists()
+
+
+def test_stage_processes_join_the_innermost_span():
+    start_job_trace(1, TRACE_ID, 'root')
+    assert stage_environment() == {TRACEPARENT_ENV: format_traceparent(TRACE_ID, 'root')}
+
+    with span('stage.load'):
+        environment = stage_environment()
+
+    assert environment == {TRACEPARENT_ENV: format_traceparent(TRACE_ID, read_trace(1)[0]['span_id'])}
+
+
+def test_trace_is_read_back_in_start_order_and_never_fails_a_request(log_dir):
+    record_span(1, TRACE_ID, 'second', start=20.0, duration=1.0)
+    record_span(1, TRACE_ID, 'first', start=10.0, duration=1.0)
+
+    assert [entry['name'] for entry in read_trace(1)] == ['first', 'second']
+    assert read_trace(2) == []
+
+    with open(log_dir / 'job_1.trace.jsonl', 'a') as f:
+        f.write('{"name": "tor')
+    assert read_trace(1) == []
+
+
+def test_worker_spans_continue_the_submitted_trace(db, make_job, toy_pipeline, worker_db, tmp_path, monkeypatch):
+    observed = []
+    monkeypatch.setattr(analysis, 'observe', lambda name, value, **labels: observed.append((name, labels)))
+    monkeypatch.setattr(analysis, 'admit_job', lambda analysis_job: True)
+    monkeypatch.setattr(analysis, 'release_job', lambda job_id: None)
+    monkeypatch.setattr(analysis, 'OUTPUT_ROOT', str(tmp_path / 'outputs'))
+    counts = tmp_path / 'counts.bin'
+    counts.write_bytes(b'x' * 10)
+    job = make_job(job_type='toy', input_file_path=str(counts), parameters='{}', celery_task_id='task',
+                   trace_id=TRACE_ID, queue='small')
+
+    analysis.run_analysis.apply(args=[job.id], task_id='task', headers={
+        'traceparent': format_traceparent(TRACE_ID, 'b' * 16), 'enqueued_at': time.time() - 2,
+    })
+
+    spans = by_name(read_trace(job.id))
+    run = spans['worker.run_analysis']
+    assert run['parent_id'] == spans['queue.wait']['parent_id'] == 'b' * 16
+    assert run['attributes']['status'] == 'completed'
+    assert spans['queue.wait']['duration'] >= 2
+    assert spans['pipeline']['parent_id'] == run['span_id']
+    for stage in ('toy_load', 'toy_scale', 'toy_shift'):
+        assert spans[f'stage.{stage}']['parent_id'] == spans['pipeline']['span_id']
+        assert spans[f'stage.{stage}']['attributes']['returncode'] == 0
+    assert spans['outputs.store']['parent_id'] == run['span_id']
+    assert {entry['trace_id'] for entry in spans.values()} == {TRACE_ID}
+
+    assert ('job_queue_wait_seconds', {'queue': 'small'}) in observed
+    assert ('job_duration_seconds', {'job_type': 'toy', 'size_class': 'small', 'status': 'completed'}) in observed
+    assert [labels['stage'] for name, labels in observed if name == 'job_stage_duration_seconds'] == \
+        ['toy_load', 'toy_scale', 'toy_shift']
+
+
+def test_trace_endpoint_returns_only_the_users_jobs(async_sessions, account, make_job):
+    job = make_job(trace_id=TRACE_ID)
+    untraced = make_job()
+    record_span(job.id, TRACE_ID, 'api.create_job', start=time.time(), duration=0.01)
+
+    async def get(job_id):
+        async with async_sessions() as session:
+            return await jobs_api.get_job_trace(job_id, current_user=account, db=session)
+
+    trace = asyncio.run(get(job.id))
+    assert trace['trace_id'] == TRACE_ID
+    assert [entry['name'] for entry in trace['spans']] == ['api.create_job']
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(get(untraced.id))
+    assert error.value.status_code == 404
@@ -0,0 +1,168 @@
+import asyncio
+import gzip
+import hashlib
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+from app.api import uploads
+from app.core.config import settings
+from app.models.upload import IngestStatus, UploadedFile, UploadStatus
+from app.models.user import User
+
+CONTENT = b'%%MatrixMarket matrix coordinate integer general\n3 4 2\n1 1 5\n3 4 1\n'
+
+
+@pytest.fixture
+def api(async_sessions, account, tmp_path, monkeypatch):
+    """Calls an upload endpoint as the test user, in a request-scoped session"""
+    monkeypatch.setattr(settings, 'UPLOAD_DIR', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(uploads, '_upload_hashers', {})
+
+    def call(endpoint, *args, body=None):
+        if body is not None:
+            args = (*args, Request(body))
+
+        async def run():
+            async with async_sessions() as session:
+                user = await session.get(User, account.id)
+                return await endpoint(*args, current_user=user, db=session)
+        return asyncio.run(run())
+    return call
+
+
+@pytest.fixture
+def ingests(monkeypatch):
+    calls = []
+    monkeypatch.setattr(uploads, 'dispatch_ingest', lambda upload: calls.append(upload.id))
+    return calls
+
+
+class Request:
+    """The part of a Starlette request upload_chunk reads: the streamed body"""
+
+    def __init__(self, body: bytes, piece: int = 4):
+        self.pieces = [body[i:i + piece] for i in range(0, len(body), piece)]
+
+    async def stream(self):
+        for piece in self.pieces:
+            yield piece
+
+
+def start(api, content=CONTENT, chunk_size=20, filename='counts.mtx'):
+    init = uploads.UploadInit(filename=filename, total_size=len(content), chunk_size=chunk_size)
+    return api(uploads.init_upload, init)
+
+
+def send(api, upload, index, content=CONTENT):
+    chunk_size = upload['chunk_size']
+    return api(uploads.upload_chunk, upload['id'], index, body=content[index * chunk_size:(index + 1) * chunk_size])
+
+
+def complete(api, upload, sha256=None):
+    return api(uploads.complete_upload, upload['id'], uploads.UploadComplete(sha256=sha256))
+
+
+def test_chunked_upload_is_hashed_and_ingested_once(api, ingests, db):
+    upload = start(api)
+    for index in range(upload['total_chunks']):
+        state = send(api, upload, index)
+    assert state['bytes_received'] == len(CONTENT)
+
+    done = complete(api, upload, hashlib.sha256(CONTENT).hexdigest().upper())
+    again = complete(api, upload)
+
+    assert done['status'] == again['status'] == UploadStatus.COMPLETED
+    assert done['sha256'] == hashlib.sha256(CONTENT).hexdigest()
+    assert (done['n_cells'], done['n_genes']) == (4, 3)
+    assert done['ingest_status'] == IngestStatus.PENDING
+    assert ingests == [upload['id']]
+    assert open(db.get(UploadedFile, upload['id']).file_path, 'rb').read() == CONTENT
+
+
+def test_upload_resumes_after_lost_acknowledgement_and_restart(api, ingests):
+    upload = start(api)
+    send(api, upload, 0)
+    send(api, upload, 1)
+
+    # The ack was lost and the client re-sends; then the running hash is lost (restart)
+    assert send(api, upload, 1)['chunks_received'] == 2
+    uploads._upload_hashers.clear()
+    for index in range(2, upload['total_chunks']):
+        send(api, upload, index)
+
+    assert complete(api, upload)['sha256'] == hashlib.sha256(CONTENT).hexdigest()
+
+
+def test_chunks_must_arrive_in_order(api):
+    upload = start(api)
+
+    with pytest.raises(HTTPException) as error:
+        send(api, upload, 1)
+    assert error.value.status_code == 409
+
+
+def test_chunk_being_written_by_another_request_is_refused_until_its_claim_expires(api, db):
+    upload = start(api)
+    record = db.get(UploadedFile, upload['id'])
+    record.chunk_claim, record.chunk_claimed_at = 'other-request', datetime.utcnow()
+    db.commit()
+
+    with pytest.raises(HTTPException) as error:
+        send(api, upload, 0)
+    assert error.value.status_code == 409
+
+    record.chunk_claimed_at = datetime.utcnow() - timedelta(seconds=uploads.CHUNK_CLAIM_SECONDS + 1)
+    db.commit()
+    assert send(api, upload, 0)['chunks_received'] == 1
+
+
+def test_oversized_chunk_is_rejected_and_can_be_sent_again(api):
+    upload = start(api)
+
+    with pytest.raises(HTTPException) as error:
+        api(uploads.upload_chunk, upload['id'], 0, body=CONTENT[:upload['chunk_size'] + 1])
+    assert error.value.status_code == 413
+
+    assert send(api, upload, 0)['chunks_received'] == 1
+
+
+def test_checksum_mismatch_is_not_completed(api, ingests):
+    upload = start(api)
+    for index in range(upload['total_chunks']):
+        send(api, upload, index)
+
+    with pytest.raises(HTTPException) as error:
+        complete(api, upload, '0' * 64)
+
+    assert error.value.status_code == 422
+    assert ingests == []
+
+
+def test_incomplete_upload_cannot_be_completed(api, ingests):
+    upload = start(api)
+    send(api, upload, 0)
+
+    with pytest.raises(HTTPException) as error:
+        complete(api, upload)
+
+    assert error.value.status_code == 409
+    assert ingests == []
+
+
+def test_storage_is_charged_per_acknowledged_chunk(api, db, account):
+    upload = start(api)
+    send(api, upload, 0)
+    send(api, upload, 0)
+
+    db.expire_all()
+    assert db.get(User, account.id).storage_used_mb == pytest.approx(upload['chunk_size'] / 1024**2)
+
+
+def test_matrix_dimensions_are_read_from_gzipped_headers(tmp_path):
+    path = tmp_path / 'matrix.mtx.gz'
+    path.write_bytes(gzip.compress(CONTENT))
+
+    assert uploads.read_matrix_dimensions(str(path), 'matrix.mtx.gz') == (4, 3)
+    assert uploads.read_matrix_dimensions(str(path), 'counts.csv') == (None, None)
@@ -0,0 +1,100 @@
+import os
+import sys
+
+import pytest
+
+from app.tasks import warm_pool
+from app.tasks.warm_pool import BLAS_THREAD_VARIABLES, WarmPool
+
+
+@pytest.fixture
+def pool():
+    pool = WarmPool(1)
+    yield pool
+    pool.close()
+
+
+def test_job_runs_forked_from_a_warm_server(pool, tmp_path):
+    script = tmp_path / 'job.py'
+    script.write_text(
+        'import os, sys\n'
+        'import numpy as np\n'
+        'a = np.ones((300, 300))\n'
+        'print(float((a @ a)[0, 0]), os.environ["JOB_VALUE"])\n'
+        'print(" ".join(os.environ[v] for v in sys.argv[1:]))\n'
+        'sys.exit(3)\n'
+    )
+
+    result = pool.run(['python', str(script), *BLAS_THREAD_VARIABLES], env={'JOB_VALUE': 'x'})
+
+    assert result is not None
+    returncode, stdout, _, usage = result
+    assert returncode == 3
+    assert stdout.splitlines() == ['300.0 x', '1 1 1']
+    assert usage.wall_seconds > 0
+
+
+def test_other_commands_are_left_to_a_subprocess(pool):
+    assert pool.run(['Rscript', 'stage.R']) is None
+
+
+def test_preload_reports_modules_it_cannot_import(monkeypatch, capsys):
+    monkeypatch.setattr(warm_pool, 'WARM_PRELOAD', ['json', 'no_such_module_for_warm_pool'])
+    for variable in BLAS_THREAD_VARIABLES:
+        monkeypatch.delenv(variable, raising=False)
+
+    warm_pool.preload()
+
+    assert 'not preloading no_such_module_for_warm_pool' in capsys.readouterr().err
+    assert all(os.environ[variable] == '1' for variable in BLAS_THREAD_VARIABLES)
+    assert 'json' in sys.modules
+
+
+def parent_pid(pool, script):
+    return int(pool.run(['python', str(script)])[1])
+
+
+def test_server_is_reused_until_it_has_run_its_jobs(pool, tmp_path, monkeypatch):
+    monkeypatch.setattr(warm_pool, 'WARM_MAX_JOBS', 2)
+    script = tmp_path / 'job.py'
+    script.write_text('import os\nprint(os.getppid())\n')
+
+    servers = [parent_pid(pool, script) for _ in range(3)]
+
+    assert servers[0] == servers[1] != servers[2]
+
+
+def test_server_over_its_memory_ceiling_is_replaced(pool, tmp_path, monkeypatch):
+    monkeypatch.setattr(warm_pool, 'WARM_MAX_RSS_MB', 0)
+    script = tmp_path / 'job.py'
+    script.write_text('import os\nprint(os.getppid())\n')
+
+    assert parent_pid(pool, script) != parent_pid(pool, script)
+
+
+def test_busy_pool_leaves_the_job_to_a_subprocess(pool, tmp_path):
+    busy = pool._acquire()
+    try:
+        assert pool.run(['python', str(tmp_path / 'job.py')]) is None
+    finally:
+        pool._retire(busy)
+
+
+def test_output_lines_are_streamed_as_they_are_printed(pool, tmp_path):
+    script = tmp_path / 'job.py'
+    script.write_text('import sys\nprint("step 1")\nprint("warning", file=sys.stderr)\nprint("step 2")\n')
+    lines = []
+
+    pool.run(['python', str(script)], on_line=lambda stream, line: lines.append((stream, line)))
+
+    assert sorted(lines) == [('stderr', 'warning'), ('stdout', 'step 1'), ('stdout', 'step 2')]
+
+
+def test_dead_server_sends_the_stage_to_a_subprocess_and_is_replaced(pool, tmp_path):
+    script = tmp_path / 'job.py'
+    script.write_text('import os, signal\nos.kill(os.getppid(), signal.SIGKILL)\n')
+
+    assert pool.run(['python', str(script)]) is None
+
+    script.write_text('print("again")\n')
+    assert pool.run(['python', str(script)])[1] == 'again\n'
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+import json
+import os
+import threading
+import time
+
+from app.core.job_logs import LOG_DIR
+
+# W3C trace context: created when a job is submitted, sent with its Celery task as a
+# header and to stage processes as the TRACEPARENT environment variable
+TRACEPARENT_HEADER = 'traceparent'
+TRACEPARENT_ENV = 'TRACEPARENT'
+
+# Spans are appended as JSON lines to a per-job file beside the job's log, by the API
+# and the worker alike; the job's trace endpoint reads them back
+TRACE_SUFFIX = '.trace.jsonl'
+
+_write_lock = threading.Lock()
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+def format_traceparent(trace_id: str, span_id: str) -> str:
+    return f"00-{trace_id}-{span_id}-01"
+
+def parse_traceparent(value: Optional[str]) -> Optional[Tuple[str, str]]:
+    """(trace id, parent span id) of a traceparent value, None if malformed"""
+    parts = (value or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+def trace_path(job_id: int) -> str:
+    return os.path.join(LOG_DIR, f"job_{job_id}{TRACE_SUFFIX}")
+
+def record_span(job_id: int, trace_id: str, name: str, start: float, duration: float,
+                parent_id: Optional[str] = None, span_id: Optional[str] = None, **attributes) -> str:
+    """Append a finished span (start is a Unix time) to the job's trace; returns its id"""
+    span_id = span_id or new_span_id()
+    line = json.dumps({
+        'trace_id': trace_id, 'span_id': span_id, 'parent_id': parent_id, 'name': name,
+        'start': start, 'duration': duration, 'attributes': attributes,
+    }) + '\n'
+    try:
+        with _write_lock:
+            os.makedirs(LOG_DIR, exist_ok=True)
+            with open(trace_path(job_id), 'a') as f:
+                f.write(line)
+    except OSError:
+        # Tracing must never fail a request or a job
+        pass
+    return span_id
+
+def read_trace(job_id: int) -> List[dict]:
+    """A job's spans in start order"""
+    try:
+        with open(trace_path(job_id), 'r') as f:
+            spans = [json.loads(line) for line in f if line.strip()]
+    except (OSError, ValueError):
+        return []
+    return sorted(spans, key=lambda span: span['start'])
+
+# The job this worker process is running (one at a time, as in app.core.process_control);
+# spans opened by a thread nest under that thread's innermost open span
+
+_job: Optional[Tuple[int, str, str]] = None
+_local = threading.local()
+
+def start_job_trace(job_id: int, trace_id: str, root_span_id: str):
+    global _job
+    _job = (job_id, trace_id, root_span_id)
+    _local.stack = []
+
+def end_job_trace():
+    global _job
+    _job = None
+    _local.stack = []
+
+def _stack() -> list:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Record the enclosed block as a span of the current job, if there is one. Yields the
+    span's attributes, which the block may add to; an exception is recorded as 'error'.
+    """
+    if _job is None:
+        yield attributes
+        return
+
+    job_id, trace_id, root_span_id = _job
+    stack = _stack()
+    parent_id = stack[-1] if stack else root_span_id
+    span_id = new_span_id()
+    stack.append(span_id)
+    start, started = time.time(), time.monotonic()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes['error'] = type(e).__name__
+        raise
+    finally:
+        stack.pop()
+        record_span(job_id, trace_id, name, start, time.monotonic() - started, parent_id, span_id, **attributes)
+
+def current_traceparent() -> Optional[str]:
+    if _job is None:
+        return None
+    stack = _stack()
+    return format_traceparent(_job[1], stack[-1] if stack else _job[2])
+
+def stage_environment() -> dict:
+    """Environment additions for a stage process, so its work joins the job's trace"""
+    traceparent = current_traceparent()
+    return {TRACEPARENT_ENV: traceparent} if traceparent else {}
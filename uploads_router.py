@@ -0,0 +1,461 @@
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel
+from typing import Optional
+from datetime import datetime, timedelta
+import aiofiles
+import asyncio
+import gzip
+import hashlib
+import math
+import os
+import uuid
+
+from app.core.database import get_db
+from app.core.security import get_current_user, load_usage
+from app.core.config import settings
+from app.core.resource_usage import charge_usage
+from app.core.scheduler import dispatch_ingest
+from app.models.user import User
+from app.models.upload import UploadedFile, UploadStatus, IngestStatus
+
+router = APIRouter()
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB
+MAX_CHUNK_SIZE = 64 * 1024 * 1024  # 64MB
+HASH_READ_SIZE = 1024 * 1024
+
+# A chunk claimed by a request that has not finished within this long may be re-sent
+CHUNK_CLAIM_SECONDS = int(os.getenv("UPLOAD_CHUNK_CLAIM_SECONDS", 15 * 60))
+
+# Running SHA-256 per upload, keyed by upload id -> (bytes hashed, hasher).
+# Lost on restart or when a chunk lands on another worker; rebuilt from disk then.
+_upload_hashers = {}
+
+# Schemas
+class UploadInit(BaseModel):
+    filename: str
+    total_size: int
+    chunk_size: Optional[int] = None
+
+class UploadComplete(BaseModel):
+    sha256: Optional[str] = None
+
+class UploadResponse(BaseModel):
+    id: str
+    filename: str
+    status: str
+    total_size: int
+    chunk_size: int
+    total_chunks: int
+    chunks_received: int
+    bytes_received: int
+    sha256: Optional[str]
+    ingest_status: Optional[str]
+    ingest_error: Optional[str]
+    n_cells: Optional[int]
+    n_genes: Optional[int]
+    nnz: Optional[int]
+
+    class Config:
+        from_attributes = True
+
+@router.post("/", response_model=UploadResponse, status_code=status.HTTP_201_CREATED)
+async def init_upload(
+    upload_data: UploadInit,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Start a chunked upload of a count matrix file"""
+
+    if upload_data.total_size <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="total_size must be positive"
+        )
+
+    chunk_size = upload_data.chunk_size or DEFAULT_CHUNK_SIZE
+    if chunk_size <= 0 or chunk_size > MAX_CHUNK_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"chunk_size must be between 1 and {MAX_CHUNK_SIZE} bytes"
+        )
+
+    # Check declared size up front so hopeless uploads never start
+    check_file_size(current_user, upload_data.total_size)
+    await load_usage(db, current_user)
+    check_storage_quota(current_user, upload_data.total_size)
+
+    # Create user upload directory
+    user_upload_dir = os.path.join(settings.UPLOAD_DIR, str(current_user.id))
+    os.makedirs(user_upload_dir, exist_ok=True)
+
+    upload_id = uuid.uuid4().hex
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    filename = os.path.basename(upload_data.filename)
+    file_path = os.path.join(user_upload_dir, f"{timestamp}_{upload_id[:8]}_{filename}")
+
+    db_upload = UploadedFile(
+        id=upload_id,
+        user_id=current_user.id,
+        filename=filename,
+        file_path=file_path,
+        status=UploadStatus.UPLOADING,
+        total_size=upload_data.total_size,
+        chunk_size=chunk_size,
+        chunks_received=0,
+        bytes_received=0
+    )
+
+    db.add(db_upload)
+    await db.commit()
+    await db.refresh(db_upload)
+
+    _upload_hashers[upload_id] = (0, hashlib.sha256())
+
+    return upload_response(db_upload)
+
+@router.get("/{upload_id}", response_model=UploadResponse)
+async def get_upload(
+    upload_id: str,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get upload state; clients resume from chunks_received"""
+    upload = await get_user_upload(upload_id, current_user.id, db)
+    return upload_response(upload)
+
+@router.put("/{upload_id}/chunks/{chunk_index}", response_model=UploadResponse)
+async def upload_chunk(
+    upload_id: str,
+    chunk_index: int,
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Upload chunk N of a file; the request body is the raw chunk bytes"""
+    upload = await get_user_upload(upload_id, current_user.id, db)
+
+    if upload.status != UploadStatus.UPLOADING:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload is {upload.status.value}"
+        )
+
+    total_chunks = count_chunks(upload)
+    if chunk_index < 0 or chunk_index >= total_chunks:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"chunk_index must be between 0 and {total_chunks - 1}"
+        )
+
+    # Re-sent chunk that was already acknowledged (e.g. the ack was lost)
+    if chunk_index < upload.chunks_received:
+        return upload_response(upload)
+
+    # Chunks are hashed on the fly, so they must arrive in order
+    if chunk_index > upload.chunks_received:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Expected chunk {upload.chunks_received}"
+        )
+
+    offset = chunk_index * upload.chunk_size
+    expected_size = min(upload.chunk_size, upload.total_size - offset)
+
+    # Quota is enforced per chunk, before any of its bytes are accepted
+    await load_usage(db, current_user)
+    check_storage_quota(current_user, expected_size)
+
+    # Only one request may write a chunk: concurrent writers would interleave in the
+    # file. The claim is committed, ending the read transaction, so no pooled
+    # connection sits idle while the body streams in.
+    claim = uuid.uuid4().hex
+    now = datetime.utcnow()
+    claimed = await db.execute(update(UploadedFile).where(
+        UploadedFile.id == upload.id,
+        UploadedFile.chunks_received == chunk_index,
+        or_(
+            UploadedFile.chunk_claim.is_(None),
+            UploadedFile.chunk_claimed_at < now - timedelta(seconds=CHUNK_CLAIM_SECONDS)
+        )
+    ).values(chunk_claim=claim, chunk_claimed_at=now).execution_options(synchronize_session=False))
+    await db.commit()
+    if claimed.rowcount != 1:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Chunk {chunk_index} is already being uploaded"
+        )
+
+    # A private copy, so the shared running hash only ever advances on acknowledgement
+    try:
+        hasher = (await get_upload_hasher(upload)).copy()
+    except BaseException:
+        await release_chunk_claim(db, upload.id, claim)
+        raise
+
+    # Stream the body straight into the final file, enforcing the chunk size as bytes arrive
+    written = 0
+    try:
+        async with aiofiles.open(upload.file_path, "r+b" if os.path.exists(upload.file_path) else "wb") as f:
+            # Drop whatever an interrupted attempt at this chunk left behind
+            await f.truncate(offset)
+            await f.seek(offset)
+
+            async for data in request.stream():
+                if not data:
+                    continue
+
+                written += len(data)
+                if written > expected_size:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"Chunk {chunk_index} exceeds expected size of {expected_size} bytes"
+                    )
+
+                await f.write(data)
+                hasher.update(data)
+
+        if written != expected_size:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Chunk {chunk_index} is {written} bytes, expected {expected_size}"
+            )
+    except BaseException:
+        await release_chunk_claim(db, upload.id, claim)
+        raise
+
+    # Acknowledged only while the claim still holds (it may have been abandoned and
+    # taken over); the storage charge is added in SQL, not from a possibly stale user
+    acknowledged = await db.execute(update(UploadedFile).where(
+        UploadedFile.id == upload.id,
+        UploadedFile.chunk_claim == claim,
+        UploadedFile.chunks_received == chunk_index
+    ).values(
+        chunks_received=chunk_index + 1, bytes_received=offset + written,
+        chunk_claim=None, chunk_claimed_at=None
+    ).execution_options(synchronize_session=False))
+    if acknowledged.rowcount != 1:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Chunk {chunk_index} was taken over by another request"
+        )
+    await db.execute(charge_usage(current_user.id, storage_mb=written / (1024**2)))
+    await db.commit()
+
+    upload.chunks_received = chunk_index + 1
+    upload.bytes_received = offset + written
+    _upload_hashers[upload.id] = (upload.bytes_received, hasher)
+
+    return upload_response(upload)
+
+@router.post("/{upload_id}/complete", response_model=UploadResponse)
+async def complete_upload(
+    upload_id: str,
+    complete_data: UploadComplete,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Finish an upload once every chunk has been acknowledged"""
+    upload = await get_user_upload(upload_id, current_user.id, db)
+
+    if upload.status == UploadStatus.COMPLETED:
+        return upload_response(upload)
+
+    if upload.status != UploadStatus.UPLOADING:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload is {upload.status.value}"
+        )
+
+    if upload.bytes_received != upload.total_size:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload incomplete: {upload.chunks_received}/{count_chunks(upload)} chunks received"
+        )
+
+    hasher = await get_upload_hasher(upload)
+    digest = hasher.hexdigest()
+
+    if complete_data.sha256 and complete_data.sha256.lower() != digest:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Checksum mismatch"
+        )
+
+    n_cells, n_genes = await asyncio.to_thread(read_matrix_dimensions, upload.file_path, upload.filename)
+
+    # Only the request that moves the upload out of UPLOADING dispatches its ingest;
+    # a concurrent /complete sees the finished upload instead of ingesting it twice
+    completed_at = datetime.utcnow()
+    completed = await db.execute(update(UploadedFile).where(
+        UploadedFile.id == upload.id,
+        UploadedFile.status == UploadStatus.UPLOADING,
+        UploadedFile.bytes_received == upload.total_size
+    ).values(
+        sha256=digest, n_cells=n_cells, n_genes=n_genes, status=UploadStatus.COMPLETED,
+        completed_at=completed_at, ingest_status=IngestStatus.PENDING
+    ).execution_options(synchronize_session=False))
+    await db.commit()
+    if completed.rowcount != 1:
+        await db.refresh(upload)
+        if upload.status == UploadStatus.COMPLETED:
+            return upload_response(upload)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload is {upload.status.value}"
+        )
+
+    upload.sha256 = digest
+    upload.n_cells, upload.n_genes = n_cells, n_genes
+    upload.status = UploadStatus.COMPLETED
+    upload.completed_at = completed_at
+    upload.ingest_status = IngestStatus.PENDING
+    _upload_hashers.pop(upload.id, None)
+
+    # Validate and convert once, in the background; clients poll ingest_status
+    dispatch_ingest(upload)
+
+    return upload_response(upload)
+
+@router.delete("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload(
+    upload_id: str,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Abort an in-progress upload and release its storage"""
+    upload = await get_user_upload(upload_id, current_user.id, db)
+
+    if upload.status != UploadStatus.UPLOADING:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload is {upload.status.value}"
+        )
+
+    if os.path.exists(upload.file_path):
+        os.remove(upload.file_path)
+
+    await db.execute(charge_usage(current_user.id, storage_mb=-upload.bytes_received / (1024**2)))
+    upload.status = UploadStatus.ABORTED
+    await db.commit()
+
+    _upload_hashers.pop(upload.id, None)
+
+    return None
+
+# Helper functions
+async def get_user_upload(upload_id: str, user_id: int, db: AsyncSession) -> UploadedFile:
+    """Get upload by ID if it belongs to user"""
+    upload = await db.scalar(select(UploadedFile).where(
+        UploadedFile.id == upload_id,
+        UploadedFile.user_id == user_id
+    ))
+
+    if not upload:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Upload not found"
+        )
+
+    return upload
+
+def count_chunks(upload: UploadedFile) -> int:
+    """Number of chunks the upload is split into"""
+    return math.ceil(upload.total_size / upload.chunk_size)
+
+def upload_response(upload: UploadedFile) -> dict:
+    """Serialize an upload including derived fields"""
+    return {
+        "id": upload.id,
+        "filename": upload.filename,
+        "status": upload.status,
+        "total_size": upload.total_size,
+        "chunk_size": upload.chunk_size,
+        "total_chunks": count_chunks(upload),
+        "chunks_received": upload.chunks_received,
+        "bytes_received": upload.bytes_received,
+        "sha256": upload.sha256,
+        "ingest_status": upload.ingest_status,
+        "ingest_error": upload.ingest_error,
+        "n_cells": upload.n_cells,
+        "n_genes": upload.n_genes,
+        "nnz": upload.nnz
+    }
+
+def check_file_size(user: User, file_size: int):
+    """Reject files over the global or per-tier size limit"""
+    if file_size > settings.MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File too large. Maximum size is {settings.MAX_UPLOAD_SIZE / (1024**3):.2f} GB"
+        )
+
+    limits = settings.SUBSCRIPTION_LIMITS[user.subscription_tier]
+    if file_size > limits["max_file_size_gb"] * 1024**3:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File too large. Your plan allows files up to {limits['max_file_size_gb']} GB"
+        )
+
+def check_storage_quota(user: User, additional_bytes: int):
+    """Reject writes that would take the user over their storage quota"""
+    limits = settings.SUBSCRIPTION_LIMITS[user.subscription_tier]
+    storage_used_gb = (user.storage_used_mb or 0) / 1024
+
+    if storage_used_gb + (additional_bytes / (1024**3)) > limits["storage_gb"]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=f"Storage quota exceeded. Your plan allows {limits['storage_gb']} GB"
+        )
+
+def read_matrix_dimensions(file_path: str, filename: str):
+    """(n_cells, n_genes) from a MatrixMarket header, or (None, None) for other formats"""
+    name = filename.lower()
+    if not (name.endswith(".mtx") or name.endswith(".mtx.gz")):
+        return None, None
+
+    opener = gzip.open if name.endswith(".gz") else open
+    try:
+        with opener(file_path, "rt") as f:
+            for line in f:
+                if line.startswith("%"):
+                    continue
+                # 10x layout: genes are rows, cells are columns
+                n_genes, n_cells = (int(value) for value in line.split()[:2])
+                return n_cells, n_genes
+    except (OSError, ValueError):
+        pass
+
+    return None, None
+
+async def release_chunk_claim(db: AsyncSession, upload_id: str, claim: str):
+    """Let the chunk be re-sent at once after a failed attempt"""
+    await db.rollback()
+    await db.execute(update(UploadedFile).where(
+        UploadedFile.id == upload_id,
+        UploadedFile.chunk_claim == claim
+    ).values(chunk_claim=None, chunk_claimed_at=None).execution_options(synchronize_session=False))
+    await db.commit()
+
+async def get_upload_hasher(upload: UploadedFile):
+    """Get the running SHA-256 for an upload, re-hashing acknowledged bytes if needed"""
+    cached = _upload_hashers.get(upload.id)
+    if cached and cached[0] == upload.bytes_received:
+        return cached[1]
+
+    hasher = hashlib.sha256()
+    remaining = upload.bytes_received
+    if remaining:
+        async with aiofiles.open(upload.file_path, "rb") as f:
+            while remaining > 0:
+                data = await f.read(min(HASH_READ_SIZE, remaining))
+                if not data:
+                    break
+                hasher.update(data)
+                remaining -= len(data)
+
+    _upload_hashers[upload.id] = (upload.bytes_received, hasher)
+    return hasher
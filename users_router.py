@@ -0,0 +1,29 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.database import get_db
+from app.core.security import get_current_user, load_usage
+from app.core.job_stats import get_job_counts
+from app.models.user import User
+
+router = APIRouter()
+
+@router.get("/stats")
+async def get_user_stats(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Get user statistics"""
+    
+    # Cached per user and invalidated on job status transitions
+    counts = await db.run_sync(get_job_counts, current_user.id)
+    await load_usage(db, current_user)
+    
+    return {
+        "total_jobs": sum(counts.values()),
+        "running_jobs": counts.get("running", 0),
+        "completed_jobs": counts.get("completed", 0),
+        "failed_jobs": counts.get("failed", 0),
+        "storage_used_mb": current_user.storage_used_mb,
+        "compute_hours_used": current_user.compute_hours_used
+    }
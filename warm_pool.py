@@ -0,0 +1,363 @@
+from collections import deque
+from multiprocessing.connection import Connection
+from typing import Callable, List, Optional, Sequence, Tuple
+import os
+import runpy
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from app.core.process_control import check_not_stopping, register_group, terminate_group, unregister_group
+from app.core.resource_usage import OUTPUT_TAIL_LINES, ProcessUsage, monitor_pid, pump_lines, _read_rss
+
+# Warm servers per Celery worker process; 0 runs every stage as a plain subprocess
+WARM_POOL_SIZE = int(os.getenv('WARM_POOL_SIZE', 2))
+
+# A server is replaced after this many jobs, or once its own RSS passes the ceiling
+WARM_MAX_JOBS = int(os.getenv('WARM_MAX_JOBS', 50))
+WARM_MAX_RSS_MB = float(os.getenv('WARM_MAX_RSS_MB', 2048))
+
+# Imported once per server so each job's fork starts with them loaded
+WARM_PRELOAD = [name for name in os.getenv('WARM_PRELOAD', 'numpy,scipy,pandas,anndata,scanpy').split(',') if name]
+
+# Native thread pools of BLAS/OpenMP libraries do not survive fork: a forked job
+# that calls into one whose workers were started in the server can hang. Servers
+# therefore load them single-threaded; the engines parallelise with their own pools.
+BLAS_THREAD_VARIABLES = ('OPENBLAS_NUM_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS')
+
+# Stage interpreters the servers can stand in for; Rscript stages run as subprocesses
+WARM_INTERPRETERS = ('python', 'python3')
+
+WARM_SERVER_MODULE = 'app.tasks.warm_pool'
+
+_pool = None
+
+# Server side: runs in `python -m app.tasks.warm_pool <fd>`
+
+def serve(fd: int):
+    """
+    Answer requests on the connection until it closes. Each 'run' request forks a child
+    that executes the script with the preloaded modules already imported, so jobs pay
+    neither interpreter startup nor import time and cannot leak state into each other.
+    References named in a request are loaded into the server's cache before the fork,
+    so they stay warm for later jobs and the child inherits them.
+    """
+    conn = Connection(fd)
+    preload()
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        if request.get('op') == 'shutdown':
+            break
+        if request.get('op') == 'run':
+            response = handle_run(conn, request)
+        else:
+            response = {'ok': False, 'error': f"Unknown op: {request.get('op')}"}
+
+        response['server_rss_mb'] = _read_rss(os.getpid()) / (1024**2)
+        try:
+            conn.send(response)
+        except (EOFError, OSError):
+            break
+
+def preload():
+    """
+    Import WARM_PRELOAD with BLAS limited to one thread (see BLAS_THREAD_VARIABLES).
+    A module that fails to import is reported on stderr (the worker's log) and
+    skipped; jobs that need it import it, and fail, themselves.
+    """
+    for variable in BLAS_THREAD_VARIABLES:
+        os.environ[variable] = '1'
+
+    for name in WARM_PRELOAD:
+        try:
+            __import__(name)
+        except ImportError as e:
+            print(f"warm server {os.getpid()}: not preloading {name}: {e}", file=sys.stderr, flush=True)
+        except Exception:
+            print(f"warm server {os.getpid()}: preloading {name} failed:\n{traceback.format_exc()}",
+                  file=sys.stderr, flush=True)
+
+def handle_run(conn: Connection, request: dict) -> dict:
+    """
+    Fork one job, wait for it while sampling its usage, and return its outcome.
+    With stream_output set, each output line is sent as an 'output' message while the
+    job runs; the final response carries only the last lines of each stream.
+    """
+    if request.get('references'):
+        from app.tasks.references import warm_references
+
+        # A reference that fails to load here is loaded (and fails properly) in the job
+        warm_references(request['references'])
+
+    try:
+        pipes = {name: os.pipe() for name in ('stdout', 'stderr')}
+        started = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            for read_fd, _ in pipes.values():
+                os.close(read_fd)
+            _run_child(request['script'], request['args'], pipes['stdout'][1], pipes['stderr'][1], request.get('env'))
+
+        for _, write_fd in pipes.values():
+            os.close(write_fd)
+
+        send_lock = threading.Lock()
+
+        def forward(stream: str, line: str):
+            with send_lock:
+                conn.send({'op': 'output', 'stream': stream, 'line': line})
+
+        tails = {name: deque(maxlen=OUTPUT_TAIL_LINES) for name in pipes}
+        streams = {name: os.fdopen(read_fd, 'r', errors='replace') for name, (read_fd, _) in pipes.items()}
+        readers = [
+            threading.Thread(
+                target=pump_lines, args=(stream, name, tails[name], forward if request.get('stream_output') else None),
+                daemon=True
+            )
+            for name, stream in streams.items()
+        ]
+        for reader in readers:
+            reader.start()
+
+        usage = ProcessUsage()
+        returncode = monitor_pid(pid, usage, started)
+        for reader in readers:
+            reader.join()
+        for stream in streams.values():
+            stream.close()
+
+        return {
+            'ok': True,
+            'returncode': returncode,
+            'stdout': ''.join(tails['stdout']),
+            'stderr': ''.join(tails['stderr']),
+            'usage': usage.to_dict(),
+        }
+    except Exception:
+        return {'ok': False, 'error': traceback.format_exc()}
+
+def _run_child(script: str, args: List[str], stdout_fd: int, stderr_fd: int, env: Optional[dict] = None):
+    """Body of a forked job: behave like `python script args...` and never return"""
+    code = 1
+    try:
+        os.environ.update(env or {})
+        for fd, target in ((1, stdout_fd), (2, stderr_fd)):
+            os.dup2(target, fd)
+            os.close(target)
+        # Line-buffered, so output reaches the job log as it is printed
+        sys.stdout.reconfigure(line_buffering=True)
+        sys.stderr.reconfigure(line_buffering=True)
+
+        if script == '-m':
+            # `python -m module args...`; the app package is already importable here
+            sys.argv = list(args)
+            runpy.run_module(args[0], run_name='__main__', alter_sys=True)
+        else:
+            sys.argv = [script] + list(args)
+            sys.path[0] = os.path.dirname(os.path.abspath(script))
+            runpy.run_path(script, run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+# Client side: used by the Celery worker process
+
+class WarmServer:
+    """One warm server process and its connection"""
+
+    def __init__(self):
+        parent, child = socket.socketpair()
+        try:
+            # Own session, so killing the group also takes down any running job
+            self.process = subprocess.Popen(
+                [sys.executable, '-m', WARM_SERVER_MODULE, str(child.fileno())],
+                pass_fds=(child.fileno(),), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                start_new_session=True
+            )
+        finally:
+            child.close()
+        self.conn = Connection(parent.detach())
+        self.jobs = 0
+        self.rss_mb = 0.0
+
+    def run(self, script: str, args: List[str], references: Sequence[str] = (),
+            on_line: Optional[Callable[[str, str], None]] = None, env: Optional[dict] = None) -> dict:
+        self.conn.send({
+            'op': 'run', 'script': script, 'args': args, 'references': list(references),
+            'stream_output': on_line is not None, 'env': env or {}
+        })
+        while True:
+            response = self.conn.recv()
+            if response.get('op') != 'output':
+                break
+            try:
+                on_line(response['stream'], response['line'])
+            except Exception:
+                # Same as run_monitored: a failing log sink does not fail the stage
+                pass
+        self.jobs += 1
+        self.rss_mb = response.get('server_rss_mb', 0.0)
+        return response
+
+    def is_worn_out(self) -> bool:
+        return self.jobs >= WARM_MAX_JOBS or self.rss_mb > WARM_MAX_RSS_MB
+
+    def close(self):
+        try:
+            self.conn.send({'op': 'shutdown'})
+        except (EOFError, OSError):
+            pass
+        self.conn.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.kill()
+
+    def kill(self):
+        """Stop the server and any job it is running: SIGTERM, then SIGKILL after a grace period"""
+        terminate_group(self.process.pid)
+        self.conn.close()
+        self.process.wait()
+
+class WarmPool:
+    """
+    Warm servers shared by the threads of one worker process (sweeps run stages
+    concurrently). When every server is busy the caller falls back to a subprocess
+    rather than waiting.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: List[WarmServer] = []
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Launch every server now so their imports finish before the first job"""
+        with self._lock:
+            while self._count < self.size:
+                self._idle.append(WarmServer())
+                self._count += 1
+
+    def run(self, cmd: List[str], references: Sequence[str] = (),
+            on_line: Optional[Callable[[str, str], None]] = None,
+            env: Optional[dict] = None) -> Optional[Tuple[int, str, str, ProcessUsage]]:
+        """
+        Run a stage command on a warm server. Output lines and env are handled as by
+        run_monitored, and the same tuple is returned, or None if the command should
+        run as a subprocess instead.
+        """
+        if cmd[0] not in WARM_INTERPRETERS or len(cmd) < 2:
+            return None
+
+        check_not_stopping()
+        server = self._acquire()
+        if server is None:
+            return None
+
+        # The server's process group includes the job, so stopping the job stops both
+        try:
+            register_group(server.process.pid)
+            try:
+                response = server.run(cmd[1], cmd[2:], references, on_line, env)
+            finally:
+                unregister_group(server.process.pid)
+        except (EOFError, OSError):
+            # The server died (e.g. OOM-killed, or the job was stopped); the subprocess
+            # path reruns the stage unless the job is being stopped
+            self._retire(server, kill=True)
+            return None
+        except BaseException:
+            # Cancelled, time limit or shutdown while waiting: do not leave the job running
+            self._retire(server, kill=True)
+            raise
+
+        if not response['ok']:
+            self._retire(server, kill=True)
+            return None
+
+        if server.is_worn_out():
+            self._retire(server)
+        else:
+            with self._lock:
+                self._idle.append(server)
+
+        return response['returncode'], response['stdout'], response['stderr'], ProcessUsage(**response['usage'])
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+        for server in idle:
+            server.close()
+
+    def _acquire(self) -> Optional[WarmServer]:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            if self._count >= self.size:
+                return None
+            self._count += 1
+
+        try:
+            return WarmServer()
+        except OSError:
+            with self._lock:
+                self._count -= 1
+            return None
+
+    def _retire(self, server: WarmServer, kill: bool = False):
+        with self._lock:
+            self._count -= 1
+        if kill:
+            server.kill()
+        else:
+            server.close()
+
+def get_pool() -> Optional[WarmPool]:
+    global _pool
+    if _pool is None and WARM_POOL_SIZE > 0:
+        _pool = WarmPool(WARM_POOL_SIZE)
+    return _pool
+
+def start_warm_pool():
+    """Called once per worker process; servers then warm up while the worker idles"""
+    pool = get_pool()
+    if pool:
+        pool.start()
+
+def stop_warm_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+def run_warm(cmd: List[str], references: Sequence[str] = (),
+             on_line: Optional[Callable[[str, str], None]] = None,
+             env: Optional[dict] = None) -> Optional[Tuple[int, str, str, ProcessUsage]]:
+    """Run a stage command on the warm pool, or return None to use a subprocess"""
+    pool = get_pool()
+    return pool.run(cmd, references, on_line, env) if pool else None
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]))